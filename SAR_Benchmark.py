@@ -0,0 +1,658 @@
+import argparse
+from collections import Counter
+import json
+import math
+import os
+import pickle
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+
+from SAR_lib import SAR_Project, PARALLEL_MIN, available_cpus
+from SAR_postings import CompressedPosting, posting_nbytes
+from SAR_postings import numpy, NUMPY_MIN, np_and, np_or, np_minus
+
+
+def build_index(args, **flags):
+    """
+    Indexa la coleccion de "args.newsdir" con las opciones "flags" (por defecto todas desactivadas).
+    """
+    opciones = {'multifield': False, 'positional': False, 'stem': False, 'permuterm': False}
+    opciones.update(flags)
+    indexer = SAR_Project()
+    indexer.index_dir(args.newsdir, **opciones)
+    return indexer
+
+
+def best_time(fnc, repeat):
+    """
+    Ejecuta "fnc" "repeat" veces y devuelve el mejor tiempo en segundos.
+    """
+    mejor = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fnc()
+        t = time.perf_counter() - t0
+        mejor = t if mejor is None else min(mejor, t)
+    return mejor
+
+
+def linear_and(p1, p2):
+    """
+    Interseccion con la mezcla lineal original, como referencia.
+    """
+    respuesta = []
+    i = 0
+    j = 0
+    while len(p1) > i and len(p2) > j:
+        if p1[i] == p2[j]:
+            respuesta.append(p1[i])
+            i = i + 1
+            j = j + 1
+        elif p1[i] < p2[j]:
+            i = i + 1
+        else:
+            j = j + 1
+    return respuesta
+
+
+def bench_indexing(args):
+    """
+    Indexa porciones crecientes de la coleccion y muestra el coste por token, en un solo
+    proceso y repartiendo los ficheros entre "args.workers" procesos (index_parallel,
+    aunque parallel_workers no lo haria), e indica cuantos usaria index_files.
+
+    Si la construccion de las posting lists es lineal, el tiempo por token
+    debe mantenerse (aproximadamente) constante al crecer la coleccion. Las dos
+    indexaciones se alternan para que el ruido de la maquina les afecte por igual.
+
+    """
+    ficheros = SAR_Project().news_files(args.newsdir)
+    tokens = SAR_Project()
+
+    def indexador():
+        indexer = SAR_Project()
+        indexer.positional = args.positional
+        indexer.multifield = args.multifield
+        indexer.ranking = args.rank
+        return indexer
+
+    def secuencial(parte):
+        indexer = indexador()
+        for filename in parte:
+            indexer.index_file(filename)
+
+    print("CPUs: %d, PARALLEL_MIN: %.1fMB" % (available_cpus(), PARALLEL_MIN / 2**20))
+    print("%8s %8s %10s %10s %12s %10s %8s %10s" % ('files', 'MB', 'tokens', 'W=1(s)', 'us/token',
+                                                   'W=%d(s)' % args.workers, 'speedup', 'index_files'))
+    for k in range(1, args.steps + 1):
+        parte = ficheros[:len(ficheros) * k // args.steps]
+        nbytes = sum(os.path.getsize(f) for f in parte)
+
+        # contamos los tokens fuera de la medicion
+        ntokens = 0
+        for filename in parte:
+            for new in tokens.read_file(filename):
+                ntokens += len(tokens.tokenize(new["article"]))
+
+        seq = par = None
+        for _ in range(args.repeat):
+            t = best_time(lambda: secuencial(parte), 1)
+            seq = t if seq is None else min(seq, t)
+            if args.workers > 1 and len(parte) > 1:
+                t = best_time(lambda: indexador().index_parallel(parte, args.workers), 1)
+                par = t if par is None else min(par, t)
+
+        print("%8d %8.2f %10d %10.3f %12.3f %10s %8s %10s" % (
+            len(parte), nbytes / 2**20, ntokens, seq, seq / ntokens * 1e6,
+            '-' if par is None else '%.3f' % par, '-' if par is None else '%.2fx' % (seq / par),
+            'W=%d' % indexador().parallel_workers(parte, args.workers)))
+
+
+def regex_tokenize(text):
+    """
+    Tokenizacion original (sustituir los simbolos por espacios y dividir), como referencia.
+    """
+    return re.sub(r"\W+", ' ', text.lower()).split()
+
+
+def bench_tokenizer(args):
+    """
+    Compara la tokenizacion original (sub + split) con tokenize (findall) y con
+    tokenize_ids, que ademas devuelve el term id de cada token, y el paso completo de
+    index_file para cada noticia: tokenizar y agrupar las apariciones de cada termino
+    (Counter, o sus posiciones con el indice posicional) sobre cadenas, como el indexador
+    original, y sobre term id. Se mide sobre los articulos de la coleccion, ya leidos en
+    memoria. Los term id se obtienen con un vocabulario vacio en cada medida (incluyen
+    añadir los terminos nuevos, como al indexar), y las medidas de los metodos se
+    alternan para que el ruido de la maquina les afecte por igual.
+
+    """
+    lector = SAR_Project()
+    textos = [new['article'] for filename in lector.news_files(args.newsdir) for new in lector.read_file(filename)]
+    ntokens = sum(len(regex_tokenize(t)) for t in textos)
+    for t in textos[:100]:
+        assert regex_tokenize(t) == lector.tokenize(t)
+
+    def vocabulario_nuevo(fnc):
+        return lambda: fnc(SAR_Project().tokenize_ids)
+
+    def posiciones(palabras):
+        apariciones = {}
+        for j, w in enumerate(palabras):
+            apariciones.setdefault(w, []).append(j)
+        return apariciones
+
+    # (metodo, si es la referencia de los siguientes, funcion)
+    metodos = (('regex sub + split (original)', True, lambda: [regex_tokenize(t) for t in textos]),
+               ('findall', False, lambda: [lector.tokenize(t) for t in textos]),
+               ('findall + term ids', False, vocabulario_nuevo(lambda ids: [ids(t) for t in textos])),
+               ('original + Counter', True, lambda: [Counter(regex_tokenize(t)) for t in textos]),
+               ('term ids + Counter', False, vocabulario_nuevo(lambda ids: [Counter(ids(t)) for t in textos])),
+               ('original + positions', True, lambda: [posiciones(regex_tokenize(t)) for t in textos]),
+               ('term ids + positions', False, vocabulario_nuevo(lambda ids: [posiciones(ids(t)) for t in textos])))
+    tiempos = [None] * len(metodos)
+    for _ in range(args.repeat):
+        for i, (_, _, fnc) in enumerate(metodos):
+            t = best_time(fnc, 1)
+            tiempos[i] = t if tiempos[i] is None else min(tiempos[i], t)
+
+    print("%d articles, %d tokens" % (len(textos), ntokens))
+    print("%-32s %12s %12s" % ('method', 'Mtokens/s', 'vs original'))
+    for (nombre, original, _), t in zip(metodos, tiempos):
+        if original:
+            referencia = t
+        print("%-32s %12.3f %11.2fx" % (nombre, ntokens / t / 1e6, referencia / t))
+
+
+def bench_intersection(args):
+    """
+    Compara la mezcla lineal original con la interseccion adaptativa de and_posting
+    (galloping sobre listas y punteros de salto sobre posting lists comprimidas)
+    para parejas de terminos raros y frecuentes, y el AND de varios terminos
+    evaluado de izquierda a derecha frente a and_postings (de la mas corta a la mas larga).
+
+    """
+    indexer = build_index(args)
+    indice = indexer.index['article']
+    nnews = len(indexer.news)
+    rnd = random.Random(0)
+    raros = sorted(w for w, p in indice.items() if 5 <= len(p) <= 50)
+    frecuentes = sorted(w for w, p in indice.items() if len(p) >= nnews // 4)
+    parejas = [(rnd.choice(raros), rnd.choice(frecuentes)) for _ in range(args.pairs)]
+    comprimido = {w: CompressedPosting.from_list(indice[w]) for par in parejas for w in par}
+
+    def lineal():
+        for a, b in parejas:
+            linear_and(indice[a], indice[b])
+
+    def adaptativo():
+        for a, b in parejas:
+            indexer.and_posting(indice[a], indice[b])
+
+    def adaptativo_z():
+        for a, b in parejas:
+            indexer.and_posting(comprimido[a], comprimido[b])
+
+    print("%d pairs rare (df 5-50) AND frequent (df >= %d)" % (len(parejas), nnews // 4))
+    print("%-32s %10s" % ('method', 'ms/query'))
+    for nombre, fnc in (('linear merge (lists)', lineal),
+                        ('adaptive (lists)', adaptativo),
+                        ('adaptive (compressed + skips)', adaptativo_z)):
+        print("%-32s %10.4f" % (nombre, best_time(fnc, args.repeat) / len(parejas) * 1000))
+
+    # AND de varios terminos: frecuentes primero, como aparecerian en una consulta
+    consultas = [rnd.sample(frecuentes, 3) + [rnd.choice(raros)] for _ in range(args.pairs)]
+
+    def izquierda_derecha():
+        for terms in consultas:
+            res = indice[terms[0]]
+            for w in terms[1:]:
+                res = linear_and(res, indice[w])
+
+    def mas_corta_primero():
+        for terms in consultas:
+            indexer.and_postings([indice[w] for w in terms])
+
+    print()
+    print("%d queries of 3 frequent terms AND 1 rare term" % len(consultas))
+    print("%-32s %10s" % ('method', 'ms/query'))
+    for nombre, fnc in (('left to right, linear merge', izquierda_derecha),
+                        ('and_postings, shortest first', mas_corta_primero)):
+        print("%-32s %10.4f" % (nombre, best_time(fnc, args.repeat) / len(consultas) * 1000))
+
+
+def bench_common(args):
+    """
+    Compara el indice normal con el que guarda como Bitmap las posting lists de los
+    terminos frecuentes (--common-terms): tamaño de las posting lists y tiempo de
+    queries booleanas y frases con esos terminos.
+
+    """
+    normal = build_index(args, positional=True)
+    bitmaps = build_index(args, positional=True, common_terms=0.25)
+    for indexer in (normal, bitmaps):
+        indexer.set_cache(0, 0)
+    indice = normal.index['article']
+    vocab = normal.vocab
+    nnews = len(normal.news)
+    rnd = random.Random(0)
+    frecuentes = sorted(vocab[t] for t, p in indice.items() if len(p) >= nnews // 4)
+    raros = sorted(vocab[t] for t, p in indice.items() if 5 <= len(p) <= 50)
+
+    tipos = [
+        ('frequent AND frequent', lambda: '%s AND %s' % tuple(rnd.sample(frecuentes, 2))),
+        ('3 frequent AND rare', lambda: '%s AND %s AND %s AND %s' % tuple(rnd.sample(frecuentes, 3) + [rnd.choice(raros)])),
+        ('frequent OR frequent', lambda: '%s OR %s' % tuple(rnd.sample(frecuentes, 2))),
+        ('rare AND NOT frequent', lambda: '%s AND NOT %s' % (rnd.choice(raros), rnd.choice(frecuentes))),
+        ('NOT frequent', lambda: 'NOT %s' % rnd.choice(frecuentes)),
+        ('phrase of frequent', lambda: '"%s %s"' % tuple(rnd.sample(frecuentes, 2))),
+    ]
+
+    print("%d terms stored as bitmaps (df >= %d)" % (bitmaps.bitmaps.get('article', 0), math.ceil(0.25 * nnews)))
+    for nombre, indexer in (('lists', normal), ('bitmaps', bitmaps)):
+        memoria = sum(posting_nbytes(p) for p in indexer.index['article'].values())
+        print("%-10s postings: %8.2f MB in memory, %8.2f MB serialized" % (
+            nombre, memoria / 2**20, len(pickle.dumps(indexer.index, pickle.HIGHEST_PROTOCOL)) / 2**20))
+    print()
+    print("%-24s %12s %12s" % ('query', 'lists(ms)', 'bitmaps(ms)'))
+    for nombre, generar in tipos:
+        consultas = [generar() for _ in range(args.pairs)]
+        for q in consultas[:20]:
+            assert list(normal.solve_query(q)) == list(bitmaps.solve_query(q)), q
+        tiempos = [best_time(lambda: [indexer.solve_query(q) for q in consultas], args.repeat)
+                   for indexer in (normal, bitmaps)]
+        print("%-24s %12.4f %12.4f" % (nombre, tiempos[0] / len(consultas) * 1000, tiempos[1] / len(consultas) * 1000))
+
+
+def linear_permuterm(ptindex, term):
+    """
+    Terminos que encajan con un comodin recorriendo todas las rotaciones, como
+    hacia el get_permuterm original, como referencia.
+    """
+    comodin = "*" if "*" in term else "?"
+    i = term.index(comodin)
+    ini = term[:i]
+    fin = term[i + 1:]
+    res = []
+    for permuterms, w in ptindex:
+        pterms = permuterms.split("$")
+        if pterms[0].endswith(fin) and pterms[1].startswith(ini):
+            if comodin == "*" or len(w) == len(term):
+                res.append(w)
+    return res
+
+
+def bench_permuterm(args):
+    """
+    Compara el recorrido lineal de todas las rotaciones del indice permuterm con la
+    busqueda de un rango en las rotaciones ordenadas, para comodines 'ini*', '*fin',
+    'ini*fin' y 'in?cio' generados a partir de terminos del vocabulario. Para terminos
+    con varios comodines compara el recorrido del vocabulario con el indice de k-gramas.
+
+    """
+    indexer = build_index(args, permuterm=True)
+    indice = indexer.index['article']
+    rnd = random.Random(0)
+    vocab = indexer.vocab
+    vocabulario = sorted(vocab[t] for t in indice if len(vocab[t]) >= 5 and vocab[t].isalpha())
+    patrones = []
+    for _ in range(args.pairs // 4):
+        w = rnd.choice(vocabulario)
+        k = rnd.randrange(1, len(w) - 1)
+        patrones += [w[:3] + '*', '*' + w[-3:], w[:2] + '*' + w[-2:], w[:k] + '?' + w[k + 1:]]
+    rotaciones = [(p, vocab[t]) for p, t in indexer.ptindex.items()]
+
+    for term in patrones[:20]:
+        assert sorted(set(linear_permuterm(rotaciones, term))) == sorted(vocab[t] for t in indexer.permuterm_terms(term)), term
+
+    print("%d wildcard terms, %d rotations" % (len(patrones), len(rotaciones)))
+    print("%-32s %10s" % ('method', 'ms/term'))
+    t = best_time(lambda: [linear_permuterm(rotaciones, term) for term in patrones], 1)
+    print("%-32s %10.4f" % ('linear scan', t / len(patrones) * 1000))
+    t = best_time(lambda: [indexer.permuterm_terms(term) for term in patrones], args.repeat)
+    print("%-32s %10.4f" % ('sorted rotations, range lookup', t / len(patrones) * 1000))
+
+    # varios comodines: recorrido del vocabulario con la expresion regular frente al indice de k-gramas
+    multiples = []
+    for _ in range(args.pairs // 4):
+        w = rnd.choice(vocabulario)
+        k = rnd.randrange(1, len(w) - 2)
+        multiples += [w[:2] + '*' + w[k:k + 2] + '*', '*' + w[1:3] + '?' + w[4:]]
+    vocabulario = [vocab[t] for t in indice]
+
+    def regex_scan(term):
+        patron = indexer.wildcard_regex(term)
+        return [w for w in vocabulario if patron.fullmatch(w)]
+
+    for term in multiples[:20]:
+        assert sorted(regex_scan(term)) == sorted(vocab[t] for t in indexer.kgram_terms(term)), term
+
+    print()
+    print("%d terms with several wildcards, %d %d-grams" % (len(multiples), len(indexer.kgindex), indexer.KGRAM))
+    print("%-32s %10s" % ('method', 'ms/term'))
+    t = best_time(lambda: [regex_scan(term) for term in multiples], 1)
+    print("%-32s %10.4f" % ('regex scan of the vocabulary', t / len(multiples) * 1000))
+    t = best_time(lambda: [indexer.kgram_terms(term) for term in multiples], args.repeat)
+    print("%-32s %10.4f" % ('k-gram index', t / len(multiples) * 1000))
+
+
+def bench_stemming(args):
+    """
+    Compara la posting list de un stem calculada como en el get_stemming original
+    (stem del termino y OR sucesivo de las posting lists de cada uno de sus terminos)
+    con la memoria de stems y las posting lists precalculadas (--stem-postings).
+
+    """
+    indexer = build_index(args, stem=True, stem_postings=True)
+    indice = indexer.index['article']
+    rnd = random.Random(0)
+    productivos = sorted(s for s, words in indexer.sindex.items() if len(words) >= 5)
+    terminos = [indexer.vocab[rnd.choice(indexer.sindex[rnd.choice(productivos)])] for _ in range(args.pairs)]
+
+    def original():
+        for term in terminos:
+            res = []
+            for w in indexer.sindex[indexer.stemmer.stem(term)]:
+                res = indexer.or_posting(res, indice[w])
+
+    def precalculado():
+        for term in terminos:
+            indexer.spindex['article'][indexer.stem(term)]
+
+    print("%d terms of stems with 5 or more terms" % len(terminos))
+    print("%-32s %10s" % ('method', 'ms/term'))
+    for nombre, fnc in (('stemmer + sequential OR', original),
+                        ('memoised stem + stem postings', precalculado)):
+        print("%-32s %10.4f" % (nombre, best_time(fnc, args.repeat) / len(terminos) * 1000))
+
+
+def bench_dates(args):
+    """
+    Compara el filtrado de los resultados de un termino por un rango de fechas leyendo
+    la fecha de cada noticia del almacen de documentos con el AND con el operador
+    'date:ini..fin' (indice de fechas).
+
+    """
+    indexer = build_index(args)
+    indice = indexer.index['article']
+    rnd = random.Random(0)
+    fechas = list(indexer.dindex.keys())
+    frecuentes = sorted(w for w, p in indice.items() if len(p) >= len(indexer.news) // 10)
+    consultas = []
+    for _ in range(args.pairs):
+        i = rnd.randrange(len(fechas))
+        j = rnd.randrange(i, min(len(fechas), i + 60))
+        consultas.append((rnd.choice(frecuentes), fechas[i], fechas[j]))
+
+    def post_filtrado():
+        for w, ini, fin in consultas:
+            [n for n in indice[w] if ini <= indexer.get_record(n)['date'] <= fin]
+
+    def operador():
+        for w, ini, fin in consultas:
+            indexer.and_posting(indice[w], indexer.get_dates(ini + '..' + fin))
+
+    for w, ini, fin in consultas[:20]:
+        assert [n for n in indice[w] if ini <= indexer.get_record(n)['date'] <= fin] == \
+            list(indexer.and_posting(indice[w], indexer.get_dates(ini + '..' + fin)))
+
+    print("%d queries of a frequent term in a range of up to 60 days" % len(consultas))
+    print("%-32s %10s" % ('method', 'ms/query'))
+    for nombre, fnc in (('filter with the stored dates', post_filtrado),
+                        ('AND with date:ini..fin', operador)):
+        print("%-32s %10.4f" % (nombre, best_time(fnc, args.repeat) / len(consultas) * 1000))
+
+
+def linear_phrase(posindex, terms):
+    """
+    Frase con el get_positionals original (comprobacion de cada posicion con 'in'
+    sobre listas y resultados sin repetidos con 'not in'), como referencia. Los
+    terminos son term id.
+    """
+    docs = []
+    res = []
+    for t in terms:
+        if t not in posindex:
+            return []
+        docs.append(sorted(posindex[t].keys()))
+    prev = docs[0]
+    for d in docs[1:]:
+        prev = linear_and(prev, d)
+    for d in prev:
+        posis = [posindex[w][d] for w in terms]
+        for i in posis[0]:
+            start = 1
+            n = i
+            while start <= len(posis):
+                if start == len(posis):
+                    if d not in res:
+                        res.append(d)
+                    break
+                elif n + 1 in posis[start]:
+                    start += 1
+                    n += 1
+                else:
+                    break
+    return res
+
+
+def bench_phrases(args):
+    """
+    Compara el get_positionals original con la mezcla lineal de las listas de posiciones
+    para frases de dos y tres palabras frecuentes (p.e. "de la", "en el marco de")
+    tomadas de los propios articulos, y mide el operador NEAR/k sobre las mismas palabras.
+
+    """
+    indexer = build_index(args, positional=True)
+    posindex = indexer.posindex['article']
+    rnd = random.Random(0)
+    nnews = len(indexer.news)
+    frecuentes = {indexer.vocab[t] for t, p in indexer.index['article'].items() if len(p) >= nnews // 4}
+    frases = set()
+    for n in range(nnews):
+        tokens = indexer.tokenize(indexer.get_record(n)['article'])
+        for j in range(len(tokens) - 2):
+            if tokens[j] in frecuentes and tokens[j + 1] in frecuentes:
+                frases.add(tuple(tokens[j:j + 2 + (tokens[j + 2] in frecuentes)]))
+    frases = rnd.sample(sorted(frases), min(args.pairs, len(frases)))
+    ids = {terms: [indexer.terms[w] for w in terms] for terms in frases}
+
+    for terms in frases[:20]:
+        assert linear_phrase(posindex, ids[terms]) == indexer.get_positionals(list(terms)), terms
+
+    print("%d phrases of frequent words (df >= %d)" % (len(frases), nnews // 4))
+    print("%-32s %10s" % ('method', 'ms/query'))
+    t = best_time(lambda: [linear_phrase(posindex, ids[terms]) for terms in frases], 1)
+    print("%-32s %10.4f" % ('original nested loops', t / len(frases) * 1000))
+    t = best_time(lambda: [indexer.get_positionals(list(terms)) for terms in frases], args.repeat)
+    print("%-32s %10.4f" % ('linear merge of positions', t / len(frases) * 1000))
+    t = best_time(lambda: [indexer.get_near(('term', 'article', terms[0]), ('term', 'article', terms[-1]), 5)
+                           for terms in frases], args.repeat)
+    print("%-32s %10.4f" % ('NEAR/5 of first and last word', t / len(frases) * 1000))
+
+
+def bench_topk(args):
+    """
+    Compara ordenar todo el resultado (rank_result sin k) con obtener solo las SHOW_MAX
+    mejores noticias con MaxScore (top_k) en queries OR de varios terminos, de
+    frecuencias variadas, con resultados de tamaño creciente, con las dos funciones de
+    ranking. La ultima columna es rank_result con k, que elige entre las dos segun
+    TOPK_RESULT y TOPK_MIN: deberia ir siempre con la mas rapida.
+
+    """
+    indexer = build_index(args, rank=True)
+    indice = indexer.index['article']
+    rnd = random.Random(0)
+    nnews = len(indexer.news)
+    vocabulario = sorted(indexer.vocab[t] for t, p in indice.items() if len(p) >= 2)
+    frecuentes = sorted(indexer.vocab[t] for t, p in indice.items() if len(p) >= nnews // 4)
+    k = indexer.SHOW_MAX
+
+    print("%-6s %6s %9s %9s %10s %10s %10s" % ('model', 'terms', 'results', 'postings',
+                                               'full(ms)', 'top-%d(ms)' % k, 'auto(ms)'))
+    for model in ('bm25', 'tfidf'):
+        indexer.set_ranking(True, model)
+        for nterms in (2, 4, 8, 16):
+            consultas = []
+            for _ in range(max(1, args.pairs // 10)):
+                ws = rnd.sample(frecuentes, nterms // 2) + rnd.sample(vocabulario, nterms - nterms // 2)
+                consultas.append(' OR '.join(ws))
+            resultados = [indexer.solve_query(q) for q in consultas]
+            for q, r in zip(consultas[:5], resultados):
+                assert [n for n, _ in indexer.rank_result(r, q)[:k]] == [n for n, _ in indexer.top_k(r, q, k)], q
+
+            completo = best_time(lambda: [indexer.rank_result(r, q) for q, r in zip(consultas, resultados)], args.repeat)
+            mejores = best_time(lambda: [indexer.top_k(r, q, k) for q, r in zip(consultas, resultados)], args.repeat)
+            auto = best_time(lambda: [indexer.rank_result(r, q, k) for q, r in zip(consultas, resultados)], args.repeat)
+            media = sum(len(r) for r in resultados) / len(resultados)
+            postings = sum(len(indice[indexer.terms[w]]) for q in consultas for w in q.split(' OR ')) / len(consultas)
+            print("%-6s %6d %9.0f %9.0f %10.4f %10.4f %10.4f" % (
+                model, nterms, media, postings, completo / len(consultas) * 1000,
+                mejores / len(consultas) * 1000, auto / len(consultas) * 1000))
+
+
+def bench_streaming(args):
+    """
+    Compara cargar un fichero de noticias entero con json.load con leerlo noticia a
+    noticia (read_file), en formato JSON Arrays y JSON Lines: tiempo y pico de memoria
+    reservada durante la lectura (medida con tracemalloc). El fichero se construye
+    repitiendo las noticias de la coleccion y crece con cada paso.
+
+    """
+    lector = SAR_Project()
+    noticias = [new for filename in lector.news_files(args.newsdir) for new in lector.read_file(filename)]
+
+    print("%-6s %8s %10s %12s %12s %12s %12s" % ('format', 'news', 'size(MB)', 'load(s)', 'stream(s)',
+                                                  'load(MB)', 'stream(MB)'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for k in range(1, args.steps + 1):
+            copia = noticias * (2 ** k)
+            for formato in ('json', 'jsonl'):
+                filename = os.path.join(tmp, 'news.' + formato)
+                with open(filename, 'w') as fh:
+                    if formato == 'json':
+                        json.dump(copia, fh)
+                    else:
+                        fh.writelines(json.dumps(new) + '\n' for new in copia)
+
+                def cargar():
+                    with open(filename) as fh:
+                        if formato == 'json':
+                            return len(json.load(fh))
+                        return len([json.loads(linea) for linea in fh])
+
+                def recorrer():
+                    return sum(1 for _ in lector.read_file(filename))
+
+                assert cargar() == recorrer() == len(copia)
+                picos = []
+                for fnc in (cargar, recorrer):
+                    tracemalloc.start()
+                    fnc()
+                    picos.append(tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+                print("%-6s %8d %10.1f %12.3f %12.3f %12.1f %12.1f" % (
+                    formato, len(copia), os.path.getsize(filename) / 2**20,
+                    best_time(cargar, args.repeat), best_time(recorrer, args.repeat),
+                    picos[0] / 2**20, picos[1] / 2**20))
+
+
+def bench_numpy(args):
+    """
+    Compara las mezclas en python de and_posting, or_posting, minus_posting y or_postings
+    con las mismas operaciones con NumPy (np_and, np_or, np_minus), incluida la conversion
+    de las listas a arrays y del resultado a lista, sobre posting lists aleatorias de
+    longitud creciente (con un newid de cada cuatro). Para cada operacion indica la
+    longitud a partir de la que NumPy es siempre mas rapido, con la que comparar su umbral
+    en NUMPY_MIN.
+
+    """
+    if numpy is None:
+        print("NumPy is not installed")
+        return
+    indexer = SAR_Project()
+    indexer.set_numpy(False)
+    rnd = random.Random(0)
+    operaciones = (('and', lambda ps: indexer.and_posting(*ps), np_and),
+                   ('or', lambda ps: indexer.or_posting(*ps), np_or),
+                   ('minus', lambda ps: indexer.minus_posting(*ps), lambda ps: np_minus(*ps)),
+                   ('or of 4', indexer.or_postings, np_or))
+    umbrales = {'and': NUMPY_MIN['and'], 'or': NUMPY_MIN['or'], 'minus': NUMPY_MIN['minus'],
+                'or of 4': NUMPY_MIN['or of k'] // 4}
+    cruce = {}
+
+    print("%-8s %8s %12s %12s %8s" % ('op', 'length', 'python(ms)', 'numpy(ms)', 'speedup'))
+    for n in (64, 256, 512, 1024, 2048, 4096, 16384, 65536, 262144):
+        listas = [sorted(rnd.sample(range(4 * n), n)) for _ in range(4)]
+        for nombre, python, vectorial in operaciones:
+            postings = listas if nombre == 'or of 4' else listas[:2]
+            assert list(python(postings)) == vectorial(postings)
+            t_python = best_time(lambda: python(postings), args.repeat)
+            t_numpy = best_time(lambda: vectorial(postings), args.repeat)
+            if t_numpy >= t_python:
+                cruce[nombre] = None
+            elif cruce.get(nombre) is None:
+                cruce[nombre] = n
+            print("%-8s %8d %12.3f %12.3f %8.2f" % (nombre, n, t_python * 1000, t_numpy * 1000,
+                                                    t_python / t_numpy))
+
+    print()
+    print("%-8s %10s %10s" % ('op', 'crossover', 'NUMPY_MIN'))
+    for nombre, _, _ in operaciones:
+        print("%-8s %10s %10d" % (nombre, cruce[nombre] or '-', umbrales[nombre]))
+
+
+BENCHMARKS = {
+    'common': bench_common,
+    'dates': bench_dates,
+    'indexing': bench_indexing,
+    'intersection': bench_intersection,
+    'numpy': bench_numpy,
+    'permuterm': bench_permuterm,
+    'phrases': bench_phrases,
+    'tokenizer': bench_tokenizer,
+    'topk': bench_topk,
+    'stemming': bench_stemming,
+    'streaming': bench_streaming,
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the indexer and the searcher.')
+    parser.add_argument('newsdir', metavar='newsdir', type=str,
+                        help='directory with the news.')
+
+    parser.add_argument('-B', '--bench', dest='bench', choices=sorted(BENCHMARKS), action='append',
+                    help='benchmark to run, can be repeated (default: all).')
+
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                    help='repetitions of each measure, the best one is reported (default: 3).')
+
+    parser.add_argument('-s', '--steps', dest='steps', type=int, default=4,
+                    help='number of corpus sizes measured (default: 4).')
+
+    parser.add_argument('-p', '--pairs', dest='pairs', type=int, default=200,
+                    help='number of random queries of the query benchmarks (default: 200).')
+
+    parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False,
+                    help='build the positional index too.')
+
+    parser.add_argument('-M', '--multifield', dest='multifield', action='store_true', default=False,
+                    help='index all the fields of the news in the indexing benchmark.')
+
+    parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False,
+                    help='store the ranking weights in the indexing benchmark.')
+
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=4,
+                    help='number of processes compared with a single one in the indexing benchmark (default: 4).')
+
+    args = parser.parse_args()
+
+    for name in args.bench or sorted(BENCHMARKS):
+        print("== %s ==" % name)
+        BENCHMARKS[name](args)
+        print()
@@ -1,23 +1,41 @@
 import argparse
+import os
 import pickle
 import sys
 import time
 
-from SAR_lib import SAR_Project
+from SAR_lib import SAR_Project, SEGMENT_MAGIC, peak_memory
+from SAR_update import merge_in_background, merge_plan, merge_segments, read_manifest, remove_segments, update_index
+
+
+def ratio(text):
+    """
+    Tipo de argparse para --common-terms: una fraccion de las noticias, 0 < RATIO <= 1.
+    """
+    try:
+        valor = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid ratio: '%s'" % text)
+    if not 0 < valor <= 1:
+        raise argparse.ArgumentTypeError("the ratio must be greater than 0 and at most 1, got %s" % text)
+    return valor
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Index a directory with news in json format.')
-    parser.add_argument('newsdir', metavar='newsdir', type=str,
+    parser.add_argument('newsdir', metavar='newsdir', type=str, nargs='?',
                         help='directory with the news.')
 
-    parser.add_argument('index', metavar='index', type=str,
+    parser.add_argument('index', metavar='index', type=str, nargs='?',
                         help='name of the file to save the project object.')
 
     parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False, 
                     help='compute stem index.')
 
+    parser.add_argument('--stem-postings', dest='stem_postings', action='store_true', default=False,
+                    help='precompute the posting list of every stem, requires -S.')
+
     parser.add_argument('-P', '--permuterm', dest='permuterm', action='store_true', default=False,
                     help='compute permuterm index.')
 
@@ -27,19 +45,89 @@ if __name__ == "__main__":
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False, 
                     help='compute positional index.')
 
+    parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False,
+                    help='store the term frequencies and precompute the weights needed to rank the results (searcher -R).')
+
+    parser.add_argument('-Z', '--compress', dest='compress', action='store_true', default=False,
+                    help='compress the posting lists (delta + variable-byte).')
+
+    parser.add_argument('--common-terms', dest='common_terms', metavar='RATIO', type=ratio, default=0,
+                    help='store the posting lists of the terms that appear in at least RATIO (0 < RATIO <= 1, e.g. 0.25) of the news as bitmaps.')
+
+    parser.add_argument('-F', '--format', dest='format', choices=['pickle', 'segment'], default='pickle',
+                    help='format of the index file: the whole pickled object or a segment that the searcher maps with mmap (default: pickle).')
+
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=1,
+                    help='maximum number of processes used to index the news, never more than the available CPUs; small collections are indexed in a single process (default: 1).')
+
+    parser.add_argument('-U', '--update', dest='update', action='store_true', default=False,
+                    help='index only the new or changed files of newsdir into a new segment of an existing segment index; the segments are merged in the background.')
+
+    parser.add_argument('--merge', dest='merge', metavar='INDEX', type=str, default=None,
+                    help='merge all the segments of the index INDEX created with --update and exit (newsdir and index are not needed).')
+
     args = parser.parse_args()
 
     newsdir = args.newsdir
     indexfile = args.index
 
+    if args.merge is not None:
+        if not os.path.exists(args.merge):
+            parser.error("index '%s' not found" % args.merge)
+        t0 = time.time()
+        fusionados = merge_segments(args.merge, todos=True)
+        print("Merged segments: %d." % len(fusionados))
+        print("Time merging: %2.2fs." % (time.time() - t0))
+        sys.exit(0)
+
+    if newsdir is None or indexfile is None:
+        parser.error('the following arguments are required: newsdir, index')
+
+    if args.update and os.path.exists(indexfile + '.manifest'):
+        incremental = True
+    elif args.update and os.path.exists(indexfile):
+        with open(indexfile, 'rb') as fh:
+            if fh.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+                parser.error('--update requires an index created with -F segment')
+        incremental = True
+    else:
+        incremental = False
+
+    if incremental:
+        t0 = time.time()
+        cambios = update_index(newsdir, indexfile, args.workers)
+        t1 = time.time()
+        print("New files: %d, changed: %d, removed: %d." % (len(cambios['new']), len(cambios['changed']), len(cambios['removed'])))
+        if cambios['segment'] is not None:
+            print("New segment: %s." % cambios['segment'])
+        print("Segments: %d." % cambios['segments'])
+        print("Time updating: %2.2fs." % (t1 - t0))
+        if peak_memory() is not None:
+            print("Peak memory: %2.2fMB." % (peak_memory() / 2**20))
+        if merge_plan(read_manifest(indexfile)):
+            merge_in_background(indexfile)
+            print("Merging segments in the background.")
+        sys.exit(0)
+    if args.update:
+        # no hay indice previo: se crea completo, como segmento para poder actualizarlo
+        args.format = 'segment'
+
     indexer = SAR_Project()
     t0 = time.time()
     indexer.index_dir(newsdir, **vars(args))
     t1 = time.time()
-    with open(indexfile, 'wb') as fh:
+    if args.format == 'segment':
+        indexer.save_segment(indexfile)
+    else:
+        with open(indexfile, 'wb') as fh:
             pickle.dump(indexer, fh)
+    # el indice se ha creado de nuevo completo: los segmentos de actualizaciones anteriores ya no valen
+    remove_segments(indexfile)
     t2 = time.time()
     indexer.show_stats()
     print("Time indexing: %2.2fs." % (t1 - t0))
     print("Time saving: %2.2fs." % (t2 - t1))
+    print("Index size: %2.2fMB." % (os.path.getsize(indexfile) / 2**20))
+    if peak_memory() is not None:
+        print("Peak memory: %2.2fMB." % (peak_memory() / 2**20))
     print()
\ No newline at end of file
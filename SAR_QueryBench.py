@@ -0,0 +1,409 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import time
+import traceback
+
+from SAR_Indexer import ratio
+from SAR_lib import SAR_Project, load_index, peak_memory
+
+
+# metricas que se comparan con --baseline: nombre --> True si un valor mayor es mejor
+METRICS = {'news_per_s': True, 'index_size': False, 'index_memory': False, 'search_memory': False}
+
+# percentiles de latencia que se calculan; con --baseline solo se comparan los de --gate
+PERCENTILES = (50, 95, 99)
+
+# muestras que tienen que quedar por encima de un percentil para poder compararlo:
+# con menos, el p95 o el p99 es practicamente la muestra mas lenta y solo mide ruido
+MIN_TAIL_SAMPLES = 5
+
+
+def read_test(filename):
+    """
+    Lee un fichero de queries en el formato de la opcion -T de SAR_Searcher: una query
+    y el numero de resultados esperado separados por un tabulador, las lineas vacias
+    o que empiezan por '#' se ignoran.
+
+    return: lista de tuplas (query, numero de resultados)
+
+    """
+    queries = []
+    with open(filename, encoding='utf-8') as fh:
+        for line in fh.read().split('\n'):
+            if len(line) > 0 and not line.startswith('#'):
+                query, reference = line.split('\t')
+                queries.append((query, int(reference)))
+    return queries
+
+
+def percentile(valores, p):
+    """
+    Percentil "p" (0-100) de una lista de valores, por el metodo del rango mas cercano.
+    """
+    valores = sorted(valores)
+    return valores[max(0, math.ceil(p / 100 * len(valores)) - 1)]
+
+
+def latency(muestras):
+    """
+    Resumen de una lista de latencias en milisegundos: numero de muestras y percentiles.
+    """
+    res = {'n': len(muestras)}
+    for p in PERCENTILES:
+        res['p%d' % p] = percentile(muestras, p)
+    return res
+
+
+def query_operators(searcher, query):
+    """
+    Operadores que aparecen en una query, a partir de su arbol (SAR_Project.parse_query):
+    'and', 'or', 'not', 'near', 'phrase', 'wildcard', 'date' y 'field' (un campo distinto
+    de article). Una query con un unico termino simple es 'term'.
+
+    return: lista ordenada con los operadores
+
+    """
+    operadores = set()
+    pendientes = [searcher.parse_query(query)]
+    while pendientes:
+        nodo = pendientes.pop()
+        tipo = nodo[0]
+        if tipo == 'term':
+            field, term = nodo[1], nodo[2]
+            if term.startswith('"'):
+                operadores.add('phrase')
+            elif '*' in term or '?' in term:
+                operadores.add('wildcard')
+            if field == 'date':
+                operadores.add('date')
+            elif field != 'article':
+                operadores.add('field')
+        elif tipo == 'near':
+            operadores.add('near')
+            pendientes.extend(nodo[2:])
+        elif tipo == 'not':
+            operadores.add('not')
+            pendientes.append(nodo[1])
+        else:
+            operadores.add(tipo)
+            pendientes.extend(nodo[1])
+    return sorted(operadores) or ['term']
+
+
+def run_child(fnc, *args):
+    """
+    Ejecuta fnc(*args) en un proceso hijo y devuelve su resultado, de forma que el pico
+    de memoria (peak_memory) medido dentro de "fnc" es el de esa fase y no el de todo el
+    benchmark. No se usa un Pool porque sus procesos no pueden crear otros (SAR_Indexer -W).
+    """
+    cola = multiprocessing.Queue()
+    proceso = multiprocessing.Process(target=_child, args=(cola, fnc, args))
+    proceso.start()
+    ok, res = cola.get()
+    proceso.join()
+    if not ok:
+        raise RuntimeError('error in the child process:\n' + res)
+    return res
+
+
+def _child(cola, fnc, args):
+    try:
+        cola.put((True, fnc(*args)))
+    except BaseException:
+        cola.put((False, traceback.format_exc()))
+
+
+def index_phase(newsdir, indexfile, flags):
+    """
+    Indexa "newsdir" con las opciones de SAR_Indexer "flags" y guarda el indice en "indexfile".
+
+    return: diccionario con el numero de noticias, el tiempo de indexacion y el de guardado,
+            el tamaño del indice y el pico de memoria
+
+    """
+    indexer = SAR_Project()
+    t0 = time.perf_counter()
+    indexer.index_dir(newsdir, **flags)
+    t1 = time.perf_counter()
+    if flags['format'] == 'segment':
+        indexer.save_segment(indexfile)
+    else:
+        with open(indexfile, 'wb') as fh:
+            pickle.dump(indexer, fh)
+    t2 = time.perf_counter()
+    return {'news': len(indexer.news), 'index_time': t1 - t0, 'save_time': t2 - t1,
+            'index_size': os.path.getsize(indexfile), 'index_memory': peak_memory()}
+
+
+def search_phase(indexfile, queries, repeat, warmup, stem, rank_model=None):
+    """
+    Carga el indice y resuelve las queries: una primera vez para comprobar el numero de
+    resultados (como SAR_Searcher -T), otras "warmup" veces sin medir (para que las
+    paginas del indice y las caches del interprete esten ya cargadas) y despues
+    "repeat" veces midiendo cada una. La cache de resultados se desactiva para medir
+    siempre la evaluacion completa.
+
+    Si "rank_model" no es None (el indice se ha creado con -R) tambien se mide, aparte,
+    el ranking de cada resultado con esa funcion, como en SAR_Searcher -R sin -A (solo
+    las SHOW_MAX mejores noticias).
+
+    return: diccionario con el tiempo de carga, el pico de memoria, los errores y, por
+            query, sus operadores y sus latencias en milisegundos (y las del ranking)
+
+    """
+    t0 = time.perf_counter()
+    searcher = load_index(indexfile)
+    t1 = time.perf_counter()
+    searcher.set_cache(0, 0)
+    searcher.set_stemming(stem)
+    if rank_model is not None:
+        searcher.set_ranking(True, rank_model)
+
+    errores = []
+    for query, reference in queries:
+        result = len(searcher.solve_query(query))
+        if result != reference:
+            errores.append({'query': query, 'results': result, 'reference': reference})
+    k = searcher.SHOW_MAX
+    for _ in range(warmup):
+        for query, _ in queries:
+            result = searcher.solve_query(query)
+            if rank_model is not None:
+                searcher.rank_result(result, query, k)
+
+    muestras = [[] for _ in queries]
+    ranking = [[] for _ in queries]
+    for _ in range(repeat):
+        for i, (query, _) in enumerate(queries):
+            t = time.perf_counter()
+            result = searcher.solve_query(query)
+            muestras[i].append((time.perf_counter() - t) * 1000)
+            if rank_model is not None:
+                t = time.perf_counter()
+                searcher.rank_result(result, query, k)
+                ranking[i].append((time.perf_counter() - t) * 1000)
+
+    res = {'load_time': t1 - t0, 'search_memory': peak_memory(), 'errors': errores, 'queries': []}
+    for (query, _), ms, rank_ms in zip(queries, muestras, ranking):
+        q = {'query': query, 'operators': query_operators(searcher, query), 'ms': ms}
+        if rank_model is not None:
+            q['rank_ms'] = rank_ms
+        res['queries'].append(q)
+    return res
+
+
+def bench_corpus(newsdir, testfile, flags, args):
+    """
+    Indexa un corpus y resuelve sus queries, cada fase en su propio proceso.
+
+    return: diccionario con los resultados del corpus, listo para guardar como JSON
+
+    """
+    queries = read_test(testfile)
+    entrada = sum(os.path.getsize(f) for f in SAR_Project().news_files(newsdir))
+    with tempfile.TemporaryDirectory() as tmp:
+        indexfile = os.path.join(tmp, 'index.bin')
+        res = run_child(index_phase, newsdir, indexfile, flags)
+        res.update(run_child(search_phase, indexfile, queries, args.repeat, args.warmup, args.stem_queries,
+                             args.rank_model if flags['rank'] else None))
+
+    res['newsdir'] = newsdir
+    res['test'] = testfile
+    res['input_size'] = entrada
+    res['news_per_s'] = res['news'] / res['index_time']
+    res['mb_per_s'] = entrada / 2**20 / res['index_time']
+
+    # latencias de cada query y agrupadas por operador (una query cuenta en todos los suyos);
+    # el ranking de los resultados (-R) es un grupo aparte, no se suma a la evaluacion
+    grupos = {'all': []}
+    for q in res['queries']:
+        for op in ['all'] + q['operators']:
+            grupos.setdefault(op, []).extend(q['ms'])
+        q['latency'] = latency(q.pop('ms'))
+        if 'rank_ms' in q:
+            grupos.setdefault('ranking', []).extend(q['rank_ms'])
+            q['rank_latency'] = latency(q.pop('rank_ms'))
+    res['latency'] = {op: latency(ms) for op, ms in sorted(grupos.items())}
+    return res
+
+
+def show_corpus(nombre, res, lentas):
+    """
+    Muestra los resultados de un corpus: indexacion, memoria, latencias por operador
+    y las "lentas" queries con mayor mediana.
+    """
+    mb = lambda n: '-' if n is None else '%.2fMB' % (n / 2**20)
+    print("== %s ==" % nombre)
+    print("News: %d, indexing: %.2fs (%.1f news/s, %.2fMB/s), saving: %.2fs, loading: %.2fs." % (
+        res['news'], res['index_time'], res['news_per_s'], res['mb_per_s'], res['save_time'], res['load_time']))
+    print("Index size: %s, peak memory: %s indexing, %s searching." % (
+        mb(res['index_size']), mb(res['index_memory']), mb(res['search_memory'])))
+    print()
+    print("%-10s %8s %10s %10s %10s" % ('operator', 'queries', 'p50(ms)', 'p95(ms)', 'p99(ms)'))
+    for op, lat in res['latency'].items():
+        nq = len(res['queries']) if op in ('all', 'ranking') else sum(op in q['operators'] for q in res['queries'])
+        print("%-10s %8d %10.3f %10.3f %10.3f" % (op, nq, lat['p50'], lat['p95'], lat['p99']))
+    if lentas > 0:
+        print()
+        print("%-50s %10s %10s %10s" % ('slowest queries', 'p50(ms)', 'p95(ms)', 'p99(ms)'))
+        for q in sorted(res['queries'], key=lambda q: -q['latency']['p50'])[:lentas]:
+            lat = q['latency']
+            print("%-50s %10.3f %10.3f %10.3f" % (q['query'][:50], lat['p50'], lat['p95'], lat['p99']))
+    for e in res['errors']:
+        print("==> ERROR: '%s'\t%d\t%d" % (e['query'], e['results'], e['reference']))
+    print()
+
+
+def compare(actual, base, threshold, min_ms, gate):
+    """
+    Compara los resultados con los de una ejecucion anterior (--baseline).
+
+    Es una regresion que una metrica empeore mas de "threshold" (fraccion) respecto a la
+    referencia; en las latencias ademas la diferencia tiene que superar "min_ms", para no
+    dar por regresiones las variaciones de las queries que tardan microsegundos. De las
+    latencias solo se comparan los percentiles de "gate" (p.e. ['p50']) de cada operador,
+    y un percentil alto solo si en las dos ejecuciones hay al menos MIN_TAIL_SAMPLES
+    muestras por encima de el.
+
+    return: tupla con la lista de regresiones, tuplas (corpus, metrica, referencia, actual),
+            y la lista de percentiles que no se han comparado por falta de muestras
+
+    """
+    regresiones = []
+    omitidos = []
+    for nombre, res in actual['corpora'].items():
+        ref = base['corpora'].get(nombre)
+        if ref is None:
+            continue
+        valores = []
+        for metrica, mayor_mejor in METRICS.items():
+            if res.get(metrica) is not None and ref.get(metrica) is not None:
+                valores.append((metrica, ref[metrica], res[metrica], mayor_mejor, 0))
+        for op, lat in res['latency'].items():
+            if op not in ref['latency']:
+                continue
+            for clave in gate:
+                muestras = min(lat['n'], ref['latency'][op]['n'])
+                if muestras * (100 - int(clave[1:])) / 100 < MIN_TAIL_SAMPLES and clave != 'p50':
+                    omitidos.append((nombre, '%s %s' % (op, clave), muestras))
+                    continue
+                valores.append(('%s %s' % (op, clave), ref['latency'][op][clave], lat[clave], False, min_ms))
+
+        for metrica, antes, ahora, mayor_mejor, minimo in valores:
+            if mayor_mejor:
+                peor = ahora < antes * (1 - threshold)
+            else:
+                peor = ahora > antes * (1 + threshold) and ahora - antes > minimo
+            if peor:
+                regresiones.append((nombre, metrica, antes, ahora))
+    return regresiones, omitidos
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Index corpora and replay SAR_Searcher -T query files, '
+                                                 'measuring indexing and query latency.')
+
+    parser.add_argument('-c', '--corpus', dest='corpus', nargs=2, metavar=('NEWSDIR', 'TEST'), action='append', required=True,
+                    help='directory with the news and file with queries and results (as in SAR_Searcher -T), can be repeated.')
+
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=10,
+                    help='times each query is solved and measured (default: 10).')
+
+    parser.add_argument('--warmup', dest='warmup', type=int, default=2,
+                    help='times all the queries are solved before measuring them (default: 2).')
+
+    parser.add_argument('--stem-queries', dest='stem_queries', action='store_true', default=False,
+                    help='solve the queries with stemming, as SAR_Searcher -S.')
+
+    parser.add_argument('--slowest', dest='slowest', type=int, default=10,
+                    help='number of slowest queries shown for each corpus (default: 10).')
+
+    parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
+                    help='compute stem index.')
+
+    parser.add_argument('--stem-postings', dest='stem_postings', action='store_true', default=False,
+                    help='precompute the posting list of every stem, requires -S.')
+
+    parser.add_argument('-P', '--permuterm', dest='permuterm', action='store_true', default=False,
+                    help='compute permuterm index.')
+
+    parser.add_argument('-M', '--multifield', dest='multifield', action='store_true', default=False,
+                    help='compute index for all the fields.')
+
+    parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False,
+                    help='compute positional index.')
+
+    parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False,
+                    help='store the ranking weights (as SAR_Indexer -R) and also measure ranking the results of every query, reported as the "ranking" operator.')
+
+    parser.add_argument('--rank-model', dest='rank_model', choices=['bm25', 'tfidf'], default='bm25',
+                    help='ranking function measured with -R: BM25 or the cosine of tf-idf (default: bm25).')
+
+    parser.add_argument('-Z', '--compress', dest='compress', action='store_true', default=False,
+                    help='compress the posting lists (delta + variable-byte).')
+
+    parser.add_argument('--common-terms', dest='common_terms', metavar='RATIO', type=ratio, default=0,
+                    help='store the posting lists of the terms that appear in at least RATIO (0 < RATIO <= 1, e.g. 0.25) of the news as bitmaps.')
+
+    parser.add_argument('-F', '--format', dest='format', choices=['pickle', 'segment'], default='pickle',
+                    help='format of the index file (default: pickle).')
+
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=1,
+                    help='number of processes used to index the news (default: 1).')
+
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                    help='file where the results are saved as JSON.')
+
+    parser.add_argument('-b', '--baseline', dest='baseline', type=str,
+                    help='JSON file of a previous run: exit with an error if any metric is worse by more than the threshold.')
+
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float, default=0.2,
+                    help='relative regression allowed with --baseline (default: 0.2).')
+
+    parser.add_argument('--min-ms', dest='min_ms', type=float, default=0.5,
+                    help='latency differences below this many milliseconds are never regressions (default: 0.5).')
+
+    parser.add_argument('-g', '--gate', dest='gate', nargs='+', choices=['p%d' % p for p in PERCENTILES], default=['p50'],
+                    help='latency percentiles compared with --baseline; p95 and p99 are only compared when there are enough samples (default: p50).')
+
+    args = parser.parse_args()
+
+    flags = {k: getattr(args, k) for k in ('stem', 'stem_postings', 'permuterm', 'multifield', 'positional',
+                                           'compress', 'common_terms', 'rank', 'format', 'workers')}
+    resultados = {'python': platform.python_version(), 'platform': platform.platform(),
+                  'flags': flags, 'repeat': args.repeat, 'warmup': args.warmup, 'stem_queries': args.stem_queries,
+                  'rank_model': args.rank_model if args.rank else None, 'corpora': {}}
+    errores = 0
+    for newsdir, testfile in args.corpus:
+        nombre = '%s:%s' % (newsdir, os.path.basename(testfile))
+        res = bench_corpus(newsdir, testfile, flags, args)
+        resultados['corpora'][nombre] = res
+        errores += len(res['errors'])
+        show_corpus(nombre, res, args.slowest)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(resultados, fh, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fh:
+            base = json.load(fh)
+        regresiones, omitidos = compare(resultados, base, args.threshold, args.min_ms, args.gate)
+        if omitidos:
+            print("Not compared, fewer than %d samples above the percentile: %s." % (
+                MIN_TAIL_SAMPLES, ', '.join('%s %s' % (nombre, metrica) for nombre, metrica, _ in omitidos)))
+        for nombre, metrica, antes, ahora in regresiones:
+            print("==> REGRESSION: %s %s: %.4g -> %.4g" % (nombre, metrica, antes, ahora))
+        if not regresiones:
+            print("No regressions beyond %d%% against %s." % (args.threshold * 100, args.baseline))
+        errores += len(regresiones)
+
+    sys.exit(1 if errores else 0)
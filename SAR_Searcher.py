@@ -2,10 +2,9 @@
 
 
 import argparse
-import pickle
 import sys
 
-from SAR_lib import SAR_Project
+from SAR_lib import load_index
 
 
 def syntax():
@@ -38,7 +37,27 @@ if __name__ == "__main__":
                     help='show all the results. If not used, only the first 10 results are showed. Does not apply with -C and -T options.')
 
     parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False, 
-                    help='rank results. Does not apply with -C and -T options.')
+                    help='rank results, requires an index built with -R. Does not apply with -C and -T options.')
+
+
+    parser.add_argument('--rank-model', dest='rank_model', choices=['bm25', 'tfidf'], default='bm25',
+                    help='ranking function used with -R: BM25 or the cosine of tf-idf (default: bm25).')
+
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=1,
+                    help='number of processes used to solve the queries of -L and -T (default: 1).')
+
+
+    parser.add_argument('--cache-entries', dest='cache_entries', type=int, default=1000,
+                    help='maximum number of query results kept in the cache, 0 disables it (default: 1000).')
+
+    parser.add_argument('--cache-mb', dest='cache_mb', type=float, default=64,
+                    help='maximum size in MB of the query results kept in the cache (default: 64).')
+
+    parser.add_argument('-E', '--explain', dest='explain', action='store_true', default=False,
+                    help='after each query, show the evaluated plan with the time and number of results of each node, and the time of each stage (EXPLAIN ANALYZE).')
+
+    parser.add_argument('--no-numpy', dest='numpy', action='store_false', default=True,
+                    help='do not use NumPy for the operations on long posting lists.')
 
 
     group1 = parser.add_mutually_exclusive_group()
@@ -51,12 +70,16 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    with open(args.index, 'rb') as fh:
-        searcher = pickle.load(fh)
+    searcher = load_index(args.index)
+    if args.rank and not searcher.ranking:
+        parser.error('-R requires an index built with the -R option of SAR_Indexer')
     searcher.set_stemming(args.stem)
-    searcher.set_ranking(args.rank)
+    searcher.set_ranking(args.rank, args.rank_model)
     searcher.set_showall(args.all)
     searcher.set_snippet(args.snippet)
+    searcher.set_cache(args.cache_entries, int(args.cache_mb * 2**20))
+    searcher.set_numpy(args.numpy)
+    searcher.set_profile(args.explain)
 
 
     # se debe contar o mostrar resultados?
@@ -70,16 +93,29 @@ if __name__ == "__main__":
 
         with open(args.test, encoding='utf-8') as fh:
             lines = fh.read().split('\n')
+            # se resuelven todas las queries de una vez, compartiendo las subconsultas comunes
+            queries = [line.split('\t')[0] for line in lines if len(line) > 0 and not line.startswith('#')]
+            if args.explain:
+                # cada query se resuelve por separado para poder medirla
+                results = iter([None] * len(queries))
+            else:
+                results = iter(searcher.solve_batch(queries, args.workers))
             for line in lines:
                 if len(line) > 0 and not line.startswith('#'):
                     query, reference = line.split('\t')
                     reference = int(reference)
-                    result = searcher.solve_and_count(query)
+                    result = searcher.solve_and_count(query, next(results))
+                    if result is None:
+                        # query mal formada: solve_and_count ya ha mostrado el error de sintaxis
+                        print("==> ERROR: '%s'\tsyntax error\t%d" % (query, reference))
+                        sys.exit(-1)
                     if result != reference:
                         print("==> ERROR: '%s'\t%d\t%d" % (query, result, reference))
                         sys.exit(-1)
                 else:
                     print(line)
+            if args.explain:
+                searcher.profile.show_totals()
             print('\nParece que todo ha ido bien, buen trabajo!')
 
     elif args.query is not None:
@@ -91,14 +127,22 @@ if __name__ == "__main__":
         with open(args.qlist, encoding='utf-8') as fh:
             queries = fh.read().split('\n')
             queries.pop()
+            if args.explain:
+                results = iter([None] * len(queries))
+            else:
+                results = iter(searcher.solve_batch([q for q in queries if len(q) > 0 and not q.startswith('#')], args.workers))
             for query in queries:
                 if len(query) > 0 and not query.startswith('#'):
-                    fnc(query)
+                    fnc(query, next(results))
                 else:
                     print(query)
+            if args.explain:
+                searcher.profile.show_totals()
     else:
         # modo interactivo
         query = input("query:")
         while query != "":
             fnc(query)
-            query = input("query:")
\ No newline at end of file
+            query = input("query:")
+        stats = searcher.query_cache.stats()
+        print("Cache: %d hits, %d misses, %d entries, %.2fMB" % (stats['hits'], stats['misses'], stats['entries'], stats['bytes'] / 2**20))
\ No newline at end of file
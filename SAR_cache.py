@@ -0,0 +1,79 @@
+"""
+Cache LRU acotada por numero de entradas y por tamaño.
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Cache LRU (se descarta la entrada usada hace mas tiempo) con contadores de aciertos y fallos.
+
+    Cada entrada se guarda con su tamaño aproximado en bytes; la cache nunca supera
+    "max_entries" entradas ni "max_bytes" bytes. Si se indica una version al consultarla
+    y no coincide con la de las entradas guardadas, la cache se vacia: asi se invalida
+    automaticamente cuando cambia el indice.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def check_version(self, version):
+        """
+        Vacia la cache si "version" es distinta de la de las entradas guardadas.
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def get(self, key, version=None):
+        """
+        Devuelve el valor asociado a "key" o None si no esta en la cache.
+        """
+        self.check_version(version)
+        entrada = self.entries.get(key)
+        if entrada is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entrada[0]
+
+    def put(self, key, value, nbytes=0, version=None):
+        """
+        Guarda "value" asociado a "key", descartando las entradas mas antiguas si hace falta.
+        Los valores mas grandes que la propia cache no se guardan.
+        """
+        self.check_version(version)
+        if nbytes > self.max_bytes or self.max_entries <= 0:
+            return
+        anterior = self.entries.pop(key, None)
+        if anterior is not None:
+            self.nbytes -= anterior[1]
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, (_, n) = self.entries.popitem(last=False)
+            self.nbytes -= n
+            self.evictions += 1
+
+    def stats(self):
+        """
+        return: diccionario con los contadores y la ocupacion de la cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.nbytes}
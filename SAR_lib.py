@@ -1,8 +1,51 @@
 import json
+import zlib
+import hashlib
 from nltk.stem.snowball import SnowballStemmer
 import os
 import re
+import sys
 import math
+import pickle
+import heapq
+from collections import Counter
+from contextlib import nullcontext
+from itertools import islice
+from bisect import bisect_left
+from array import array
+import multiprocessing
+from multiprocessing import Pool
+
+from SAR_postings import CompressedPosting, CompressedPositional, posting_nbytes
+from SAR_postings import PostingCursor, GALLOP_RATIO, Bitmap
+from SAR_postings import numpy, NUMPY_MIN, np_and, np_or, np_minus
+from SAR_postings import encode_posting, decode_posting, encode_positional, decode_positional
+from SAR_segment import MAGIC as SEGMENT_MAGIC, Segment, SegmentWriter, MemoryArray, SortedTable
+from SAR_cache import LRUCache
+from SAR_vocab import Vocabulary
+from SAR_profile import QueryProfile
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# caracteres que se leen de cada vez de un fichero de noticias, ver iter_json
+JSON_CHUNK = 1 << 16
+
+# bytes de noticias a partir de los que se reparte la indexacion entre varios procesos
+# (ver SAR_Project.parallel_workers y SAR_Benchmark -B indexing)
+PARALLEL_MIN = 1 << 21
+
+# contexto que no mide nada, ver SAR_Project.stage
+NO_PROFILE = nullcontext()
+
+
+class QuerySyntaxError(ValueError):
+    """
+    Query mal formada: parentesis sin cerrar o sin abrir, u operadores sin operando.
+    """
+
 
 class SAR_Project:
     """
@@ -26,6 +69,19 @@ class SAR_Project:
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
 
+    # longitud de los k-gramas del indice para comodines (self.kgindex)
+    KGRAM = 3
+
+    # parametros de BM25, ver rank_result
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    # rank_result solo usa MaxScore (top_k) si el resultado tiene mas de TOPK_RESULT * k
+    # noticias y las posting lists de los terminos que puntuan suman al menos TOPK_MIN
+    # newid (segun la funcion de ranking); si no, ordenar todo es mas rapido (ver bench_topk)
+    TOPK_RESULT = 4
+    TOPK_MIN = {'bm25': 2048, 'tfidf': 16384}
+
 
     def __init__(self):
         """
@@ -37,23 +93,57 @@ class SAR_Project:
 
         """
         self.term_field = {}
-        self.weight_doc = {}
-        self.index = {} # hash para el indice invertido de terminos --> clave: termino, valor: posting list.
-                        # Si se hace la implementacion multifield, se pude hacer un segundo nivel de hashing de tal forma que:
-                        # self.index['title'] seria el indice invertido del campo 'title'.
-        self.posindex = {}
-        self.sindex = {} # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
-        self.ptindex = {} # hash para el indice permuterm.
+        self.weight_doc = {} # pesado de las noticias --> clave: campo, valor: tupla (longitudes, normas, longitud media), ver make_weights
+        self.index = {} # hash para el indice invertido de terminos --> clave: campo, valor: hash con clave: term id, valor: posting list.
+                        # self.index['title'] es el indice invertido del campo 'title'; sin multifield solo se indexa 'article'.
+                        # La fecha no esta aqui sino en self.dindex, ver index_fields.
+        self.posindex = {} # hash para el indice posicional --> clave: campo, valor: hash con clave: term id, valor: {newid: posiciones}
+        self.terms = Vocabulary() # vocabulario compartido por los indices de todos los campos --> clave: termino, valor: term id.
+                                  # self.terms[termino] añade el termino si es nuevo, ver SAR_vocab
+        self.vocab = self.terms.terms # terminos del vocabulario --> posicion: term id, valor: termino
+        self.sindex = {} # hash para el indice invertido de stems --> clave: stem, valor: lista con los term id de los terminos que tienen ese stem
+        self.spindex = {} # posting lists precalculadas de los stems (opcional) --> clave: campo, valor: hash con clave: stem, valor: union de las posting lists de sus terminos
+        self.ptindex = {} # indice permuterm, tras make_permuterm es una SortedTable con las rotaciones ordenadas --> clave: rotacion, valor: term id
+        self.kgindex = {} # hash para el indice de k-gramas --> clave: k-grama, valor: lista ordenada de term id
+        self.dindex = {} # indice de fechas, tras make_dates es una SortedTable --> clave: fecha, valor: lista de tramos (ini, fin) de newid consecutivos
+        self.dates = [] # tramos de noticias con la misma fecha segun se indexan --> [fecha, primer newid, ultimo newid + 1]
+        self.manifest = {} # ficheros indexados --> clave: ruta, valor: firma (ver file_signature), para la indexacion incremental
         self.docs = {} # diccionario de documentos --> clave: entero(docid),  valor: ruta del fichero.
-        self.weight = {} # hash de terminos para el pesado, ranking de resultados. puede no utilizarse
+        self.weight = {} # hash de terminos para el pesado --> clave: campo, valor: hash con clave: term id, valor: tupla (idf, frecuencias del termino
+                         # en cada noticia de su posting list y en el mismo orden), ver make_weights
         self.news = {} # hash de noticias --> clave entero (newid), valor: la info necesaria para diferenciar la noticia dentro de su fichero (doc_id y posición dentro del documento)
-        self.tokenizer = re.compile("\W+") # expresion regular para hacer la tokenizacion
+        self.tokenizer = re.compile(r"\w+") # expresion regular para hacer la tokenizacion: los tokens son las secuencias de caracteres alfanumericos
+        self.query_splitter = re.compile(r'[^\s()"]*"[^"]*"|[^\s()"]+|[()]') # expresion regular para separar los elementos de una query
         self.stemmer = SnowballStemmer('spanish') # stemmer en castellano
+        self.stems = {} # memoria de self.stemmer.stem --> clave: termino, valor: su stem. Ver self.stem(). No se guarda con el indice
+        self.stem_postings = False # si es True make_stemming precalcula self.spindex
+        self.ranking = False # si es True se guardan las frecuencias y se precalcula el pesado para rank_result, ver make_weights
         self.show_all = False # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False # valor por defecto, se cambia con self.set_stemming()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
+        self.rank_model = 'bm25' # funcion de ranking: 'bm25' o 'tfidf' (coseno), se cambia con self.set_ranking()
         self.pterms = {} # hash para el indice invertido permuterm --> clave: permuterm, valor: lista con los terminos que tienen ese permuterm
+        self.compress = False # si es True las posting lists se guardan comprimidas, ver self.compress_index()
+        self.common_terms = 0 # fraccion de las noticias a partir de la que una posting list se guarda como Bitmap (0: nunca), ver self.make_common()
+        self.bitmaps = {} # numero de posting lists guardadas como Bitmap --> clave: campo, valor: numero
+        self.use_numpy = True # si es True y NumPy esta instalado, las posting lists largas se operan con NumPy, se cambia con self.set_numpy()
+        self.sizes = {} # tamaños en memoria y en disco de los indices antes y despues de comprimirlos
+        self.index_version = 0 # se incrementa cada vez que cambia el indice, invalida self.query_cache
+        self.query_cache = LRUCache() # cache de resultados de solve_query, se cambia con self.set_cache()
+        self.store = MemoryArray() # almacen de documentos --> posicion: newid, valor: campos de la noticia (JSON comprimido con zlib)
+        self.record_cache = LRUCache(256) # cache de noticias ya decodificadas del almacen
+        self.profile = None # instrumentacion de las queries (QueryProfile), se activa con self.set_profile()
+
+
+    def __getstate__(self):
+        """
+        Estado que se guarda con pickle: todo salvo la memoria de stems (self.stems), que
+        solo sirve mientras se ejecuta y se vuelve a rellenar bajo demanda.
+        """
+        estado = self.__dict__.copy()
+        estado['stems'] = {}
+        return estado
 
 
     ###############################
@@ -108,12 +198,13 @@ class SAR_Project:
         self.use_stemming = v
 
 
-    def set_ranking(self, v):
+    def set_ranking(self, v, model='bm25'):
         """
 
         Cambia el modo de ranking por defecto.
 
         input: "v" booleano.
+               "model": funcion de ranking, 'bm25' o 'tfidf'
 
         UTIL PARA LA VERSION CON RANKING DE NOTICIAS
 
@@ -121,6 +212,60 @@ class SAR_Project:
 
         """
         self.use_ranking = v
+        self.rank_model = model
+
+
+    def set_cache(self, entries, nbytes):
+        """
+
+        Cambia el tamaño de la cache de resultados de las queries.
+
+        input: "entries": numero maximo de queries guardadas, 0 desactiva la cache.
+               "nbytes": tamaño maximo (aproximado) en bytes de los resultados guardados.
+
+        La cache se guarda en self.query_cache, sus contadores con self.query_cache.stats()
+
+        """
+        self.query_cache = LRUCache(entries, nbytes)
+
+
+    def set_numpy(self, v):
+        """
+
+        Activa o desactiva las operaciones con NumPy sobre posting lists largas.
+
+        input: "v" booleano.
+
+        si self.use_numpy es True (y NumPy esta instalado) el AND, OR y except de posting lists
+        suficientemente largas (NUMPY_MIN) se calculan con arrays de NumPy, ver self.numpy_ok()
+
+        """
+        self.use_numpy = v
+
+
+    def set_profile(self, v):
+        """
+
+        Activa o desactiva la instrumentacion de las queries (EXPLAIN ANALYZE).
+
+        input: "v" booleano.
+
+        si es True se guardan en self.profile el plan evaluado de cada query, con el tiempo y
+        el numero de resultados de cada nodo, los tiempos de cada etapa y varios contadores;
+        solve_and_show y solve_and_count los muestran despues de cada query
+
+        """
+        self.profile = QueryProfile() if v else None
+
+
+    def stage(self, etapa):
+        """
+        Contexto que suma el tiempo de un bloque a una etapa de self.profile, o que no
+        hace nada si la instrumentacion esta desactivada.
+        """
+        if self.profile is None:
+            return NO_PROFILE
+        return self.profile.stage(etapa)
 
 
 
@@ -144,25 +289,274 @@ class SAR_Project:
         self.positional = args['positional']
         self.stemming = args['stem']
         self.permuterm = args['permuterm']
+        self.compress = args.get('compress', False)
+        self.stem_postings = args.get('stem_postings', False)
+        self.common_terms = args.get('common_terms', 0) or 0
+        self.ranking = args.get('rank', False)
 
+        self.index_files(self.news_files(root), args.get('workers', 1) or 1)
+        self.finish_index()
 
-        for dir, subdirs, files in os.walk(root):
-            for filename in files:
-                if filename.endswith('.json'):
-                    fullname = os.path.join(dir, filename)
-                    self.index_file(fullname)
+        ##########################################
+        ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
+        ##########################################
+
+
+
+    def index_files(self, ficheros, workers=1):
+        """
+        Indexa una lista de ficheros de noticias y anota su firma en self.manifest.
+
+        param:  "ficheros": lista ordenada con las rutas de los ficheros
+                "workers": numero maximo de procesos a utilizar (ver parallel_workers)
+
+        """
+        workers = self.parallel_workers(ficheros, workers)
+        if workers > 1:
+            self.index_parallel(ficheros, workers)
+        else:
+            for fullname in ficheros:
+                self.index_file(fullname)
+        for fullname in ficheros:
+            self.manifest[fullname] = file_signature(fullname)
 
+
+    def finish_index(self):
+        """
+        Construye los indices que dependen del vocabulario o de toda la coleccion (stems,
+        permuterm, k-gramas, fechas y pesos) y deja las posting lists en su formato final.
+        Se llama una vez indexadas todas las noticias.
+        """
         if self.stemming:
             self.set_stemming(True)
             self.make_stemming()
         if self.permuterm:
             self.make_permuterm()
+            self.make_kgrams()
+        self.make_dates()
+        if self.ranking:
+            self.make_weights()
+        if self.common_terms:
+            self.make_common()
+        if self.compress:
+            self.compress_index()
+        elif self.positional:
+            self.pack_positionals()
+
+
+
+    def index_fields(self):
+        """
+        Devuelve los campos que se indexan: todos los de self.fields con multifield y
+        solo 'article' sin el. La fecha no se indexa como un campo mas: siempre se guarda
+        en el indice de fechas (self.dindex, ver make_dates), que es el que se consulta.
+        Todos los campos indexados se tokenizan.
+
+        return: lista de campos
+
+        """
+        if self.multifield:
+            return [field for field, _ in self.fields if field != 'date']
+        return ["article"]
+
+
+    def news_files(self, root):
+        """
+        Devuelve la lista de ficheros de noticias que cuelgan del directorio "root".
+
+        El arbol se recorre en orden alfabetico para que los docid y newid sean
+        siempre los mismos, independientemente del sistema de ficheros.
+
+        param:  "root": directorio con las noticias
+
+        return: lista con las rutas de los ficheros .json y .jsonl
+
+        """
+        ficheros = []
+        for dir, subdirs, files in os.walk(root):
+            subdirs.sort()
+            for filename in sorted(files):
+                if filename.endswith(('.json', '.jsonl')):
+                    ficheros.append(os.path.join(dir, filename))
+        return ficheros
+
+
+    def parallel_workers(self, ficheros, workers):
+        """
+        Decide cuantos procesos usar para indexar "ficheros" con como mucho "workers".
+
+        Nunca mas que CPUs disponibles ni que ficheros, y ninguno extra si la coleccion
+        tiene menos de PARALLEL_MIN bytes: el padre tiene que deserializar y fusionar todos
+        los indices parciales, y con pocos datos eso y arrancar el pool cuesta mas de lo
+        que se ahorra.
+
+        return: numero de procesos, 1 para indexar secuencialmente
+
+        """
+        workers = min(workers, len(ficheros), available_cpus())
+        if workers > 1 and sum(os.path.getsize(f) for f in ficheros) < PARALLEL_MIN:
+            return 1
+        return max(workers, 1)
+
+
+    def index_parallel(self, ficheros, workers):
+        """
+        Indexa una lista de ficheros repartiendola entre varios procesos.
+
+        Cada proceso indexa un bloque de ficheros consecutivos con sus propios docid y newid
+        (empezando en 0) y devuelve sus indices parciales. Los bloques se fusionan en orden
+        desplazando los identificadores, de forma que el resultado es identico al de la
+        indexacion secuencial y las posting lists siguen ordenadas.
+
+        param:  "ficheros": lista ordenada con las rutas de los ficheros a indexar
+                "workers": numero de procesos a utilizar
+
+        """
+        # Varios bloques por proceso para repartir mejor la carga
+        nbloques = min(len(ficheros), workers * 4)
+        tam = math.ceil(len(ficheros) / nbloques)
+        tareas = [(ficheros[i:i + tam], self.positional, self.multifield, self.ranking)
+                  for i in range(0, len(ficheros), tam)]
+
+        with Pool(workers) as pool:
+            # imap devuelve los resultados en el orden de las tareas
+            for parcial in pool.imap(_index_chunk, tareas):
+                self.merge_partial(*parcial)
+
+
+    def merge_partial(self, docs, news, vocab, index, posindex, store, dates, weight, weight_doc):
+        """
+        Fusiona en el indice los resultados parciales de un proceso de indexacion.
+
+        param:  "docs": lista de ficheros indexados, en orden de docid local
+                "news": lista con la posicion de cada noticia ("docid_pos") en orden de newid local
+                "vocab": lista de terminos en orden de term id local
+                "index": indice invertido parcial
+                "posindex": indice posicional parcial
+                "store": almacen de documentos parcial
+                "dates": tramos de fechas parciales (ver self.dates)
+                "weight", "weight_doc": frecuencias y longitudes parciales (ver self.weight)
+
+        """
+        doff = len(self.docs)
+        noff = len(self.news)
+
+        for d, filename in enumerate(docs):
+            self.docs[doff + d] = filename
+
+        for n, ref in enumerate(news):
+            d, i = ref.split("_")
+            self.news[noff + n] = f"{int(d) + doff}_{i}"
+        for record in store.values():
+            self.store.append(record)
+        for fecha, ini, fin in dates:
+            self.add_date(fecha, ini + noff, fin + noff)
+
+        # term id del bloque --> term id del vocabulario compartido; los terminos se
+        # añaden en el mismo orden que si se hubieran indexado los ficheros aqui
+        ids = [self.terms[w] for w in vocab]
+
+        # Los newid del bloque son todos mayores que los ya indexados,
+        # basta con concatenar para mantener las posting lists ordenadas
+        for field, parcial in index.items():
+            indice = self.index.setdefault(field, {})
+            for w, posting in parcial.items():
+                w = ids[w]
+                if w not in indice:
+                    indice[w] = []
+                indice[w].extend(n + noff for n in posting)
+
+        for field, parcial in weight.items():
+            pesos = self.weight.setdefault(field, {})
+            for w, tfs in parcial.items():
+                pesos.setdefault(ids[w], []).extend(tfs)
+        for field, longitudes in weight_doc.items():
+            self.weight_doc.setdefault(field, array('I')).extend(longitudes)
+
+        for field, parcial in posindex.items():
+            indice = self.posindex.setdefault(field, {})
+            for w, posis in parcial.items():
+                destino = indice.setdefault(ids[w], {})
+                for n, lista in posis.items():
+                    destino[n + noff] = lista
+        self.index_version += 1
+
+
+
+    def merge_project(self, parte, borrados=()):
+        """
+        Añade al indice las noticias de otro indice ya construido (p.e. un segmento abierto
+        con load_index), salvo las de "borrados". Las noticias se renumeran a continuacion
+        de las ya indexadas, sin huecos, y las posting lists se copian sin volver a leer ni
+        tokenizar las noticias. Como en index_files, despues hay que llamar a finish_index.
+
+        param:  "parte": SAR_Project con el indice a añadir
+                "borrados": newid (de "parte") de las noticias que no se deben copiar
+
+        """
+        borrados = set(borrados)
+        nuevo = {}
+        docmap = {}
+        docs = []
+        news = []
+        store = MemoryArray()
+        for n in range(len(parte.news)):
+            if n in borrados:
+                continue
+            d, i = parte.news[n].split("_")
+            d = int(d)
+            if d not in docmap:
+                docmap[d] = len(docs)
+                docs.append(parte.docs[d])
+            nuevo[n] = len(news)
+            news.append(f"{docmap[d]}_{i}")
+            store.append(parte.store[n])
+
+        dates = []
+        for fecha, tramos in parte.dindex.items():
+            for ini, fin in tramos:
+                dates.extend([fecha, nuevo[n], nuevo[n] + 1] for n in range(ini, fin) if n in nuevo)
+        dates.sort(key=lambda t: t[1])
+
+        # solo pasan al vocabulario los terminos que siguen en alguna noticia
+        vocab = []
+        locales = {}
+        index = {}
+        weight = {}
+        for field, indice in parte.index.items():
+            pesos = parte.weight.get(field)
+            index[field] = {}
+            if pesos is not None:
+                weight[field] = {}
+            for w, posting in indice.items():
+                if pesos is None:
+                    lista = [nuevo[n] for n in posting if n in nuevo]
+                else:
+                    pares = [(nuevo[n], tf) for n, tf in zip(posting, pesos[w][1]) if n in nuevo]
+                    lista = [n for n, _ in pares]
+                if not lista:
+                    continue
+                if w not in locales:
+                    locales[w] = len(vocab)
+                    vocab.append(parte.vocab[w])
+                w = locales[w]
+                index[field][w] = lista
+                if pesos is not None:
+                    weight[field][w] = [tf for _, tf in pares]
+
+        posindex = {}
+        for field, indice in parte.posindex.items():
+            posindex[field] = {}
+            for w, posis in indice.items():
+                copia = {nuevo[n]: pos for n, pos in posis.items() if n in nuevo}
+                if copia:
+                    posindex[field][locales[w]] = copia
+
+        weight_doc = {field: array('I', (longitudes[n] for n in nuevo))
+                      for field, (longitudes, _, _) in parte.weight_doc.items()}
+        self.merge_partial(docs, news, vocab, index, posindex, store, dates, weight, weight_doc)
 
-        ##########################################
-        ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
-        ##########################################
 
-        
 
     def index_file(self, filename):
         """
@@ -175,61 +569,182 @@ class SAR_Project:
         Dependiendo del valor de "self.multi field" y "self.positional" se debe ampliar el indexado.
         En estos casos, se recomienda crear nuevos metodos para hacer mas sencilla la implementacion
 
-        input: "filename" es el nombre de un fichero en formato JSON Arrays (https://www.w3schools.com/js/js_json_arrays.asp).
-                Una vez parseado con json.load tendremos una lista de diccionarios, cada diccionario se corresponde a una noticia
+        input: "filename" es el nombre de un fichero en formato JSON Arrays (https://www.w3schools.com/js/js_json_arrays.asp)
+                o JSON Lines. self.read_file devuelve las noticias de una en una, como diccionarios
 
         """
 
-        with open(filename) as fh:
-            
-            i = 0 #Contador para los articulos dentro del fichero
-            #fname = filename.split("\\")[2][:-5] #Split para sacar el nombre base
-     
-            jlist = json.load(fh)
-            d = len(self.docs) #DocId
-            self.docs[d] = filename
-
-            if self.positional:
-                for new in jlist:
-                    n = len(self.news) #NewId
-
-                    self.news[n] = f"{d}_{i}" #Asignar al newId su nombre junto con la posición relativa
-      
-                    words = self.tokenize(new["article"])
-                    j = 0
-                    for w in words:
-                        if w in self.index.keys():
-                            if n not in self.index[w]:
-                                self.index[w].append(n)
-                        if w in self.posindex.keys():
-                            if n not in self.posindex[w].keys():
-                                self.posindex[w][n] = [j]
-                            else:
-                                self.posindex[w][n].append(j)
-                        else:
-                            self.index[w] = [n]
-                            self.posindex[w] = {n : [j]}
-                        j = j + 1
-                    i = i + 1
-            else:
-                for new in jlist:
-                    
-                    n = len(self.news) #NewId
-                    self.news[n] = f"{d}_{i}" #Asignar al newId su nombre junto con la posición relativa
-                    words = self.tokenize(new["article"])
-                    j = 0
-                    for w in words:
-                        if w in self.index.keys():
-                            if n not in self.index[w]:
-                                self.index[w].append(n)
-                                self.posindex[w]
-                        else:
-                            self.index[w] = [n]
-                            self.posindex[w] = {n : [j]}
-                        j = j + 1
-                    i = i + 1
-            fh.close()
+        i = 0 #Contador para los articulos dentro del fichero
+
+        jlist = self.read_file(filename) #iterador, el fichero no se carga entero
+        d = len(self.docs) #DocId
+        self.docs[d] = filename
+        self.index_version += 1
+
+        for new in jlist:
+            n = len(self.news) #NewId
+            self.news[n] = f"{d}_{i}" #Asignar al newId su nombre junto con la posición relativa
+            self.store_record(new)
+            self.add_date(str(new.get('date', '')).strip(), n, n + 1)
+
+            # Una unica pasada por la noticia indexa todos sus campos
+            for field in self.index_fields():
+                indice = self.index.setdefault(field, {})
+                words = self.tokenize_ids(new.get(field, ''))
+                if self.ranking:
+                    pesos = self.weight.setdefault(field, {})
+                    self.weight_doc.setdefault(field, array('I')).append(len(words))
+
+                # Se agrupan las apariciones de cada termino en la noticia (sus posiciones,
+                # o solo cuantas hay si no se hace el indice posicional); asi cada termino
+                # se añade una unica vez al final de su posting list, junto con su frecuencia
+                if self.positional:
+                    posindex = self.posindex.setdefault(field, {})
+                    apariciones = {}
+                    for j, w in enumerate(words):
+                        apariciones.setdefault(w, []).append(j)
+                else:
+                    apariciones = Counter(words)
+
+                for w, aparicion in apariciones.items():
+                    posting = indice.get(w)
+                    if posting is None:
+                        indice[w] = [n]
+                        if self.positional:
+                            posindex[w] = {}
+                    else:
+                        posting.append(n)
+                    if self.positional:
+                        posindex[w][n] = aparicion
+                    if self.ranking:
+                        pesos.setdefault(w, []).append(len(aparicion) if self.positional else aparicion)
+            i = i + 1
+
+
+
+
+    def add_date(self, fecha, ini, fin):
+        """
+        Anota que las noticias ini..fin-1 tienen la fecha "fecha".
+
+        Las noticias de un mismo fichero suelen ser del mismo dia y tener newid
+        consecutivos, asi que basta con alargar el ultimo tramo de self.dates.
+
+        """
+        if self.dates and self.dates[-1][0] == fecha and self.dates[-1][2] == ini:
+            self.dates[-1][2] = fin
+        else:
+            self.dates.append([fecha, ini, fin])
+
+
+    def make_dates(self):
+        """
+        Crea el indice de fechas (self.dindex) a partir de los tramos de self.dates.
+
+        Las fechas se guardan ordenadas, por lo que un rango de fechas es un rango de
+        claves consecutivas, y cada fecha tiene la lista de tramos de newid con esa fecha.
+
+        """
+        tramos = {}
+        for fecha, ini, fin in self.dates:
+            tramos.setdefault(fecha, []).append((ini, fin))
+        self.dindex = SortedTable(tramos.items())
+        self.dates = []
+
+
+    def make_weights(self):
+        """
+        Precalcula el pesado de terminos y noticias para rank_result. Solo se hace si
+        self.ranking (opcion -R del indexador): sin ella no se guardan las frecuencias.
+
+        Durante la indexacion self.weight[field][term] es la lista de frecuencias del termino
+        (en el orden de su posting list) y self.weight_doc[field] la longitud de cada noticia.
+        Aqui se les añade el idf de cada termino y la norma de cada noticia (para el coseno
+        de tf-idf), de forma que al ordenar solo hay que recorrer las posting lists de la query.
+        Tambien se guarda la maxima puntuacion que el termino aporta a una noticia con cada
+        funcion de ranking, como cota superior para top_k:
+
+            self.weight[field][term] = (idf, array de frecuencias, cota BM25, cota tf-idf)
+            self.weight_doc[field] = (array de longitudes, array de normas, longitud media)
+
+        Se usa el idf de BM25, log(1 + (N - df + 0.5) / (df + 0.5)), que nunca es negativo.
+
+        """
+        N = len(self.news)
+        for field, pesos in self.weight.items():
+            longitudes = self.weight_doc[field]
+            normas = [0.0] * N
+            indice = self.index[field]
+            for w, tfs in pesos.items():
+                df = len(tfs)
+                idf = math.log(1 + (N - df + 0.5) / (df + 0.5))
+                for n, tf in zip(indice[w], tfs):
+                    normas[n] += ((1 + math.log(tf)) * idf) ** 2
+                pesos[w] = (idf, array('I', tfs))
+            media = sum(longitudes) / N if N else 0
+            normas = array('d', (math.sqrt(x) for x in normas))
+            self.weight_doc[field] = (longitudes, normas, media)
+
+            for w, (idf, tfs) in pesos.items():
+                cota_bm25 = cota_tfidf = 0
+                for n, tf in zip(indice[w], tfs):
+                    cota_bm25 = max(cota_bm25, self.term_score('bm25', tf, idf, n, self.weight_doc[field]))
+                    cota_tfidf = max(cota_tfidf, self.term_score('tfidf', tf, idf, n, self.weight_doc[field]))
+                pesos[w] = (idf, tfs, cota_bm25, cota_tfidf)
+
+
+    def store_record(self, new):
+        """
+        Añade una noticia al almacen de documentos (self.store).
+
+        Se guardan los campos de self.fields como JSON comprimido con zlib, de forma que
+        para mostrar una noticia basta con leer y descomprimir su registro.
+
+        param:  "new": diccionario con la noticia
+
+        """
+        campos = {field: new.get(field, '') for field, _ in self.fields}
+        self.store.append(zlib.compress(json.dumps(campos, ensure_ascii=False).encode('utf-8')))
+
+
+    def get_record(self, newid):
+        """
+        Devuelve los campos guardados de una noticia.
+
+        Las ultimas noticias leidas se guardan ya decodificadas en self.record_cache.
+
+        param:  "newid": identificador de la noticia
+
+        return: diccionario con los campos de la noticia
+
+        """
+        noticia = self.record_cache.get(newid)
+        if noticia is None:
+            raw = self.store[newid]
+            noticia = json.loads(zlib.decompress(raw))
+            self.record_cache.put(newid, noticia, len(raw))
+            if self.profile is not None:
+                self.profile.count('records decoded')
+                self.profile.count('record bytes', len(raw))
+        elif self.profile is not None:
+            self.profile.count('record cache hits')
+        return noticia
+
+
+    def read_file(self, filename):
+        """
+        Lee un fichero de noticias en formato JSON Arrays o JSON Lines.
+
+        Las noticias se leen de una en una (ver iter_json), de forma que la memoria no
+        depende del tamaño del fichero sino del de la noticia mas grande.
+
+        param:  "filename": ruta del fichero
 
+        return: iterador de diccionarios, uno por noticia
+
+        """
+        with open(filename) as fh:
+            yield from iter_json(fh)
 
 
 
@@ -240,12 +755,37 @@ class SAR_Project:
         Tokeniza la cadena "texto" eliminando simbolos no alfanumericos y dividientola por espacios.
         Puedes utilizar la expresion regular 'self.tokenizer'.
 
+        Los tokens se extraen directamente con findall, sin crear una copia del texto
+        con los simbolos sustituidos por espacios.
+
         params: 'text': texto a tokenizar
 
         return: lista de tokens
 
         """
-        return self.tokenizer.sub(' ', text.lower()).split()
+        return self.tokenizer.findall(text.lower())
+
+
+    def tokenize_ids(self, text):
+        """
+        Tokeniza "text" (ver tokenize) y devuelve el term id de cada token, añadiendo
+        al vocabulario (self.terms) los terminos nuevos. Cada termino se guarda una
+        sola vez y todos los indices se refieren a el por su term id.
+
+        params: 'text': texto a tokenizar
+
+        return: lista de term id
+
+        """
+        return list(map(self.terms.__getitem__, self.tokenize(text)))
+
+
+    def index_key(self, term):
+        """
+        Clave de un termino de una query en los indices: su term id (None si no esta en
+        el vocabulario). Las fechas no estan en los indices de terminos, ver get_dates.
+        """
+        return self.terms.get(term)
 
 
 
@@ -257,23 +797,48 @@ class SAR_Project:
 
         self.stemmer.stem(token) devuelve el stem del token
 
+        Si self.stem_postings es True se precalcula ademas la posting list de cada stem
+        (self.spindex), para que las consultas con stemming no tengan que unir las
+        posting lists de todos sus terminos. Las frases y NEAR no usan stemming, por lo
+        que no hace falta un indice posicional de los stems.
+
         """
          # Recorremos todos los campos del índice de términos
 
-        for word in self.index.keys():
+        for t, word in enumerate(self.vocab):
 
             # Recorremos todos los términos del campo
                 # Generamos el stem solo si no hemos hecho el stemming del término con anterioridad
-            stem = self.stemmer.stem(word)
+            stem = self.stem(word)
 
+            # cada termino esta una sola vez en el vocabulario, no puede repetirse en la lista
             if stem in self.sindex.keys():
-                if word not in self.sindex[stem]:
-                    self.sindex[stem].append(word)
+                self.sindex[stem].append(t)
             else:
-                self.sindex[stem] = [word]
+                self.sindex[stem] = [t]
             # Añadimos el stem si no lo hemos añadido todavía
             #self.sindex[stem] = self.or_posting(self.sindex[field].get(stem, []),self.index[field][term])
 
+        if self.stem_postings:
+            for field in self.index_fields():
+                indice = self.index[field]
+                spindex = self.spindex[field] = {}
+                for stem, words in self.sindex.items():
+                    words = [w for w in words if w in indice]
+                    if not words:
+                        continue
+                    spindex[stem] = self.or_postings([indice[w] for w in words])
+
+
+    def stem(self, word):
+        """
+        Devuelve el stem de "word" guardando el resultado en self.stems, de forma que
+        cada termino distinto solo pasa una vez por self.stemmer.
+        """
+        stem = self.stems.get(word)
+        if stem is None:
+            stem = self.stems[word] = self.stemmer.stem(word)
+        return stem
 
 
     def make_permuterm(self):
@@ -287,15 +852,204 @@ class SAR_Project:
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
-     # Recorremos todos los campos del índice de términos
-        for term in self.index.keys():
+        # Todas las rotaciones de "termino$" se guardan ordenadas (SortedTable), de forma
+        # que los terminos que encajan con un comodin son un rango de rotaciones consecutivas
+        rotaciones = []
+        for t, term in enumerate(self.vocab):
             aux = term + "$"
-            i=0
-            if aux not in self.ptindex.keys():
-                for w in aux:
-                    pterm = aux[i:] + aux[0:i]
-                    self.ptindex[pterm] = term
-                    i=i+1
+            for i in range(len(aux)):
+                rotaciones.append((aux[i:] + aux[0:i], t))
+        self.ptindex = SortedTable(rotaciones)
+
+
+
+    def make_common(self):
+        """
+        Guarda como Bitmap las posting lists de los terminos muy frecuentes (p.e. 'de', 'la',
+        'que'), los que aparecen en al menos self.common_terms * N noticias, en self.index
+        y en self.spindex.
+
+        Un Bitmap ocupa N/8 bytes, menos que la posting list comprimida (al menos un byte
+        por noticia) si el termino esta en mas de 1/8 de las noticias. El AND con una lista
+        solo consulta el bitmap para cada elemento de la lista, y el AND, el OR y el NOT
+        entre bitmaps son operaciones sobre enteros (ver bitmap_posting). Las posiciones
+        siguen en self.posindex, asi que las frases se resuelven igual.
+
+        """
+        N = len(self.news)
+        minimo = max(1, math.ceil(self.common_terms * N))
+        for indices in (self.index, self.spindex):
+            for field, indice in indices.items():
+                for w, posting in indice.items():
+                    if len(posting) >= minimo:
+                        indice[w] = Bitmap.from_posting(posting, N)
+                        if indices is self.index:
+                            self.bitmaps[field] = self.bitmaps.get(field, 0) + 1
+        self.index_version += 1
+
+
+    def compress_index(self):
+        """
+        Comprime las posting lists de self.index y self.posindex (ver SAR_postings).
+
+        Antes y despues de comprimir se anota en self.sizes la memoria estimada y el
+        tamaño serializado de los indices, para mostrarlos en show_stats.
+
+        """
+        self.sizes['before'] = self.index_sizes()
+
+        for indices, comprimir in ((self.index, CompressedPosting.from_list),
+                                   (self.posindex, CompressedPositional.from_dict),
+                                   (self.spindex, CompressedPosting.from_list)):
+            for indice in indices.values():
+                for w, posting in indice.items():
+                    if not isinstance(posting, Bitmap):
+                        indice[w] = comprimir(posting)
+
+        self.sizes['after'] = self.index_sizes()
+        self.index_version += 1
+
+
+    def pack_positionals(self):
+        """
+        Guarda las listas de posiciones de self.posindex como array('I')
+        (4 bytes por posicion en lugar de un objeto int y su referencia). Las posiciones
+        se añaden en orden al indexar, por lo que ya estan ordenadas.
+        """
+        for indice in self.posindex.values():
+            for posis in indice.values():
+                for n, lista in posis.items():
+                    posis[n] = array('I', lista)
+
+
+    def index_sizes(self):
+        """
+        Calcula el tamaño de self.index y self.posindex (y de los indices de stems precalculados).
+
+        return: tupla (memoria, disco) en bytes, la memoria es una estimacion que incluye
+                los diccionarios, las listas y los enteros; el tamaño en disco es el del pickle
+
+        """
+        memoria = 0
+        indices = (self.index, self.posindex, self.spindex)
+        for indice in (indice for campos in indices for indice in campos.values()):
+            memoria += sys.getsizeof(indice)
+            memoria += sum(sys.getsizeof(w) + posting_nbytes(p) for w, p in indice.items())
+        disco = len(pickle.dumps(indices, pickle.HIGHEST_PROTOCOL))
+        return memoria, disco
+
+
+
+    def save_segment(self, filename):
+        """
+        Guarda los indices en un segmento (ver SAR_segment) en lugar de serializar el objeto entero.
+
+        El segmento contiene la configuracion, los ficheros, las noticias, el almacen de documentos, el vocabulario,
+        el indice invertido, el posicional, el de stems, el permuterm y el de k-gramas. Las posting lists se guardan comprimidas.
+
+        param:  "filename": ruta del fichero a crear
+
+        """
+        meta = {'multifield': self.multifield, 'positional': self.positional,
+                'stemming': self.stemming, 'permuterm': self.permuterm,
+                'compress': self.compress, 'stem_postings': self.stem_postings, 'sizes': self.sizes,
+                'common_terms': self.common_terms, 'ranking': self.ranking, 'bitmaps': self.bitmaps, 'manifest': self.manifest}
+
+        seg = SegmentWriter(filename)
+        seg.add_blob('meta', pickle.dumps(meta, pickle.HIGHEST_PROTOCOL))
+        seg.add_array('docs', (self.docs[d].encode('utf-8') for d in range(len(self.docs))))
+        seg.add_array('news', (self.news[n].encode('utf-8') for n in range(len(self.news))))
+        seg.add_array('store', self.store.values())
+        seg.add_array('vocab', (w.encode('utf-8') for w in self.vocab))
+        seg.add_table('terms', ((w, array('I', [t]).tobytes()) for w, t in self.terms.items()))
+        # una tabla por campo, p.e. 'index.article' o 'posindex.title'; las claves son
+        # term id (idtable) salvo en los indices de stems
+        for nombre, indices, encode, ids in (('index', self.index, encode_posting, True),
+                                             ('posindex', self.posindex, encode_positional, True),
+                                             ('spindex', self.spindex, encode_posting, False)):
+            for field, indice in indices.items():
+                add = seg.add_idtable if ids else seg.add_table
+                add(f'{nombre}.{field}', ((w, encode(p)) for w, p in indice.items()))
+        for field, pesos in self.weight.items():
+            seg.add_idtable(f'weight.{field}', ((w, array('d', [idf, cota_bm25, cota_tfidf]).tobytes() + tfs.tobytes())
+                                                for w, (idf, tfs, cota_bm25, cota_tfidf) in pesos.items()))
+            longitudes, normas, media = self.weight_doc[field]
+            seg.add_blob(f'weight_doc.{field}', array('d', [media]).tobytes() + normas.tobytes() + longitudes.tobytes())
+        if self.dindex:
+            seg.add_table('dindex', ((d, array('Q', [n for t in tramos for n in t]).tobytes())
+                                     for d, tramos in self.dindex.items()))
+        if self.sindex:
+            seg.add_table('sindex', ((s, array('I', ids).tobytes()) for s, ids in self.sindex.items()))
+        if self.ptindex:
+            seg.add_table('ptindex', ((p, array('I', [t]).tobytes()) for p, t in self.ptindex.items()))
+        if self.kgindex:
+            seg.add_table('kgindex', ((g, encode_posting(p)) for g, p in self.kgindex.items()))
+        seg.close()
+
+
+    def open_segment(self, filename):
+        """
+        Abre un segmento creado con save_segment.
+
+        Los indices no se cargan en memoria: self.index, self.posindex... pasan a ser vistas
+        de solo lectura sobre el fichero proyectado con mmap, y cada consulta solo lee las
+        posting lists que necesita.
+
+        param:  "filename": ruta del segmento
+
+        """
+        seg = Segment(filename)
+        for k, v in pickle.loads(seg.blob('meta')).items():
+            setattr(self, k, v)
+
+        self.docs = seg.array('docs', _decode_str)
+        self.news = seg.array('news', _decode_str)
+        self.store = seg.array('store')
+        self.vocab = seg.array('vocab', _decode_str)
+        self.terms = seg.table('terms', _decode_id)
+        for nombre, decode, ids in (('index', decode_posting, True), ('posindex', decode_positional, True),
+                                    ('spindex', decode_posting, False)):
+            indices = getattr(self, nombre)
+            for field in self.index_fields():
+                if f'{nombre}.{field}' in seg:
+                    abrir = seg.idtable if ids else seg.table
+                    indices[field] = abrir(f'{nombre}.{field}', decode)
+        N = len(self.news)
+        for field in self.index_fields():
+            if f'weight.{field}' in seg:
+                self.weight[field] = seg.idtable(f'weight.{field}', _decode_weight)
+                raw = seg.blob(f'weight_doc.{field}')
+                self.weight_doc[field] = (raw[8 + 8 * N:].cast('I'), raw[8:8 + 8 * N].cast('d'), raw[:8].cast('d')[0])
+        # sin noticias no hay tabla de fechas, pero date: sigue consultando self.dindex
+        self.dindex = seg.table('dindex', _decode_runs) if 'dindex' in seg else SortedTable(())
+        if 'sindex' in seg:
+            self.sindex = seg.table('sindex', _decode_ids)
+        if 'ptindex' in seg:
+            self.ptindex = seg.table('ptindex', _decode_id)
+        if 'kgindex' in seg:
+            self.kgindex = seg.table('kgindex', decode_posting)
+        self.segment = seg
+        self.index_version += 1
+
+
+
+    def make_kgrams(self):
+        """
+        Crea el indice de k-gramas (self.kgindex) para los terminos de todos los indices.
+
+        Cada termino se rodea de '$' ("$termino$") y se añade a la lista de cada uno de
+        sus k-gramas distintos. Las listas guardan el term id del termino y se recorre el
+        vocabulario en orden, por lo que quedan ordenadas y se pueden intersectar con
+        and_postings.
+
+        """
+        k = self.KGRAM
+        kgindex = {}
+        for t, term in enumerate(self.vocab):
+            aux = "$" + term + "$"
+            for g in {aux[i:i+k] for i in range(len(aux) - k + 1)}:
+                kgindex.setdefault(g, []).append(t)
+        self.kgindex = kgindex
 
 
 
@@ -313,19 +1067,38 @@ class SAR_Project:
         print('Número de noticias indexadas: {}'.format(len(self.news)))
         print('----------------------------------------')
         print('TOKENS:')
-        print("\t# tokens en 'index': {}".format(len(self.index.keys())))
+        for field, indice in self.index.items():
+            print("\t# tokens en '{}': {}".format(field, len(indice)))
         print('----------------------------------------')
         if (self.permuterm):
             print('PERMUTERMS:')
-            print(f"\t# tokens en 'ptindex': {len(self.ptindex.keys())}")
+            print(f"\t# tokens en 'ptindex': {len(self.ptindex)}")
+            print(f"\t# {self.KGRAM}-gramas en 'kgindex': {len(self.kgindex)}")
             print('----------------------------------------')
         if (self.stemming):
             print('STEMS:')
-            print(f"\t# tokens en 'sindex': {len(self.sindex.keys())}")
+            print(f"\t# tokens en 'sindex': {len(self.sindex)}")
+            for field, spindex in self.spindex.items():
+                print(f"\t# posting lists precalculadas en 'spindex' de '{field}': {len(spindex)}")
+            print('----------------------------------------')
+        if (self.dindex):
+            print('DATES:')
+            print(f"\t# fechas en 'dindex': {len(self.dindex)}")
             print('----------------------------------------')
         if (self.positional):
             print('POSITIONALS:')
             print(f"Se permiten consultas posicionales")
+            print('----------------------------------------')
+        if (self.bitmaps):
+            print('COMMON TERMS:')
+            for field, n in self.bitmaps.items():
+                print(f"\t# posting lists guardadas como bitmap en '{field}': {n}")
+            print('----------------------------------------')
+        if (self.compress):
+            print('POSTINGS:')
+            for clave, nombre in (('before', 'sin comprimir'), ('after', 'comprimidas')):
+                memoria, disco = self.sizes[clave]
+                print(f"\t{nombre}: {memoria / 2**20:.2f} MB en memoria, {disco / 2**20:.2f} MB en disco")
         print('========================================')
 
         ########################################
@@ -354,153 +1127,445 @@ class SAR_Project:
 
         return: posting list con el resultado de la query
 
-        """
-
-        #normalizamos la query
-        query = query.lower()
-
-        #separamos los parentesis
-        split = ""
-        open = False
-        for i in range(0,len(query)):
-            item=query[i]
-            if item == '(' or item == ')':
-                split = split + " " + item + " "
-            else:
-                if item == '"':
-                    open = not open
-                if item == " " and open:
-                    split = split + "|"
-                else: split = split + item
+        La query se convierte en un arbol (parse_query) respetando la precedencia
+        NOT > AND > OR, se reescribe (plan_query) y se evalua (eval_query) ordenando
+        los operandos por el tamaño estimado de sus posting lists. Los resultados se
+        guardan en self.query_cache usando como clave el arbol reescrito.
 
-        #separamos los diferentes items de la query
-        query = split.split()
-
-        #insertamos para que el primer término haga un OR con una lista vacía (así no hay problemas)
-        query.insert(0,'or')
+        """
 
-        #devolvemos el resultado llamando a un nuevo método que resuelva la query de forma recursiva
-        return self.solve_query2(query,[])
+        #analizamos la query, la reescribimos y la evaluamos
+        with self.stage('parse'):
+            arbol = self.plan_query(self.parse_query(query))
+        with self.stage('cache'):
+            res = self.cached_result(arbol)
+        if self.profile is not None and self.query_cache is not None:
+            self.profile.count('query cache hits' if res is not None else 'query cache misses')
+        if res is None:
+            res = self.eval_plan(arbol)
+            with self.stage('cache'):
+                self.cache_result(arbol, res)
+        return res
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
-    def solve_query2(self,query,prev):
+    def query_tokens(self, query):
         """
-        Resuelve una query de forma recursiva.
+        Separa una query en sus elementos: parentesis, operadores y terminos.
+
+        Las frases entre comillas son un unico termino en el que los espacios se
+        sustituyen por '|' (el formato que espera get_posting).
 
         param:  "query": cadena con la query
-                "prev": parámetro recursivo que almacenará la posting list t1 en (t1 AND/OR t2)
 
-        return: la posting list con el resultado de la query
+        return: lista de elementos de la query, en minusculas
 
+        Si una comilla no tiene su pareja lanza QuerySyntaxError (query_splitter la
+        descartaria y la frase se buscaria como palabras sueltas).
+
+        """
+        if query.count('"') % 2:
+            raise QuerySyntaxError("falta '\"' de cierre en la posicion %d" % (query.rindex('"') + 1))
+        tokens = []
+        for item in self.query_splitter.findall(query.lower()):
+            if '"' in item:
+                item = '|'.join(item.split())
+            tokens.append(item)
+        return tokens
+
+    def parse_query(self, query):
         """
+        Construye el arbol de una query.
 
-        new_query = ""      #query a procesar
-        i=1                 #indica a partir de donde comienza new_query
-        field = 'article'   #campo sobre el que se efectua la query
+        Precedencia de los operadores, de mayor a menor: NEAR/k, NOT, AND, OR. Dos terminos
+        seguidos sin operador se unen con AND. Los operandos de NEAR/k son palabras de un
+        mismo campo, sin comodines ni frases. Los nodos del arbol son tuplas:
 
-        if query is None or len(query) == 0:
-            return prev
-        else:
-            #posting list para hacer "t1 AND/OR t2"
-            t1 = prev
+            ('term', campo, termino)
+            ('near', k, ('term', ...), ('term', ...))
+            ('not', hijo)
+            ('and', (hijo1, hijo2, ...))
+            ('or', (hijo1, hijo2, ...))
 
-            #Analizamos el que va después del AND/OR por si hay que negar el siguiente término
-            if query[1] != 'not' and query[1] != '(':
-                term = query[1]
-                field,term = self.colonSplit(term)
+        param:  "query": cadena con la query
 
-                t2 = self.get_posting(term, field)
-                i=2
+        return: arbol de la query
 
-            elif query[1] != '(': #después del AND/OR hay un 'NOT'
-                term = query[2] #item después del 'NOT'
+        Si la query esta mal formada (falta un operando, sobra o falta un parentesis o un
+        operando de NEAR no es una palabra) lanza QuerySyntaxError.
 
-                if term == '(': #tenemos que negar una consulta entre paréntesis
-                    #resolvemos la consulta entre paréntesis
-                    new_query = self.subconsulta(query[2:len(query)])
-                    new_query.insert(0,'or')
-                    t2_sin_negar = self.solve_query2(new_query,{})
+        """
+        tokens = self.query_tokens(query)
+        arbol, i = self.parse_or(tokens, 0)
+        if i < len(tokens):
+            # parse_or solo se detiene antes del final en un ')' sin su '('
+            raise QuerySyntaxError("')' sin '(' en la posicion %d" % (i + 1))
+        return arbol
+
+    def parse_or(self, tokens, i):
+        """
+        Analiza una secuencia de operandos unidos por OR a partir de la posicion "i".
 
-                    #negamos la consulta
-                    t2 = self.reverse_posting(t2_sin_negar)
+        return: tupla (nodo, posicion siguiente)
 
-                    #longitud de la subquery + 2 paréntesis + 'NOT' + 1 (contado en la subquery por 'OR')
-                    i = len(new_query)+3
-                else: #negamos solo un término
-                    field,term = self.colonSplit(term)
+        """
+        hijos = []
+        nodo, i = self.parse_and(tokens, i)
+        hijos.append(nodo)
+        while i < len(tokens) and tokens[i] == 'or':
+            nodo, i = self.parse_and(tokens, i + 1)
+            hijos.append(nodo)
+        return (hijos[0] if len(hijos) == 1 else ('or', tuple(hijos))), i
+
+    def parse_and(self, tokens, i):
+        """
+        Analiza una secuencia de operandos unidos por AND a partir de la posicion "i".
 
-                    t2 = self.reverse_posting(self.get_posting(term, field))
-                    i=3
-            else: #es un '('
-                #obtenemos la consulta entre paréntesis
-                new_query = self.subconsulta(query[1:len(query)])
-                new_query.insert(0,'or')
-                t2 = self.solve_query2(new_query,{})
+        return: tupla (nodo, posicion siguiente)
 
-                #longitud de la subquery + paréntesis + 1 (contado por 'OR' en len(new_query))
-                i = len(new_query)+2
+        """
+        hijos = []
+        nodo, i = self.parse_not(tokens, i)
+        hijos.append(nodo)
+        while i < len(tokens) and tokens[i] not in ('or', ')'):
+            if tokens[i] == 'and':
+                i += 1
+            nodo, i = self.parse_not(tokens, i)
+            hijos.append(nodo)
+        return (hijos[0] if len(hijos) == 1 else ('and', tuple(hijos))), i
+
+    def parse_not(self, tokens, i):
+        """
+        Analiza un operando, posiblemente negado, a partir de la posicion "i".
 
-            #Actualizamos la lista según operador
-            if query[0] == 'and':
-                prev = self.and_posting(t1,t2)
-            elif query[0] == 'or':
-                prev = self.or_posting(t1,t2)
+        return: tupla (nodo, posicion siguiente)
 
-        #Actualizamos la posición desde donde empezará la siguiente parte
-        new_query = query[i:len(query)]
+        """
+        negaciones = 0
+        while i < len(tokens) and tokens[i] == 'not':
+            negaciones += 1
+            i += 1
+
+        if i >= len(tokens):
+            raise QuerySyntaxError("falta un operando al final de la query")
+        if tokens[i] in ('and', 'or', ')') or re.fullmatch(r'near/\d+', tokens[i]):
+            raise QuerySyntaxError("falta un operando antes de '%s' (posicion %d)" % (tokens[i], i + 1))
+        if tokens[i] == '(':
+            nodo, i = self.parse_or(tokens, i + 1)
+            if i >= len(tokens):
+                raise QuerySyntaxError("falta ')'")
+            i += 1
+        else:
+            field, term = self.colonSplit(tokens[i])
+            nodo = ('term', field, term)
+            i += 1
+            # proximidad: 'a NEAR/k b NEAR/j c' es (a NEAR/k b) AND (b NEAR/j c)
+            cercanos = []
+            while i < len(tokens):
+                op = re.fullmatch(r'near/(\d+)', tokens[i])
+                if op is None:
+                    break
+                if i + 1 >= len(tokens) or tokens[i + 1] in ('(', ')', 'and', 'or', 'not'):
+                    raise QuerySyntaxError("falta el termino despues de '%s' (posicion %d)" % (tokens[i], i + 1))
+                field, term = self.colonSplit(tokens[i + 1])
+                siguiente = ('term', field, term)
+                # get_near solo busca las posiciones de dos palabras de un mismo campo
+                for t in (nodo, siguiente):
+                    if '*' in t[2] or '?' in t[2] or '"' in t[2]:
+                        raise QuerySyntaxError("NEAR solo admite palabras, no comodines ni frases: '%s'" % t[2].replace('|', ' '))
+                if nodo[1] != siguiente[1]:
+                    raise QuerySyntaxError("los terminos de '%s' deben ser del mismo campo" % tokens[i])
+                cercanos.append(('near', int(op.group(1))) + tuple(sorted((nodo, siguiente))))
+                nodo = siguiente
+                i += 2
+            if cercanos:
+                nodo = cercanos[0] if len(cercanos) == 1 else ('and', tuple(cercanos))
+
+        for _ in range(negaciones):
+            nodo = ('not', nodo)
+        return nodo, i
+
+    def plan_query(self, nodo, negado=False):
+        """
+        Reescribe el arbol de una query para evaluarlo de forma eficiente.
 
-        #devolvemos recursivamente
-        return self.solve_query2(new_query,prev)
+        - Los NOT se bajan hasta los terminos (leyes de De Morgan) y se eliminan las dobles negaciones.
+        - Los AND y OR anidados del mismo tipo se aplanan en un unico nodo, se quitan los operandos
+          repetidos y el resto se ordena de forma canonica.
 
-    def colonSplit(self,term):
-        """
-        Calcula el nuevo campo y recalcula el nuevo término
+        El orden de evaluacion de los operandos se decide en eval_query.
 
-        param:  "term": término a consultar
+        param:  "nodo": arbol de la query
+                "negado": si el nodo esta afectado por un numero impar de NOT
 
-        return: una tupla (field,term) con el campo y término correspondientes
+        return: arbol reescrito
 
         """
+        tipo = nodo[0]
+        if tipo == 'not':
+            return self.plan_query(nodo[1], not negado)
+        if tipo in ('term', 'near'):
+            return ('not', nodo) if negado else nodo
+
+        op = tipo
+        if negado:
+            op = 'or' if tipo == 'and' else 'and'
+        hijos = []
+        for h in nodo[1]:
+            h = self.plan_query(h, negado)
+            if h[0] == op:
+                hijos.extend(h[1])
+            else:
+                hijos.append(h)
+        #orden canonico de los operandos (los nodos son tuplas comparables),
+        #asi 'a AND b' y 'b AND a' dan el mismo arbol
+        hijos = tuple(sorted(set(hijos)))
+        if len(hijos) == 1:
+            return hijos[0]
+        return (op, hijos)
+
+    def estimate(self, nodo):
+        """
+        Estima el numero de noticias que devuelve un nodo del arbol de una query.
 
-        field = 'article'
-        colonSplit = term.split(':')
-        if len(colonSplit) == 2:
-            field = colonSplit[0]
-            term = colonSplit[1]
+        Para los terminos normales es la longitud de su posting list. Para comodines,
+        stemming o terminos que no se pueden estimar sin resolverlos se supone que
+        devuelven todas las noticias, de forma que se evaluan los ultimos.
 
-        return field,term
+        param:  "nodo": nodo del arbol
+
+        return: numero estimado de noticias
 
-    def subconsulta(self,query):
         """
-        Obtiene la subconsulta entre paréntesis
+        total = len(self.news)
+        tipo = nodo[0]
+        if tipo == 'term':
+            field, term = nodo[1], nodo[2]
+            if field == 'date':
+                return sum(fin - ini for ini, fin in self.date_runs(term))
+            if '*' in term or '?' in term or self.use_stemming:
+                return total
+            if term.startswith('"'):
+                return min(self.estimate(('term', field, t)) for t in term.strip('"').split('|'))
+            posting = self.index.get(field, {}).get(self.index_key(term))
+            return len(posting) if posting is not None else 0
+        if tipo == 'near':
+            return min(self.estimate(nodo[2]), self.estimate(nodo[3]))
+        if tipo == 'not':
+            return total - self.estimate(nodo[1])
+        if tipo == 'and':
+            return min([self.estimate(h) for h in nodo[1] if h[0] != 'not'] + [total])
+        return min(total, sum(self.estimate(h) for h in nodo[1]))
+
+    def eval_plan(self, arbol):
+        """
+        Evalua el arbol completo de una query (ver eval_query).
+        """
+        return self.eval_query(arbol)
 
-        param:  "query": la consulta sobre la que realizar la subconsulta
+    def eval_query(self, nodo, memo=None):
+        """
+        Evalua el arbol de una query (ya reescrito con plan_query).
 
-        return: la subconsulta entre los paréntesis exteriores
+        - AND: se evaluan primero los operandos con menos resultados estimados y despues se
+          restan los negados, sin calcular nunca su complemento. Si un resultado intermedio
+          queda vacio no se evalua el resto de operandos.
+        - OR: se unen todos los operandos a la vez (or_postings) y se para si alguno ya
+          contiene todas las noticias.
+        - NOT: solo se calcula el complemento cuando no queda otra opcion (p.e. 'a OR NOT b').
 
-        """
+        param:  "nodo": arbol de la query
+                "memo": diccionario nodo --> posting list con los nodos ya evaluados, para
+                        compartir subexpresiones entre varias queries (ver solve_batch)
 
-        j = 0 #contador de subconsultas
+        return: posting list con el resultado
 
-        #calcular donde acaba la subconsulta
-        for i in range (0,len(query)):
-            if query[i] == '(': j = j+1 #se abre subconsulta
-            if query[i] == ')': j = j-1 #se cierra subconsulta
-            if(j==0): break #se ha cerrado el primer paréntesis
+        Si la instrumentacion esta activada (set_profile) cada nodo se anota en el plan de
+        self.profile con su tiempo y su numero de resultados.
 
-        return query[1:i]
+        """
+        if self.profile is not None:
+            return self.profile.node(nodo, self.node_stage(nodo), self.estimate(nodo),
+                                     lambda: self.eval_node(nodo, memo))
+        return self.eval_node(nodo, memo)
 
-    def get_posting(self, term, field='article'):
+    def eval_node(self, nodo, memo=None):
         """
-        NECESARIO PARA TODAS LAS VERSIONES
+        Evalua un nodo del arbol de una query, ver eval_query.
+        """
+        if memo is not None and nodo in memo:
+            return memo[nodo]
 
-        Devuelve la posting list asociada a un termino.
-        Dependiendo de las ampliaciones implementadas "get_posting" puede llamar a:
-            - self.get_positionals: para la ampliacion de posicionales
-            - self.get_permuterm: para la ampliacion de permuterms
+        tipo = nodo[0]
+        if tipo == 'term':
+            res = self.get_posting(nodo[2], nodo[1])
+
+        elif tipo == 'near':
+            res = self.get_near(nodo[2], nodo[3], nodo[1])
+
+        elif tipo == 'not':
+            res = self.reverse_posting(self.eval_query(nodo[1], memo))
+
+        elif tipo == 'and':
+            positivos = sorted((h for h in nodo[1] if h[0] != 'not'), key=self.estimate)
+            negativos = sorted((h[1] for h in nodo[1] if h[0] == 'not'), key=self.estimate, reverse=True)
+            if not positivos:
+                #NOT a AND NOT b == NOT (a OR b): un unico complemento
+                res = self.reverse_posting(self.eval_query(('or', tuple(negativos)), memo))
+            else:
+                res = self.eval_query(positivos[0], memo)
+                for h in positivos[1:]:
+                    if len(res) == 0:
+                        break
+                    res = self.and_posting(res, self.eval_query(h, memo))
+                for h in negativos:
+                    if len(res) == 0:
+                        break
+                    res = self.minus_posting(res, self.eval_query(h, memo))
+
+        else:
+            postings = []
+            total = len(self.news)
+            for h in sorted(nodo[1], key=self.estimate):
+                p = self.eval_query(h, memo)
+                if len(p) == total:
+                    #ya estan todas las noticias
+                    postings = [p]
+                    break
+                postings.append(p)
+            res = self.or_postings(postings)
+
+        if memo is not None:
+            memo[nodo] = res
+        return res
+
+    def node_stage(self, nodo):
+        """
+        Etapa de la instrumentacion a la que se atribuye el tiempo propio de un nodo del
+        arbol: la forma de obtener la posting list de un termino (como en get_posting),
+        'positional' para NEAR y 'merge' para los AND, OR y NOT.
+        """
+        tipo = nodo[0]
+        if tipo == 'near':
+            return 'positional'
+        if tipo != 'term':
+            return 'merge'
+        field, term = nodo[1], nodo[2]
+        if field == 'date':
+            return 'dates'
+        if "*" in term or "?" in term:
+            return 'permuterm'
+        if term.startswith('"'):
+            return 'positional'
+        if self.use_stemming:
+            return 'stemming'
+        return 'postings'
+
+    def cached_result(self, arbol):
+        """
+        Busca en la cache el resultado de una query ya reescrita con plan_query.
+
+        La clave es el arbol (que ya esta normalizado: minusculas, campos, orden de los
+        operandos) junto con el modo de stemming. Si el indice ha cambiado desde que se
+        guardaron los resultados la cache se vacia.
+
+        param:  "arbol": arbol de la query
+
+        return: posting list del resultado o None si no esta en la cache
+
+        """
+        if self.query_cache is None:
+            return None
+        return self.query_cache.get((arbol, self.use_stemming), self.index_version)
+
+    def cache_result(self, arbol, res):
+        """
+        Guarda en la cache el resultado de una query (ver cached_result).
+        """
+        if self.query_cache is not None:
+            self.query_cache.put((arbol, self.use_stemming), res, posting_nbytes(res), self.index_version)
+
+    def solve_batch(self, queries, workers=1):
+        """
+        Resuelve un lote de queries compartiendo el trabajo comun.
+
+        Todas las queries se analizan y reescriben antes de evaluar ninguna; los nodos
+        iguales (mismos terminos o mismas subexpresiones, sin importar el orden de los
+        operandos de AND y OR) se evaluan una unica vez para todo el lote.
+
+        Como en solve_query, los resultados se buscan y se guardan en self.query_cache.
+        Si "workers" es mayor que 1 las queries que no estan en la cache se reparten en
+        bloques entre varios procesos, cada uno con su propia cache de subexpresiones. Solo
+        se hace si el sistema permite crear los procesos con fork (para que hereden el indice
+        sin copiarlo).
+
+        param:  "queries": lista de cadenas con las queries
+                "workers": numero de procesos a utilizar
+
+        return: lista con la posting list del resultado de cada query, en el mismo orden, o
+                None si la query esta mal formada (solve_and_show la vuelve a analizar y
+                muestra el error)
+
+        """
+        arboles = []
+        for q in queries:
+            try:
+                arboles.append(self.plan_query(self.parse_query(q)))
+            except QuerySyntaxError:
+                arboles.append(None)
+
+        # solo se evaluan (una vez) las queries que no estan en la cache de resultados
+        resultados = [None if arbol is None else self.cached_result(arbol) for arbol in arboles]
+        pendientes = list(dict.fromkeys(arbol for arbol, res in zip(arboles, resultados)
+                                        if arbol is not None and res is None))
+
+        if workers > 1 and len(pendientes) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            global _batch_project
+            _batch_project = self
+            tam = math.ceil(len(pendientes) / workers)
+            bloques = [pendientes[i:i + tam] for i in range(0, len(pendientes), tam)]
+            try:
+                with multiprocessing.get_context('fork').Pool(workers) as pool:
+                    calculados = [res for parcial in pool.imap(_solve_chunk, bloques) for res in parcial]
+            finally:
+                _batch_project = None
+        else:
+            memo = {}
+            calculados = [self.eval_query(arbol, memo) for arbol in pendientes]
+
+        calculados = dict(zip(pendientes, calculados))
+        for arbol, res in calculados.items():
+            self.cache_result(arbol, res)
+        return [calculados.get(arbol) if res is None else res for arbol, res in zip(arboles, resultados)]
+
+    def colonSplit(self,term):
+        """
+        Calcula el nuevo campo y recalcula el nuevo término
+
+        param:  "term": término a consultar
+
+        return: una tupla (field,term) con el campo y término correspondientes
+
+        """
+
+        field = 'article'
+        colonSplit = term.split(':')
+        if len(colonSplit) == 2:
+            field = colonSplit[0]
+            term = colonSplit[1]
+
+        return field,term
+
+    def get_posting(self, term, field='article'):
+        """
+        NECESARIO PARA TODAS LAS VERSIONES
+
+        Devuelve la posting list asociada a un termino.
+        Dependiendo de las ampliaciones implementadas "get_posting" puede llamar a:
+            - self.get_positionals: para la ampliacion de posicionales
+            - self.get_permuterm: para la ampliacion de permuterms
             - self.get_stemming: para la amplaicion de stemming
 
 
@@ -518,21 +1583,26 @@ class SAR_Project:
 
         res = []
 
+        #Fechas y rangos de fechas ('date:2015-01-02..2015-03-31'): solo estan en el indice de fechas
+        if field == 'date':
+            res = self.get_dates(termAux)
+
         #Comprobamos si se debe realizar permuterms
-        if ("*" in termAux or "?" in termAux):
+        elif ("*" in termAux or "?" in termAux):
             res = self.get_permuterm(termAux,field)
 
-        if termAux[0] == '"' and termAux[-1] == '"':
+        elif len(termAux) > 1 and termAux[0] == '"' and termAux[-1] == '"':
             var = termAux.replace('"',"")
-            res = self.get_positionals(var.split("|"))
+            res = self.get_positionals(var.split("|"), field)
         #Comprobamos si se debe realizar stemming
-        elif (self.use_stemming):
+        elif self.use_stemming:
             res = self.get_stemming(term, field)
 
         #Caso estándar
-        elif (termAux in self.index):
-            for t in self.index[termAux]:
-                res = self.index[termAux]
+        else:
+            res = self.index.get(field, {}).get(self.index_key(termAux), [])
+            if self.profile is not None:
+                self.profile.postings([res])
         return res
 
         ########################################
@@ -541,6 +1611,64 @@ class SAR_Project:
 
 
 
+    def date_runs(self, term):
+        """
+        Devuelve los tramos de newid de las noticias con una fecha o un rango de fechas.
+
+        param:  "term": fecha ('2015-01-02') o rango de fechas ('2015-01-02..2015-03-31'),
+                        en un rango se puede omitir el principio o el final ('2015-03-01..');
+                        tambien se admiten comodines ('2015-01-*')
+
+        return: lista de tramos (ini, fin) ordenados y sin solapamientos, los tramos
+                contiguos se unen en uno
+
+        """
+        tramos = []
+        if '*' in term or '?' in term:
+            patron = self.wildcard_regex(term)
+            for fecha, lista in self.dindex.items():
+                if patron.fullmatch(fecha):
+                    tramos.extend(lista)
+        else:
+            if '..' in term:
+                ini, fin = term.split('..', 1)
+            else:
+                ini = fin = term
+            i = self.dindex.bisect_left(ini)
+            while i < len(self.dindex) and (not fin or self.dindex.key_at(i) <= fin):
+                tramos.extend(self.dindex.value_at(i))
+                i += 1
+        tramos.sort()
+
+        res = []
+        for ini, fin in tramos:
+            if res and res[-1][1] == ini:
+                res[-1] = (res[-1][0], fin)
+            else:
+                res.append((ini, fin))
+        return res
+
+
+    def get_dates(self, term):
+        """
+        Devuelve la posting list de las noticias con una fecha o un rango de fechas (ver date_runs).
+
+        Como los newid se asignan fichero a fichero, un rango de fechas suele ser un unico
+        tramo de newid consecutivos; el resultado es un Bitmap construido directamente con
+        los tramos, y el AND con la posting list de un termino solo tiene que consultarlo.
+
+        param:  "term": fecha o rango de fechas
+
+        return: posting list (Bitmap)
+
+        """
+        size = len(self.news)
+        bits = 0
+        for ini, fin in self.date_runs(term):
+            bits |= Bitmap.from_range(ini, fin, size).bits
+        return Bitmap(bits, size)
+
+
     def get_positionals(self, terms, field='article'):
         """
         NECESARIO PARA LA AMPLIACION DE POSICIONALES
@@ -553,39 +1681,129 @@ class SAR_Project:
         return: posting list
 
         """
-        pos = -1
-        docs = []
-        res = []
-        for i in terms:
-            if i in self.posindex.keys():
-                docs.append(list(sorted(self.posindex[i].keys())))
-            else:
+        return self.positional_merge(terms, field, self.phrase_match)
+
+
+    def get_near(self, t1, t2, k):
+        """
+        Devuelve la posting list de las noticias en las que dos terminos aparecen a una
+        distancia de como mucho "k" posiciones, en cualquier orden ('a NEAR/k b').
+
+        param:  "t1", "t2": nodos 'term' del arbol de la query, palabras del mismo campo
+                (parse_query rechaza los comodines, las frases y los campos distintos)
+                "k": distancia maxima
+
+        return: posting list
+
+        """
+        if t1[1] != t2[1]:
+            return []
+        return self.positional_merge([t1[2], t2[2]], t1[1],
+                                     lambda listas: self.near_match(listas[0], listas[1], k))
+
+
+    def positional_merge(self, terms, field, match):
+        """
+        Recorre en paralelo las posting lists posicionales de varios terminos y devuelve
+        las noticias en las que aparecen todos y en las que sus posiciones cumplen "match".
+
+        Si las posting lists posicionales estan sin comprimir se intersectan las posting
+        lists de los terminos (and_postings) y se consultan las posiciones de cada noticia
+        del resultado. Si estan comprimidas se recorren en paralelo (ordenadas por newid):
+        se avanza cada una hasta el mayor newid actual y, cuando todas coinciden, se
+        comprueban las posiciones.
+
+        param:  "terms": lista de terminos (cadenas)
+                "field": campo del indice posicional
+                "match": funcion que recibe la lista ordenada de posiciones de cada termino
+
+        return: posting list
+
+        """
+        posindex = self.posindex.get(field, {})
+        terms = [self.index_key(t) for t in terms]
+        for t in terms:
+            if t not in posindex:
                 return []
-        prev = docs.pop(0)
-        while docs != []:
-            d = docs.pop(0)
-            prev = self.and_posting(prev,d)
-        for d in prev:
-            posis = [self.posindex[w][d] for w in terms]
-
-            for i in posis[0]:
-                start = 1
-                n = i
-                while start <= len(posis):
-                    if start == len(posis):
-                        if d not in res:
-                            res.append(d)
-                            break
-                        else: 
-                            break
-                    elif n+1 in posis[start]:
-                        start += 1
-                        n+=1
-                    else:
-                        break
+
+        posis = [posindex[t] for t in terms]
+        if self.profile is not None:
+            self.profile.postings(posis)
+        if all(isinstance(p, dict) for p in posis):
+            # sin comprimir: las noticias candidatas son el AND de las posting lists
+            # de los terminos y las posiciones de cada una se consultan directamente
+            indice = self.index[field]
+            return [n for n in self.and_postings([indice[t] for t in terms])
+                    if match([p[n] for p in posis])]
+
+        iters = [iter(p.items()) for p in posis]
+        res = []
+        try:
+            actual = [next(it) for it in iters]
+            while True:
+                maximo = max(n for n, _ in actual)
+                for k, it in enumerate(iters):
+                    while actual[k][0] < maximo:
+                        actual[k] = next(it)
+                if all(n == maximo for n, _ in actual):
+                    if match([pos for _, pos in actual]):
+                        res.append(maximo)
+                    actual = [next(it) for it in iters]
+        except StopIteration:
+            pass
         return res
 
 
+    def phrase_match(self, listas):
+        """
+        Comprueba si hay una posicion p tal que el termino k-esimo aparece en p + k.
+
+        Las posiciones de inicio posibles se van intersectando con las de cada termino
+        (desplazadas k posiciones) con una mezcla lineal de listas ordenadas.
+
+        param:  "listas": lista ordenada de posiciones de cada termino de la frase
+
+        return: True si los terminos aparecen consecutivos
+
+        """
+        inicios = listas[0]
+        for k in range(1, len(listas)):
+            lista = listas[k]
+            res = []
+            i = j = 0
+            while i < len(inicios) and j < len(lista):
+                a = inicios[i]
+                b = lista[j] - k
+                if a == b:
+                    res.append(a)
+                    i += 1
+                    j += 1
+                elif a < b:
+                    i += 1
+                else:
+                    j += 1
+            if not res:
+                return False
+            inicios = res
+        return len(inicios) > 0
+
+
+    def near_match(self, p1, p2, k):
+        """
+        Comprueba con una mezcla lineal si dos listas ordenadas de posiciones tienen
+        dos elementos a distancia de como mucho "k".
+        """
+        i = j = 0
+        while i < len(p1) and j < len(p2):
+            if abs(p1[i] - p2[j]) <= k:
+                return True
+            if p1[i] < p2[j]:
+                i += 1
+            else:
+                j += 1
+        return False
+
+
 
 
 
@@ -604,19 +1822,24 @@ class SAR_Project:
 
         """
         # Generamos el stem del término
-        stem = self.stemmer.stem(term)
-        res = []
+        stem = self.stem(term)
+
+        # Si se ha precalculado, la posting list del stem es una unica consulta
+        if field in self.spindex:
+            res = self.spindex[field].get(stem, [])
+            if self.profile is not None:
+                self.profile.postings([res])
+            return res
 
         # Búscamos si el stem está indexado
+        indice = self.index.get(field, {})
         if (stem in self.sindex):
-            # Devolvemos la posting list asociada al stem
-            words = self.sindex[stem]
-            for w in words:
-                if w in self.index:
-                    res = self.or_posting(res,self.index[w])
-
-
-        return res
+            # Unimos de una vez las posting lists de todos los terminos del stem
+            listas = [indice[t] for t in self.sindex[stem] if t in indice]
+            if self.profile is not None:
+                self.profile.postings(listas)
+            return self.or_postings(listas)
+        return []
 
 
     def get_permuterm(self, term, field='article'):
@@ -625,71 +1848,127 @@ class SAR_Project:
 
         Devuelve la posting list asociada a un termino utilizando el indice permuterm.
 
-        param:  "term": termino para recuperar la posting list, "term" incluye un comodin (* o ?).
+        param:  "term": termino para recuperar la posting list, "term" incluye uno o varios comodines (* o ?).
                 "field": campo sobre el que se debe recuperar la posting list, solo necesario se se hace la ampliacion de multiples indices
 
         return: posting list
 
         """
-        i=0
-        res=[]
-        resprov=[]
-        if("*" in term):
-            for simbolo in term:
-                if(simbolo=="*"):
-                    break
-                i=i+1
-
-            ini=term[0:i]
-            fin=term[i+1:len(term)]
-            for permuterms in self.ptindex.keys():
-                if(permuterms[0]=="$"):
-                    pterms=["",permuterms[1:]]
-                elif(permuterms[len(permuterms)-1]=="$"):
-                    pterms=[permuterms[:-1],""]
-                else:
-                    pterms=permuterms.split("$")
-                if(pterms[0].endswith(fin) & pterms[1].startswith(ini)):
-                    w=self.ptindex[permuterms]
-                    if(w not in res):
-                        resprov.append(w)
-            
-            for w in resprov:
-                lista=self.get_posting(w)
-                res=self.or_posting(res,lista)
+        #unimos de una vez las posting lists de todos los terminos que encajan con el comodin
+        indice = self.index.get(field, {})
+        listas = [indice[w] for w in self.wildcard_terms(term, field)]
+        if self.profile is not None:
+            self.profile.postings(listas)
+        return self.or_postings(listas)
+
+
+    def wildcard_terms(self, term, field='article'):
+        """
+        Devuelve las claves del indice de un campo (term id, ver index_key) de los terminos
+        que encajan con un patron con comodines.
+
+        Con un unico comodin se usa el indice permuterm (permuterm_terms). Con varios
+        comodines (p.e. 'pre*mid*suf' o 'c?nari?s') se usa el indice de k-gramas
+        (kgram_terms). Ambos se construyen sobre el diccionario de terminos compartido por
+        todos los campos, asi que despues se descartan los terminos que no estan en el campo.
+        Si no se ha creado ninguno de los dos indices se recorre el vocabulario.
+
+        param:  "term": patron con uno o varios comodines (* o ?)
+                "field": campo en el que se buscan los terminos
+
+        return: lista de claves del indice del campo
+
+        """
+        indice = self.index.get(field, {})
+        comodines = term.count("*") + term.count("?")
+        patron = self.wildcard_regex(term)
+        if comodines == 1 and self.ptindex:
+            terminos = self.permuterm_terms(term)
+        elif self.kgindex:
+            terminos = self.kgram_terms(term)
         else:
-            for simbolo in term:
-                if(simbolo=="?"):
-                    break
-                i=i+1
+            terminos = [t for t in range(len(self.vocab)) if patron.fullmatch(self.vocab[t])]
+        return [t for t in terminos if t in indice]
 
-            ini=term[0:i]
-            fin=term[i+1:len(term)]
 
-            for permuterms in self.ptindex.keys():
-                if(permuterms[0]=="$"):
-                    pterms=["",permuterms[1:]]
-                elif(permuterms[len(permuterms)-1]=="$"):
-                    pterms=[permuterms[:-1],""]
-                else:
-                    pterms=permuterms.split("$")
-                if(pterms[0].endswith(fin) & pterms[1].startswith(ini)):
-                    w=self.ptindex[permuterms]
-                    if(w not in res and len(w)==len(term)):
-                        resprov.append(w)
-            for w in resprov:
-                lista=self.get_posting(w)
-                res=self.or_posting(res,lista)
+    def wildcard_regex(self, term):
+        """
+        Expresion regular equivalente a un patron con comodines: '*' es cualquier
+        secuencia de caracteres y '?' un unico caracter.
+        """
+        return re.compile("".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in term))
+
+
+    def kgram_terms(self, term):
+        """
+        Devuelve los term id de los terminos que encajan con un patron usando el indice de k-gramas.
+
+        Los fragmentos fijos del patron (con '$' marcando el principio y el final del termino)
+        se parten en k-gramas; los terminos candidatos son la interseccion de las listas de
+        esos k-gramas, y despues se comprueba cada candidato con la expresion regular del patron.
 
+        param:  "term": patron con uno o varios comodines (* o ?)
 
-            # #if permuterms.startswith(ini) and permuterms.endswith(fin):
-            #    # l = self.get_posting(permuterms)
-            #     for i in l:
-            #         res.append(i)
+        return: lista de term id
 
+        """
+        k = self.KGRAM
+        listas = []
+        for fragmento in re.split(r"[*?]", "$" + term + "$"):
+            for i in range(len(fragmento) - k + 1):
+                lista = self.kgindex.get(fragmento[i:i+k])
+                if lista is None:
+                    return []
+                listas.append(lista)
+
+        if listas:
+            candidatos = self.and_postings(listas)
+        else:
+            candidatos = range(len(self.vocab))
+
+        patron = self.wildcard_regex(term)
+        res = []
+        for t in candidatos:
+            if patron.fullmatch(self.vocab[t]):
+                res.append(t)
         return res
 
 
+    def permuterm_terms(self, term):
+        """
+        Devuelve los term id de los terminos que encajan con un termino con un comodin.
+
+        "ini*fin" encaja con los terminos cuya rotacion empieza por "fin$ini", que estan
+        todas seguidas en el indice permuterm ordenado: basta una busqueda binaria y
+        recorrer el rango. Con '?' se hace la misma busqueda y despues se exige que el
+        termino tenga la misma longitud que el patron.
+
+        param:  "term": termino con un comodin (* o ?)
+
+        return: lista de term id
+
+        """
+        if not self.ptindex:
+            return []
+        comodin = "*" if "*" in term else "?"
+        i = term.index(comodin)
+        ini = term[:i]
+        fin = term[i+1:]
+        prefijo = fin + "$" + ini
+
+        res = []
+        j = self.ptindex.bisect_left(prefijo)
+        while j < len(self.ptindex):
+            if not self.ptindex.key_at(j).startswith(prefijo):
+                break
+            t = self.ptindex.value_at(j)
+            if comodin == "*" or len(self.vocab[t]) == len(term):
+                res.append(t)
+            j += 1
+        #un termino puede aparecer en varias rotaciones del rango (p.e. 'a*' y 'aa')
+        return list(dict.fromkeys(res))
+
+
     def reverse_posting(self, p):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -705,12 +1984,9 @@ class SAR_Project:
 
         """
 
-        #Obtenemos una posting list con todas las noticias diferentes
-        res = list(self.news.keys())
-
-        #Procedemos a quitar aquellas que están incluidas en p
-
-        return self.minus_posting(res, p)
+        #El complemento se calcula como un bitmap sobre todos los newid,
+        #sin crear la lista con todas las noticias
+        return Bitmap.from_posting(p, len(self.news)).invert()
 
 
         ########################################
@@ -719,6 +1995,24 @@ class SAR_Project:
 
 
 
+    def numpy_ok(self, op, *postings):
+        """
+        Indica si conviene operar las posting lists con NumPy: esta instalado y activado,
+        ninguna es un Bitmap y todas tienen al menos NUMPY_MIN[op] elementos. Por debajo de
+        esa longitud convertir las listas a arrays cuesta mas que mezclarlas en python.
+
+        param:  "op": operacion, 'and', 'or' o 'minus'
+                "postings": posting lists sobre las que se va a operar
+
+        return: True si se debe usar NumPy
+
+        """
+        if numpy is None or not self.use_numpy:
+            return False
+        return all(len(p) >= NUMPY_MIN[op] and not isinstance(p, Bitmap) for p in postings)
+
+
+
     def and_posting(self, p1, p2):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -735,22 +2029,73 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            return self.bitmap_posting('and', p1, p2)
+
+        # Si una lista es mucho mas corta que la otra, buscamos sus elementos en la
+        # larga con un cursor (galloping sobre listas, punteros de salto si esta comprimida)
+        if len(p1) > len(p2):
+            p1, p2 = p2, p1
+        if len(p1) * GALLOP_RATIO < len(p2):
+            respuesta = []
+            cursor = PostingCursor(p2)
+            for a in p1:
+                b = cursor.next_geq(a)
+                if b is None:
+                    break
+                if a == b:
+                    respuesta.append(a)
+            return respuesta
+
+        if self.numpy_ok('and', p1, p2):
+            return np_and([p1, p2])
+
+        # Si no, mezcla lineal. Se recorren con iteradores para poder consumir
+        # directamente tanto listas como posting lists comprimidas
         respuesta = []
-        i = 0
-        j = 0
-        while len(p1)> i and len(p2)>j:
-            if p1[i] == p2[j]:
-                respuesta.append(p1[i])
-                i = i + 1
-                j = j + 1
-            elif p1[i] < p2[j]:
-                i = i + 1
+        it1 = iter(p1)
+        it2 = iter(p2)
+        a = next(it1, None)
+        b = next(it2, None)
+        while a is not None and b is not None:
+            if a == b:
+                respuesta.append(a)
+                a = next(it1, None)
+                b = next(it2, None)
+            elif a < b:
+                a = next(it1, None)
             else:
-                j = j + 1
+                b = next(it2, None)
         return respuesta
 
 
 
+    def and_postings(self, postings):
+        """
+        Calcula el AND de varias posting lists.
+
+        Las listas se intersectan de la mas corta a la mas larga, de forma que el resultado
+        parcial es siempre lo mas pequeño posible y and_posting puede buscar sus elementos
+        en las listas largas sin recorrerlas enteras.
+
+        param:  "postings": lista de posting lists
+
+        return: posting list con los newid incluidos en todas las posting lists
+
+        """
+        if not postings:
+            return []
+        postings = sorted(postings, key=len)
+        res = postings[0]
+        for p in postings[1:]:
+            if len(res) == 0:
+                break
+            res = self.and_posting(res, p)
+        # el AND de varios terminos frecuentes (ver make_common) se queda como Bitmap
+        return res if isinstance(res, Bitmap) else list(res)
+
+
+
     def or_posting(self, p1, p2):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -766,38 +2111,44 @@ class SAR_Project:
 
 
 
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            return self.bitmap_posting('or', p1, p2)
+
+        if self.numpy_ok('or', p1, p2):
+            return np_or([p1, p2])
+
         res=[]
-        i=0
-        j=0
+        it1 = iter(p1)
+        it2 = iter(p2)
+        a = next(it1, None)
+        b = next(it2, None)
 
         #mientras no acaben las posting list:
-        while(i < len(p1) and j < len(p2)):
+        while(a is not None and b is not None):
             #sii el elemento de p1 == p2:
-            if(p1[i]==p2[j]):
+            if(a==b):
                 #se añade y avanzamos ambas posting list
-                res.append(p1[i])
-                i+=1
-                j+=1
+                res.append(a)
+                a = next(it1, None)
+                b = next(it2, None)
             #sii el elemento de p1 < p2:
-            elif(p1[i]<p2[j]):
-                #se añade y avanzamos ambas posting list
-                res.append(p1[i])
-                i+=1
+            elif(a<b):
+                #se añade y avanzamos SOLO p1
+                res.append(a)
+                a = next(it1, None)
             #sii el elemento de p2 <= p1:
             else:
                 #se añade y avanzamos SOLO p2
-                res.append(p2[j])
-                j+=1
-
-            #mientras no acaben las posting list se añaden a la variable res
-        while(i<len(p1)):
-                #se añade y avanzamos hasta finalizar
-                res.append(p1[i])
-                i+=1
-        while(j<len(p2)):
-                #se añade y avanzamos hasta finalizar
-                res.append(p2[j])
-                j+=1
+                res.append(b)
+                b = next(it2, None)
+
+        #se añade lo que quede de la posting list que no ha acabado
+        if a is not None:
+            res.append(a)
+            res.extend(it1)
+        if b is not None:
+            res.append(b)
+            res.extend(it2)
 
         return res
         ########################################
@@ -805,6 +2156,41 @@ class SAR_Project:
         ########################################
 
 
+    def or_postings(self, postings):
+        """
+        Calcula el OR de varias posting lists.
+
+        Con mas de dos listas se hace una unica mezcla de k vias con un heap (o con NumPy,
+        ver np_or), en lugar de k-1 mezclas sucesivas que recorren una y otra vez el
+        resultado parcial.
+
+        param:  "postings": lista de posting lists
+
+        return: posting list con los newid incluidos en alguna de las posting lists
+
+        """
+        postings = [p for p in postings if len(p) > 0]
+        if not postings:
+            return []
+        if len(postings) <= 2 or any(isinstance(p, Bitmap) for p in postings):
+            res = postings[0]
+            for p in postings[1:]:
+                res = self.or_posting(res, p)
+            return res
+
+        # con NumPy se concatenan y se ordenan de una vez; el heap es lento en python,
+        # por lo que compensa en cuanto el total de newid llega a NUMPY_MIN['or of k']
+        if numpy is not None and self.use_numpy and sum(map(len, postings)) >= NUMPY_MIN['or of k']:
+            return np_or(postings)
+
+        res = []
+        for n in heapq.merge(*postings):
+            if not res or res[-1] != n:
+                res.append(n)
+        return res
+
+
+
     def minus_posting(self, p1, p2):
         """
         OPCIONAL PARA TODAS LAS VERSIONES
@@ -818,22 +2204,51 @@ class SAR_Project:
         return: posting list con los newid incluidos de p1 y no en p2
 
         """
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            return self.bitmap_posting('minus', p1, p2)
+
+        # p1 mucho mas corta: buscamos cada elemento de p1 en p2 con un cursor
+        if len(p1) * GALLOP_RATIO < len(p2):
+            respuesta = []
+            cursor = PostingCursor(p2)
+            for a in p1:
+                if cursor.next_geq(a) != a:
+                    respuesta.append(a)
+            return respuesta
+
+        # p2 mucho mas corta: localizamos sus elementos en p1 y copiamos los tramos intermedios
+        if isinstance(p1, list) and len(p2) * GALLOP_RATIO < len(p1):
+            respuesta = []
+            inicio = 0
+            for b in p2:
+                i = bisect_left(p1, b, inicio)
+                if i < len(p1) and p1[i] == b:
+                    respuesta.extend(p1[inicio:i])
+                    inicio = i + 1
+            respuesta.extend(p1[inicio:])
+            return respuesta
+
+        if self.numpy_ok('minus', p1, p2):
+            return np_minus(p1, p2)
+
         respuesta = []
-        i = 0
-        j = 0
-
-        while len(p1)> i and len(p2)>j:
-            if p1[i] == p2[j]:
-                i = i + 1
-                j = j + 1
-            elif p1[i] < p2[j]:
-                respuesta.append(p1[i])
-                i = i + 1
+        it1 = iter(p1)
+        it2 = iter(p2)
+        a = next(it1, None)
+        b = next(it2, None)
+
+        while a is not None and b is not None:
+            if a == b:
+                a = next(it1, None)
+                b = next(it2, None)
+            elif a < b:
+                respuesta.append(a)
+                a = next(it1, None)
             else:
-                j = j + 1
-        while(i<len(p1)):
-            respuesta.append(p1[i])
-            i+=1
+                b = next(it2, None)
+        if a is not None:
+            respuesta.append(a)
+            respuesta.extend(it1)
 
         return respuesta
 
@@ -843,6 +2258,39 @@ class SAR_Project:
 
 
 
+    def bitmap_posting(self, op, p1, p2):
+        """
+        Calcula el AND, OR o except de dos posting lists cuando alguna es un Bitmap.
+
+        Si la otra es una lista, en el AND y en el except de una lista menos un bitmap
+        basta con consultar el bitmap para cada elemento de la lista; en el resto de casos
+        se convierten las dos a bitmap y se opera con ellos.
+
+        param:  "op": 'and', 'or' o 'minus'
+                "p1", "p2": posting lists sobre las que calcular, al menos una es un Bitmap
+
+        return: posting list (lista o Bitmap) con el resultado
+
+        """
+        if op == 'and' and not isinstance(p1, Bitmap):
+            p1, p2 = p2, p1
+        if op in ('and', 'minus') and isinstance(p2, Bitmap) and not isinstance(p1, Bitmap):
+            # p2 es el bitmap y p1 la lista
+            if op == 'and':
+                return [n for n in p1 if n in p2]
+            return [n for n in p1 if n not in p2]
+
+        size = len(self.news)
+        b1 = Bitmap.from_posting(p1, size)
+        b2 = Bitmap.from_posting(p2, size)
+        if op == 'and':
+            return b1 & b2
+        if op == 'or':
+            return b1 | b2
+        return b1 - b2
+
+
+
 
 
     #####################################
@@ -852,23 +2300,35 @@ class SAR_Project:
     #####################################
 
 
-    def solve_and_count(self, query):
+    def solve_and_count(self, query, result=None):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
         Resuelve una consulta y la muestra junto al numero de resultados
 
         param:  "query": query que se debe resolver.
+                "result": resultado de la query si ya se ha resuelto (p.e. con solve_batch)
 
-        return: el numero de noticias recuperadas, para la opcion -T
+        return: el numero de noticias recuperadas, para la opcion -T, o None si la
+                query esta mal formada (muestra el error de sintaxis)
 
         """
-        result = self.solve_query(query)
+        if self.profile is not None:
+            self.profile.start(query)
+        if result is None:
+            try:
+                result = self.solve_query(query)
+            except QuerySyntaxError as e:
+                print("%s\tError de sintaxis: %s" % (query, e))
+                return None
         print("%s\t%d" % (query, len(result)))
+        if self.profile is not None:
+            self.profile.finish()
+            self.profile.show()
         return len(result)  # para verificar los resultados (op: -T)
 
 
-    def solve_and_show(self, query):
+    def solve_and_show(self, query, result=None):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
@@ -879,126 +2339,491 @@ class SAR_Project:
         - Si se implementa la opcion de ranking y en funcion del valor de self.use_ranking debera llamar a self.rank_result
 
         param:  "query": query que se debe resolver.
+                "result": resultado de la query si ya se ha resuelto (p.e. con solve_batch)
 
         return: el numero de noticias recuperadas, para la opcion -T
 
         """
-        
-        result = self.solve_query(query)
+        if self.profile is not None:
+            self.profile.start(query)
+        if result is None:
+            try:
+                result = self.solve_query(query)
+            except QuerySyntaxError as e:
+                print(f"Error de sintaxis en la query '{query}': {e}")
+                return
         
             
         print(f"Noticias recuperadas: {len(result)}")
-        for n in result:
-            d = self.news[n]
-            lis = d.split("_")
-            ruta = self.docs[int(lis[0])]
-            with open(ruta) as fi:
-                docJson = json.load(fi)
-                fecha = docJson[int(lis[1])]["date"]
-                titulo = docJson[int(lis[1])]["title"]
-                keywords = docJson[int(lis[1])]["keywords"]
-                score = 0             
-                print(f"Noticia: {n}")
-                print(f"    Fecha: {fecha}")
-                print(f"    Título: {titulo}")
-                print(f"    Keywords: {keywords}")
-                print(f"    Score: {score}")
-                if self.show_snippet:
-                    texto = docJson[int(lis[1])]["article"]
-                    arrwords = self.tokenize(texto) 
-                    consulta = query.lower()
-                    #separamos los parentesis
-                    split = ""
-                    op = False
-                    for i in range(0,len(query)):
-                        item=consulta[i]
-                        if item == '(' or item == ')':
-                            split = split + " " + item + " "
-                        else:
-                            if item == '"':
-                                op = not op
-                            if item == " " and open:
-                                split = split + "|"
-                            else: split = split + item
-                            
-                    
-
-                    #separamos los diferentes items de la query
-                    consulta = split.split(" ")  
-                    palabras = []
-                    for i in range(len(consulta)):
-                        if consulta[i] == "not":
-                            i = i + 1
-                        else:
-                            if consulta[i]!= "or" and consulta[i] != "and":
-                                palabras.append(consulta[i])
-                    snippet =""
-                    encontradas = 0
-                    abuscar = []
-
-                    if self.use_stemming:
-                        for p in palabras:
-                            terminos=self.sindex[self.stemmer.stem(p)]
-                            for t in terminos:
-                                abuscar.append(t)
-                    
-                    else:
-                        for p in palabras:
-                            if("*" in p or "?" in p):
-                                i=0
-                                res=[]
-                                p = p.replace("?", "*")
-
-                                for simbolo in p:
-                                    if(simbolo=="*"):
-                                        break
-                                    i=i+1
-                                ini=p[0:i]
-                                fin=p[i+1:len(p)]
-                                for permuterms in self.ptindex:
-                                    if permuterms.startswith(ini) and permuterms.endswith(fin):
-                                        abuscar.append(permuterms)
-                            elif('"' in p):
-                                words = p.replace('"',"").replace('|'," ")
-                                abuscar.append(words)
-                            else:
-                                abuscar.append(p)
-                                 
-                    if len(abuscar) > 1:
-                        for w in arrwords:
-                            if w in abuscar:
-                                encontradas += 1
-                                snippet =  snippet + " " + w
-                                if len(snippet.split(" ")) > 10: break
-                            else:
-                                if encontradas > 0 and encontradas != len(abuscar):
-                                    snippet = snippet + " " + w
-                                    
-                    if len(abuscar) == 1 or len(snippet.split(" ")) < 10 or len(snippet.split(" ")) > 250:
-                        
-                        puntos = texto.lower().split(".")
-                        for f in puntos:
-                            for i in abuscar:
-                                if i in f:
-                                    snippet = f
-                    
-                    print(f"    Snippet: {snippet}")
-                    print("---------------------------------------------------------------------------------")
-                    
-                            
-                            
-
-    def rank_result(self, result, query):
+        if self.show_snippet:
+            with self.stage('snippets'):
+                palabras = self.query_words(query)
+        if self.use_ranking:
+            #sin -A solo hacen falta las SHOW_MAX mejores noticias (ver top_k)
+            with self.stage('ranking'):
+                resultados = self.rank_result(result, query, None if self.show_all else self.SHOW_MAX)
+        else:
+            resultados = ((n, 0) for n in result)
+            if not self.show_all:
+                resultados = islice(resultados, self.SHOW_MAX)
+        for n, score in resultados:
+            #los datos de la noticia se leen del almacen de documentos, sin abrir el JSON
+            with self.stage('records'):
+                noticia = self.get_record(n)
+            fecha = noticia["date"]
+            titulo = noticia["title"]
+            keywords = noticia["keywords"]
+            print(f"Noticia: {n}")
+            print(f"    Fecha: {fecha}")
+            print(f"    Título: {titulo}")
+            print(f"    Keywords: {keywords}")
+            print(f"    Score: {round(score, 4)}")
+            if self.show_snippet:
+                with self.stage('snippets'):
+                    snippet = self.make_snippet(noticia["article"], palabras)
+                print(f"    Snippet: {snippet}")
+                print("---------------------------------------------------------------------------------")
+        if self.profile is not None:
+            self.profile.finish()
+            self.profile.show()
+
+
+
+    def query_words(self, query):
+        """
+        Devuelve las palabras del articulo que se deben resaltar en el snippet de una query
+        (las de query_terms, sin el campo).
+
+        param:  "query": query que se esta resolviendo
+
+        return: conjunto de palabras
+
+        """
+        return {w for _, w in self.query_terms(query)}
+
+
+
+    def query_terms(self, query):
+        """
+        Devuelve los terminos de una query que cuentan para el snippet y el ranking.
+
+        Son los terminos no negados de la query salvo las fechas; los comodines
+        se expanden con el indice permuterm, las frases y NEAR se separan en sus palabras
+        y, con stemming, se incluyen todas las palabras con el mismo stem.
+
+        param:  "query": query que se esta resolviendo
+
+        return: conjunto de tuplas (campo, termino)
+
+        """
+        palabras = set()
+        pendientes = [self.plan_query(self.parse_query(query))]
+        while pendientes:
+            nodo = pendientes.pop()
+            if nodo[0] in ('and', 'or'):
+                pendientes.extend(nodo[1])
+            elif nodo[0] == 'near':
+                pendientes.extend(nodo[2:])
+            elif nodo[0] == 'term' and nodo[1] != 'date':
+                field, term = nodo[1], nodo[2]
+                if "*" in term or "?" in term:
+                    terminos = [self.vocab[t] for t in self.wildcard_terms(term, field)]
+                elif term.startswith('"'):
+                    terminos = term.strip('"').split("|")
+                elif self.use_stemming:
+                    terminos = [term] + [self.vocab[t] for t in self.sindex.get(self.stem(term), [])]
+                else:
+                    terminos = [term]
+                palabras.update((field, w) for w in terminos)
+        return palabras
+
+
+
+    def make_snippet(self, texto, palabras, ancho=5, maximo=3):
+        """
+        Construye el snippet de una noticia.
+
+        Se toman las primeras apariciones de (como mucho "maximo") palabras distintas de
+        la query con "ancho" palabras de contexto a cada lado; los fragmentos que se solapan
+        se unen y el resto se separan con '...'. Si no aparece ninguna palabra se muestra
+        el principio del articulo.
+
+        param:  "texto": articulo de la noticia
+                "palabras": palabras a buscar (ver query_words)
+
+        return: cadena con el snippet
+
+        """
+        tokens = self.tokenize(texto)
+        vistas = set()
+        ventanas = []
+        for j, w in enumerate(tokens):
+            if w in palabras and w not in vistas:
+                vistas.add(w)
+                ventanas.append([max(0, j - ancho), min(len(tokens), j + ancho + 1)])
+                if len(ventanas) == maximo:
+                    break
+        if not ventanas:
+            return " ".join(tokens[:2 * ancho + 1])
+
+        unidas = [ventanas[0]]
+        for ini, fin in ventanas[1:]:
+            if ini <= unidas[-1][1]:
+                unidas[-1][1] = max(unidas[-1][1], fin)
+            else:
+                unidas.append([ini, fin])
+        return " ... ".join(" ".join(tokens[ini:fin]) for ini, fin in unidas)
+
+
+
+    def rank_result(self, result, query, k=None):
         """
         NECESARIO PARA LA AMPLIACION DE RANKING
         Ordena los resultados de una query.
+
+        La puntuacion de una noticia es la suma, para cada termino de la query (query_terms)
+        que aparece en ella, de:
+
+            - BM25 (self.rank_model == 'bm25'):
+                idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * longitud / longitud media))
+            - tf-idf (self.rank_model == 'tfidf'): el coseno entre la noticia y la query,
+                (1 + log(tf)) * idf / norma de la noticia; la norma de la query es la
+                misma para todas las noticias y no cambia el orden, por lo que no se divide.
+
+        El idf, las frecuencias, las longitudes y las normas estan precalculados (make_weights):
+        solo se recorren las posting lists de los terminos de la query. Si solo hacen falta
+        las "k" mejores noticias se usa top_k, siempre que el resultado y las posting lists
+        sean lo bastante largos para que compense (TOPK_RESULT y TOPK_MIN).
+
         param:  "result": lista de resultados sin ordenar
                 "query": query, puede ser la query original, la query procesada o una lista de terminos
-        return: la lista de resultados ordenada
+                "k": numero de noticias que hacen falta, None para ordenarlas todas
+        return: la lista de resultados ordenada, como tuplas (newid, puntuacion) de mayor a menor puntuacion
+        """
+        if len(result) == 0:
+            return []
+        terminos = []
+        for field, term in self.query_terms(query):
+            t = self.index_key(term)
+            pesos = self.weight.get(field, {}).get(t)
+            if pesos is not None:
+                terminos.append((field, t, pesos))
+        if k is not None and len(result) > self.TOPK_RESULT * k and \
+                sum(len(self.index[field][t]) for field, t, _ in terminos) >= self.TOPK_MIN[self.rank_model]:
+            return self.top_k(result, query, k)
+
+        resultado = result if isinstance(result, Bitmap) else set(result)
+        scores = {}
+        for field, t, pesos in terminos:
+            idf, tfs = pesos[:2]
+            doc = self.weight_doc[field]
+            for n, tf in zip(self.index[field][t], tfs):
+                if n in resultado:
+                    scores[n] = scores.get(n, 0) + self.term_score(self.rank_model, tf, idf, n, doc)
+
+        # sort es estable: a igual puntuacion se mantiene el orden por newid
+        ordenados = sorted(((n, scores.get(n, 0)) for n in result), key=lambda x: -x[1])
+        return ordenados if k is None else ordenados[:k]
+
+
+    def term_score(self, model, tf, idf, n, doc):
+        """
+        Puntuacion que aporta un termino a una noticia (ver rank_result).
+
+        param:  "model": 'bm25' o 'tfidf'
+                "tf": frecuencia del termino en la noticia
+                "idf": idf del termino
+                "n": newid de la noticia
+                "doc": pesado de las noticias del campo, self.weight_doc[field]
+
         """
+        longitudes, normas, media = doc
+        if model == 'tfidf':
+            return (1 + math.log(tf)) * idf / normas[n]
+        k1, b = self.BM25_K1, self.BM25_B
+        return idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * longitudes[n] / media))
 
-        pass
+
+    def top_k(self, result, query, k):
+        """
+        Devuelve las "k" noticias del resultado de una query con mayor puntuacion (MaxScore).
+
+        Los terminos de la query se ordenan por su cota (la maxima puntuacion que aportan a
+        una noticia, precalculada en make_weights) y se recorren sus posting lists a la vez,
+        noticia a noticia, guardando las k mejores en un heap. Cuando el heap esta lleno, su
+        minimo es el umbral que hay que superar: los terminos cuyas cotas acumuladas no lo
+        superan ya no pueden meter por si solos una noticia en el heap, asi que solo se
+        recorren las posting lists del resto ("esenciales") y en las primeras solo se busca
+        (con saltos) cada candidata, y solo mientras todavia pueda superar el umbral.
+
+        El resultado es el mismo que el de los k primeros de rank_result (a igual puntuacion,
+        primero el menor newid).
+
+        param:  "result": posting list con el resultado de la query
+                "query": query
+                "k": numero de noticias a devolver
+
+        return: lista de tuplas (newid, puntuacion) de mayor a menor puntuacion
+
+        """
+        resultado = result if isinstance(result, Bitmap) else set(result)
+        cota = 3 if self.rank_model == 'tfidf' else 2
+        terminos = []
+        for field, term in self.query_terms(query):
+            t = self.index_key(term)
+            pesos = self.weight.get(field, {}).get(t)
+            if pesos is not None:
+                terminos.append((pesos[cota], field, t))
+        terminos.sort()
+
+        cursores = []
+        datos = []
+        acumuladas = []
+        total = 0
+        for c, field, t in terminos:
+            cursores.append(PostingCursor(self.index[field][t]))
+            idf, tfs = self.weight[field][t][:2]
+            datos.append((idf, tfs, self.weight_doc[field]))
+            total += c
+            acumuladas.append(total)
+        actual = [cur.next_geq(0) for cur in cursores]
+
+        heap = []
+        umbral = 0
+        primero = 0  # los terminos primero.. son los esenciales
+        nterms = len(cursores)
+        puntuar = self.term_score
+        model = self.rank_model
+        while True:
+            d = None
+            for j in range(primero, nterms):
+                a = actual[j]
+                if a is not None and (d is None or a < d):
+                    d = a
+            if d is None:
+                break
+            if d in resultado:
+                score = 0
+                for j in range(primero, nterms):
+                    if actual[j] == d:
+                        idf, tfs, doc = datos[j]
+                        score += puntuar(model, tfs[cursores[j].ordinal()], idf, d, doc)
+                lleno = len(heap) == k
+                for j in range(primero - 1, -1, -1):
+                    if lleno and score + acumuladas[j] <= umbral:
+                        break
+                    actual[j] = cursores[j].next_geq(d)
+                    if actual[j] == d:
+                        idf, tfs, doc = datos[j]
+                        score += puntuar(model, tfs[cursores[j].ordinal()], idf, d, doc)
+                # a igual puntuacion gana el menor newid, que es el que llega antes
+                if not lleno:
+                    heapq.heappush(heap, (score, -d))
+                elif score > umbral:
+                    heapq.heapreplace(heap, (score, -d))
+                if len(heap) == k:
+                    umbral = heap[0][0]
+                    while primero < nterms and acumuladas[primero] <= umbral:
+                        primero += 1
+            for j in range(primero, nterms):
+                if actual[j] == d:
+                    actual[j] = cursores[j].next_geq(d + 1)
+
+        res = [(-m, score) for score, m in sorted(heap, reverse=True)]
+        if len(res) < k:
+            # faltan noticias sin ningun termino puntuable (p.e. solo negados): puntuacion 0
+            vistas = {n for n, _ in res}
+            res.extend(islice(((n, 0) for n in result if n not in vistas), k - len(res)))
+        return res
 
         ###################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE RANKING ##
-        ###################################################
\ No newline at end of file
+        ###################################################
+
+
+
+# Proyecto sobre el que trabajan los procesos de solve_batch (lo heredan con fork)
+_batch_project = None
+
+
+def _solve_chunk(arboles):
+    """
+    Evalua un bloque de queries ya analizadas en un proceso independiente (ver SAR_Project.solve_batch).
+
+    param:  "arboles": lista de arboles de queries
+
+    return: lista con el resultado de cada query
+
+    """
+    memo = {}
+    return [list(_batch_project.eval_query(arbol, memo)) for arbol in arboles]
+
+
+def _index_chunk(tarea):
+    """
+    Indexa un bloque de ficheros en un proceso independiente (ver SAR_Project.index_parallel).
+
+    param:  "tarea": tupla (ficheros, positional, multifield, ranking)
+
+    return: tupla (docs, news, vocab, index, posindex, store, dates, weight, weight_doc) con los indices parciales del bloque
+
+    """
+    ficheros, positional, multifield, ranking = tarea
+    parcial = SAR_Project()
+    parcial.positional = positional
+    parcial.multifield = multifield
+    parcial.ranking = ranking
+    for filename in ficheros:
+        parcial.index_file(filename)
+    return (list(parcial.docs.values()), list(parcial.news.values()), parcial.vocab,
+            parcial.index, parcial.posindex, parcial.store, parcial.dates,
+            parcial.weight, parcial.weight_doc)
+
+
+
+def available_cpus():
+    """
+    Numero de CPUs que puede usar este proceso (las de su afinidad, si el sistema la tiene).
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+
+def file_signature(filename):
+    """
+    Firma de un fichero de noticias para detectar si ha cambiado (ver SAR_update).
+
+    return: tupla (fecha de modificacion en ns, tamaño, sha1 del contenido)
+
+    """
+    st = os.stat(filename)
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for bloque in iter(lambda: fh.read(2**20), b''):
+            h.update(bloque)
+    return st.st_mtime_ns, st.st_size, h.hexdigest()
+
+
+
+def iter_json(fh, chunk=JSON_CHUNK):
+    """
+    Recorre los valores de un fichero JSON Arrays ("[{...}, {...}]") o JSON Lines (un
+    valor por linea) leyendolo por bloques de "chunk" caracteres.
+
+    Cada valor se decodifica con json.JSONDecoder.raw_decode en cuanto esta completo en
+    el buffer; si no lo esta (o si termina justo al final del buffer, como un numero que
+    puede continuar en el siguiente bloque) se lee otro bloque, de tamaño creciente para
+    que un valor muy grande no se analice un numero cuadratico de veces.
+
+    param:  "fh": fichero de texto abierto
+            "chunk": caracteres que se leen de cada vez
+
+    return: iterador de los valores del fichero
+
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    lista = None # None hasta ver el primer caracter: True si es un JSON Array
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                if lista:
+                    raise ValueError("fichero JSON incompleto: falta ']'")
+                return
+            buf = fh.read(chunk)
+            pos = 0
+            eof = not buf
+            continue
+        c = buf[pos]
+        if lista is None:
+            lista = c == '['
+            if lista:
+                pos += 1
+                continue
+        elif lista and c == ',':
+            pos += 1
+            continue
+        elif lista and c == ']':
+            return
+        try:
+            valor, fin = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            fin = None
+            if eof:
+                raise
+        # si el valor llega justo al final del buffer puede estar cortado (p.e. el numero
+        # 12345 leido como 12 y 345): se lee otro bloque y se vuelve a decodificar
+        if fin is None or (fin == len(buf) and not eof):
+            mas = fh.read(max(chunk, len(buf) - pos))
+            buf = buf[pos:] + mas
+            pos = 0
+            eof = not mas
+            continue
+        pos = fin
+        yield valor
+
+
+def peak_memory():
+    """
+    Pico de memoria residente (RSS) del proceso y de sus procesos hijos ya terminados.
+
+    return: bytes, o None si el sistema no permite medirlo (modulo resource)
+
+    """
+    if resource is None:
+        return None
+    # ru_maxrss esta en KB en Linux y en bytes en macOS
+    escala = 1 if sys.platform == 'darwin' else 1024
+    propio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    hijos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(propio, hijos) * escala
+
+
+def _decode_str(raw):
+    return str(raw, 'utf-8')
+
+
+def _decode_id(raw):
+    return raw.cast('I')[0]
+
+
+def _decode_ids(raw):
+    return raw.cast('I')
+
+
+def _decode_weight(raw):
+    idf, cota_bm25, cota_tfidf = raw[:24].cast('d')
+    return idf, raw[24:].cast('I'), cota_bm25, cota_tfidf
+
+
+def _decode_runs(raw):
+    n = raw.cast('Q')
+    return [(n[i], n[i + 1]) for i in range(0, len(n), 2)]
+
+
+def load_index(filename):
+    """
+    Carga un indice guardado por SAR_Indexer, ya sea un segmento o un objeto SAR_Project serializado con pickle.
+
+    param:  "filename": ruta del fichero con el indice
+
+    return: objeto SAR_Project listo para resolver consultas
+
+    """
+    if os.path.exists(filename + '.manifest'):
+        # indice incremental con varios segmentos, ver SAR_update
+        from SAR_update import MultiSegmentProject
+        return MultiSegmentProject(filename)
+    with open(filename, 'rb') as fh:
+        if fh.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            fh.seek(0)
+            return pickle.load(fh)
+    searcher = SAR_Project()
+    searcher.open_segment(filename)
+    return searcher
@@ -0,0 +1,543 @@
+"""
+Posting lists comprimidas para SAR_Project.
+
+Los newid de una posting list se guardan como diferencias entre elementos
+consecutivos codificadas en variable-byte (7 bits de datos por byte, el bit
+alto indica que el numero continua en el siguiente byte). Las posiciones del
+indice posicional se codifican de la misma forma.
+
+Las listas se decodifican bajo demanda mientras se recorren, por lo que los
+algoritmos de mezcla (and_posting, or_posting...) pueden consumirlas
+directamente sin descomprimirlas antes.
+
+Las posting lists comprimidas largas guardan ademas punteros de salto cada
+SKIP_INTERVAL elementos, para que un cursor pueda avanzar hasta un newid sin
+decodificar todos los anteriores (ver PostingCursor).
+
+Si NumPy esta instalado, las operaciones sobre posting lists largas se pueden
+hacer con arrays de int32 (ver np_and, np_or y np_minus).
+"""
+
+import sys
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError: # NumPy es opcional
+    numpy = None
+
+
+# Cada cuantos elementos se guarda un puntero de salto
+SKIP_INTERVAL = 64
+
+# Relacion de longitudes a partir de la cual la interseccion busca los elementos
+# de la lista corta en la larga (galloping / saltos) en vez de recorrer ambas
+GALLOP_RATIO = 8
+
+# Longitud a partir de la cual es mas rapido operar con arrays de NumPy que con las
+# mezclas en python, incluyendo la conversion de ida y vuelta, para cada operacion
+# (ver bench_numpy). En el except el cruce esta entre 1024 y 2048; en el OR de k
+# listas (heap en python) la longitud es la suma de todas
+NUMPY_MIN = {'and': 256, 'or': 1024, 'minus': 2048, 'or of k': 256}
+
+
+def vbyte_encode(numeros, buf=None):
+    """
+    Codifica una secuencia de enteros no negativos en variable-byte.
+
+    param:  "numeros": iterable de enteros
+            "buf": bytearray sobre el que escribir, si es None se crea uno nuevo
+
+    return: el bytearray con los numeros codificados
+
+    """
+    if buf is None:
+        buf = bytearray()
+    for n in numeros:
+        while n >= 128:
+            buf.append(n & 127 | 128)
+            n >>= 7
+        buf.append(n)
+    return buf
+
+
+def vbyte_decode(data):
+    """
+    Decodifica bajo demanda una secuencia de enteros en variable-byte.
+
+    param:  "data": bytes, bytearray o memoryview con los numeros codificados
+
+    return: generador con los enteros decodificados
+
+    """
+    n = 0
+    shift = 0
+    for b in data:
+        if b & 128:
+            n |= (b & 127) << shift
+            shift += 7
+        else:
+            yield n | (b << shift)
+            n = 0
+            shift = 0
+
+
+def vbyte_read(data, pos=0):
+    """
+    Lee un unico entero en variable-byte.
+
+    param:  "data": bytes, bytearray o memoryview
+            "pos": posicion del primer byte del entero
+
+    return: tupla (entero, posicion siguiente al entero)
+
+    """
+    n = 0
+    shift = 0
+    while data[pos] & 128:
+        n |= (data[pos] & 127) << shift
+        shift += 7
+        pos += 1
+    return n | (data[pos] << shift), pos + 1
+
+
+def delta_encode(posting, buf=None):
+    """
+    Codifica una lista ordenada de enteros como diferencias en variable-byte.
+
+    param:  "posting": lista ordenada de enteros
+            "buf": bytearray sobre el que escribir, si es None se crea uno nuevo
+
+    return: el bytearray con la lista codificada
+
+    """
+    anterior = 0
+    gaps = []
+    for n in posting:
+        gaps.append(n - anterior)
+        anterior = n
+    return vbyte_encode(gaps, buf)
+
+
+class CompressedPosting:
+    """
+    Posting list de newid comprimida con diferencias + variable-byte.
+
+    Se comporta como una lista de solo lectura: admite len() y se puede recorrer
+    en orden creciente, decodificando los elementos a medida que se piden.
+
+    "skips" contiene los punteros de salto: para cada bloque de SKIP_INTERVAL
+    elementos, el ultimo newid del bloque y la posicion en "data" del siguiente
+    elemento, ambos como diferencias con el puntero anterior y en variable-byte.
+    """
+
+    __slots__ = ('data', 'size', 'skips')
+
+    def __init__(self, data, size, skips=b''):
+        self.data = data
+        self.size = size
+        self.skips = skips
+
+    @classmethod
+    def from_list(cls, posting):
+        buf = bytearray()
+        saltos = []
+        anterior = 0
+        for k, n in enumerate(posting, 1):
+            gap = n - anterior
+            while gap >= 128:
+                buf.append(gap & 127 | 128)
+                gap >>= 7
+            buf.append(gap)
+            anterior = n
+            if k % SKIP_INTERVAL == 0 and k < len(posting):
+                saltos.append((n, len(buf)))
+        skips = bytearray()
+        anterior = (0, 0)
+        for n, pos in saltos:
+            vbyte_encode((n - anterior[0], pos - anterior[1]), skips)
+            anterior = (n, pos)
+        return cls(bytes(buf), len(posting), bytes(skips))
+
+    def skip_pointers(self):
+        """
+        Decodifica los punteros de salto.
+
+        return: tupla de listas (newids, posiciones), el puntero k corresponde al elemento
+                (k + 1) * SKIP_INTERVAL - 1
+
+        """
+        newids = []
+        posiciones = []
+        numeros = vbyte_decode(self.skips)
+        n = pos = 0
+        for gap in numeros:
+            n += gap
+            pos += next(numeros)
+            newids.append(n)
+            posiciones.append(pos)
+        return newids, posiciones
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        n = 0
+        for gap in vbyte_decode(self.data):
+            n += gap
+            yield n
+
+    def __reduce__(self):
+        return (CompressedPosting, (self.data, self.size, self.skips))
+
+    def nbytes(self):
+        return sys.getsizeof(self) + len(self.data) + len(self.skips)
+
+
+class CompressedPositional:
+    """
+    Posting list posicional comprimida.
+
+    Para cada noticia se guarda la diferencia con el newid anterior, el numero de
+    apariciones y las posiciones como diferencias, todo en variable-byte.
+
+    Se comporta como el diccionario {newid: [posiciones]} del indice posicional
+    sin comprimir: len() es el numero de noticias, al recorrerlo se obtienen los
+    newid y items() devuelve los pares (newid, posiciones) en orden creciente.
+    """
+
+    __slots__ = ('data', 'size')
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    @classmethod
+    def from_dict(cls, posis):
+        buf = bytearray()
+        anterior = 0
+        for n, lista in posis.items():
+            vbyte_encode((n - anterior, len(lista)), buf)
+            delta_encode(lista, buf)
+            anterior = n
+        return cls(bytes(buf), len(posis))
+
+    def __len__(self):
+        return self.size
+
+    def items(self):
+        numeros = vbyte_decode(self.data)
+        n = 0
+        for gap in numeros:
+            n += gap
+            posiciones = []
+            p = 0
+            for _ in range(next(numeros)):
+                p += next(numeros)
+                posiciones.append(p)
+            yield n, posiciones
+
+    def __iter__(self):
+        for n, _ in self.items():
+            yield n
+
+    def __reduce__(self):
+        return (CompressedPositional, (self.data, self.size))
+
+    def nbytes(self):
+        return sys.getsizeof(self) + len(self.data)
+
+
+def encode_posting(p):
+    """
+    Serializa una posting list (lista o comprimida) como su longitud seguida de
+    los datos comprimidos. Es el formato que se guarda en los segmentos.
+
+    El primer byte indica el tipo: 0 para una posting list comprimida y 1 para un
+    Bitmap, que se guarda tal cual (numero de noticias y bits).
+
+    param:  "p": posting list
+
+    return: bytes con la posting list serializada
+
+    """
+    if isinstance(p, Bitmap):
+        return b'\x01' + bytes(vbyte_encode([p.size])) + p.tobytes()
+    if not isinstance(p, CompressedPosting):
+        p = CompressedPosting.from_list(p)
+    return b'\x00' + bytes(vbyte_encode([len(p), len(p.skips)])) + p.skips + p.data
+
+
+def decode_posting(data):
+    """
+    Recupera una posting list serializada con encode_posting sin copiar los datos
+    (salvo los de un Bitmap, que se convierten en un entero).
+    """
+    size, pos = vbyte_read(data, 1)
+    if data[0] == 1:
+        return Bitmap(int.from_bytes(data[pos:], 'little'), size)
+    nskips, pos = vbyte_read(data, pos)
+    return CompressedPosting(data[pos + nskips:], size, data[pos:pos + nskips])
+
+
+def encode_positional(posis):
+    """
+    Serializa una posting list posicional (diccionario o comprimida), ver encode_posting.
+    """
+    if not isinstance(posis, CompressedPositional):
+        posis = CompressedPositional.from_dict(posis)
+    return bytes(vbyte_encode([len(posis)])) + posis.data
+
+
+def decode_positional(data):
+    """
+    Recupera una posting list posicional serializada con encode_positional.
+    """
+    size, pos = vbyte_read(data)
+    return CompressedPositional(data[pos:], size)
+
+
+class PostingCursor:
+    """
+    Cursor sobre una posting list (lista o comprimida) que permite avanzar
+    hasta el primer newid mayor o igual que uno dado.
+
+    Sobre listas hace una busqueda exponencial (galloping) desde la posicion
+    actual; sobre posting lists comprimidas usa los punteros de salto y solo
+    decodifica el bloque en el que puede estar el newid buscado.
+    """
+
+    __slots__ = ('lista', 'i', 'data', 'pos', 'actual', 'size', 'skip_newids', 'skip_pos')
+
+    def __init__(self, p):
+        if isinstance(p, CompressedPosting):
+            self.lista = None
+            self.data = p.data
+            self.size = p.size
+            self.skip_newids, self.skip_pos = p.skip_pointers()
+            self.pos = 0
+            self.i = 0
+            self.actual = 0
+            self._decode()
+        else:
+            self.lista = p if isinstance(p, list) else list(p)
+            self.i = 0
+
+    def _decode(self):
+        # decodifica el siguiente elemento (el i-esimo) y lo deja como actual
+        if self.i >= self.size:
+            self.actual = None
+            return
+        data = self.data
+        pos = self.pos
+        gap = 0
+        shift = 0
+        while data[pos] & 128:
+            gap |= (data[pos] & 127) << shift
+            shift += 7
+            pos += 1
+        self.actual += gap | (data[pos] << shift)
+        self.pos = pos + 1
+        self.i += 1
+
+    def next_geq(self, target):
+        """
+        Avanza el cursor hasta el primer elemento mayor o igual que "target".
+
+        return: ese elemento, o None si no queda ninguno. El cursor se queda
+                sobre el elemento devuelto.
+
+        """
+        lista = self.lista
+        if lista is not None:
+            i = self.i
+            n = len(lista)
+            if i >= n:
+                return None
+            if lista[i] >= target:
+                return lista[i]
+            # busqueda exponencial y despues binaria en el ultimo tramo
+            salto = 1
+            while i + salto < n and lista[i + salto] < target:
+                i += salto
+                salto *= 2
+            i = bisect_left(lista, target, i + 1, min(i + salto, n))
+            self.i = i
+            return lista[i] if i < n else None
+
+        if self.actual is None or self.actual >= target:
+            return self.actual
+        # saltamos al ultimo bloque que termina antes de "target", si esta por delante
+        k = bisect_left(self.skip_newids, target) - 1
+        if k >= 0 and (k + 1) * SKIP_INTERVAL > self.i:
+            self.actual = self.skip_newids[k]
+            self.pos = self.skip_pos[k]
+            self.i = (k + 1) * SKIP_INTERVAL
+            self._decode()
+        while self.actual is not None and self.actual < target:
+            self._decode()
+        return self.actual
+
+
+    def ordinal(self):
+        """
+        Posicion en la posting list del elemento sobre el que esta el cursor
+        (p.e. para consultar datos guardados en paralelo a la posting list).
+        """
+        if self.lista is not None:
+            return self.i
+        return self.i - 1
+
+
+# Posiciones de los bits activos de cada valor de un byte
+_BYTE_BITS = [tuple(i for i in range(8) if b >> i & 1) for b in range(256)]
+
+
+class Bitmap:
+    """
+    Posting list representada como un conjunto de bits sobre los newid 0..size-1.
+
+    Los bits se guardan en un entero de python, por lo que el AND, OR y la diferencia
+    de dos bitmaps son operaciones sobre enteros grandes, y el complemento no necesita
+    crear la lista de todas las noticias. Se comporta como una posting list: admite
+    len() y se recorre en orden creciente.
+    """
+
+    __slots__ = ('bits', 'size', '_len', '_bytes')
+
+    def __init__(self, bits, size):
+        self.bits = bits
+        self.size = size
+        self._len = None
+        self._bytes = None
+
+    @classmethod
+    def from_posting(cls, p, size):
+        """
+        Crea el bitmap de una posting list (si ya es un Bitmap se devuelve tal cual).
+        """
+        if isinstance(p, Bitmap):
+            return p
+        buf = bytearray((size + 7) // 8)
+        for n in p:
+            buf[n >> 3] |= 1 << (n & 7)
+        return cls(int.from_bytes(buf, 'little'), size)
+
+    @classmethod
+    def from_range(cls, ini, fin, size):
+        """
+        Crea el bitmap de los newid consecutivos ini..fin-1 sin recorrerlos.
+        """
+        return cls(((1 << (fin - ini)) - 1) << ini, size)
+
+    def tobytes(self):
+        if self._bytes is None:
+            self._bytes = self.bits.to_bytes((self.size + 7) // 8, 'little')
+        return self._bytes
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self.bits.bit_count()
+        return self._len
+
+    def __contains__(self, n):
+        return 0 <= n < self.size and self.tobytes()[n >> 3] >> (n & 7) & 1 == 1
+
+    def __iter__(self):
+        for i, byte in enumerate(self.tobytes()):
+            if byte:
+                base = i << 3
+                for bit in _BYTE_BITS[byte]:
+                    yield base + bit
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits, self.size)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits, self.size)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits, self.size)
+
+    def invert(self):
+        """
+        Complemento del bitmap respecto a todos los newid.
+        """
+        return Bitmap(self.bits ^ ((1 << self.size) - 1), self.size)
+
+
+def np_posting(p):
+    """
+    Convierte una posting list (lista, array o comprimida) en un array de int32 de NumPy.
+    """
+    return numpy.fromiter(p, dtype=numpy.int32, count=len(p))
+
+
+def np_and(postings):
+    """
+    AND de varias posting lists con NumPy, de la mas corta a la mas larga.
+
+    return: lista con los newid incluidos en todas las posting lists
+
+    """
+    postings = sorted(postings, key=len)
+    res = np_posting(postings[0])
+    for p in postings[1:]:
+        if len(res) == 0:
+            break
+        res = numpy.intersect1d(res, np_posting(p), assume_unique=True)
+    return res.tolist()
+
+
+def np_or(postings):
+    """
+    OR de varias posting lists con NumPy: se concatenan, se ordenan y se quitan
+    los repetidos (union1d hace lo mismo, pero con bastante mas sobrecarga).
+
+    return: lista con los newid incluidos en alguna de las posting lists
+
+    """
+    res = numpy.concatenate([np_posting(p) for p in postings])
+    res.sort()
+    distintos = numpy.empty(len(res), dtype=bool)
+    distintos[:1] = True
+    numpy.not_equal(res[1:], res[:-1], out=distintos[1:])
+    return res[distintos].tolist()
+
+
+def np_minus(p1, p2):
+    """
+    Except de dos posting lists con NumPy.
+
+    return: lista con los newid incluidos en p1 y no en p2
+
+    """
+    return numpy.setdiff1d(np_posting(p1), np_posting(p2), assume_unique=True).tolist()
+
+
+def posting_nbytes(p):
+    """
+    Estima la memoria (en bytes) que ocupa una posting list.
+
+    param:  "p": lista de newid, diccionario {newid: [posiciones]}, array, posting comprimida o Bitmap
+
+    return: numero de bytes aproximado, incluyendo los objetos int de python
+
+    """
+    if isinstance(p, (CompressedPosting, CompressedPositional)):
+        return p.nbytes()
+    if isinstance(p, Bitmap):
+        return sys.getsizeof(p) + sys.getsizeof(p.bits)
+    if isinstance(p, array):
+        return sys.getsizeof(p)
+    total = sys.getsizeof(p)
+    if isinstance(p, dict):
+        for n, lista in p.items():
+            total += posting_nbytes(lista)
+            if n > 256:
+                total += sys.getsizeof(n)
+    else:
+        # los enteros pequeños son objetos compartidos por python
+        total += sum(sys.getsizeof(n) for n in p if n > 256)
+    return total
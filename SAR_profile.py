@@ -0,0 +1,170 @@
+"""
+Instrumentacion de las consultas de SAR_Project (EXPLAIN ANALYZE).
+
+Solo se activa con SAR_Project.set_profile(): sin ella los metodos del buscador no
+miden nada. Con ella se guarda, para cada query, el arbol del plan evaluado con el
+tiempo y el numero de resultados de cada nodo, el tiempo de cada etapa (analisis,
+cache, busqueda de posting lists, comodines, stemming, mezclas, ranking...) y
+contadores de posting lists consultadas, bytes comprimidos y aciertos de las caches.
+"""
+
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from SAR_postings import CompressedPosting, CompressedPositional, Bitmap
+
+
+# orden en el que se muestran las etapas
+STAGES = ('parse', 'cache', 'postings', 'dates', 'permuterm', 'stemming', 'positional',
+          'merge', 'ranking', 'records', 'snippets')
+
+
+class PlanNode:
+    """
+    Nodo evaluado del arbol de una query: el nodo (como en SAR_Project.parse_query), la
+    etapa a la que se atribuye su tiempo, los resultados estimados y reales, el tiempo
+    en segundos (incluidos sus hijos) y los hijos en el orden en que se evaluaron.
+    """
+
+    __slots__ = ('nodo', 'etapa', 'estimado', 'filas', 'tiempo', 'hijos')
+
+    def __init__(self, nodo, etapa, estimado):
+        self.nodo = nodo
+        self.etapa = etapa
+        self.estimado = estimado
+        self.filas = 0
+        self.tiempo = 0
+        self.hijos = []
+
+    def label(self):
+        tipo = self.nodo[0]
+        if tipo == 'term':
+            return 'TERM %s:%s' % (self.nodo[1], self.nodo[2].replace('|', ' '))
+        if tipo == 'near':
+            return 'NEAR/%d %s:%s %s:%s' % (self.nodo[1], self.nodo[2][1], self.nodo[2][2],
+                                            self.nodo[3][1], self.nodo[3][2])
+        return tipo.upper()
+
+
+class QueryProfile:
+    """
+    Tiempos, contadores y plan de la ultima query, y totales de todas las queries medidas.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.total_stages = Counter()
+        self.total_counters = Counter()
+        self.total_time = 0
+        self.start(None)
+
+    def start(self, query):
+        """
+        Empieza a medir una query, descartando los datos de la anterior.
+        """
+        self.query = query
+        self.stages = Counter()
+        self.counters = Counter()
+        self.roots = []
+        self.elapsed = None
+        self._pila = []
+        self._t0 = time.perf_counter()
+
+    def finish(self):
+        """
+        Termina de medir la query actual y la suma a los totales.
+        """
+        self.elapsed = time.perf_counter() - self._t0
+        self.queries += 1
+        self.total_time += self.elapsed
+        self.total_stages.update(self.stages)
+        self.total_counters.update(self.counters)
+
+    @contextmanager
+    def stage(self, etapa):
+        """
+        Suma a "etapa" el tiempo del bloque with.
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[etapa] += time.perf_counter() - t
+
+    def count(self, nombre, n=1):
+        self.counters[nombre] += n
+
+    def postings(self, listas):
+        """
+        Anota las posting lists (o posicionales) consultadas: cuantas, cuantos newid
+        y cuantos bytes comprimidos hay que decodificar para recorrerlas.
+        """
+        for p in listas:
+            self.counters['postings'] += 1
+            self.counters['newids'] += len(p)
+            if isinstance(p, (CompressedPosting, CompressedPositional)):
+                self.counters['compressed bytes'] += len(p.data)
+            elif isinstance(p, Bitmap):
+                self.counters['bitmap bytes'] += (p.size + 7) // 8
+
+    def node(self, nodo, etapa, estimado, fnc):
+        """
+        Evalua un nodo del arbol (fnc()) anotandolo en el plan. El tiempo propio del
+        nodo, sin el de sus hijos, se suma a "etapa".
+
+        return: el resultado de fnc()
+
+        """
+        plan = PlanNode(nodo, etapa, estimado)
+        (self._pila[-1].hijos if self._pila else self.roots).append(plan)
+        self._pila.append(plan)
+        t = time.perf_counter()
+        try:
+            res = fnc()
+        finally:
+            plan.tiempo = time.perf_counter() - t
+            self._pila.pop()
+        plan.filas = len(res)
+        self.stages[etapa] += plan.tiempo - sum(h.tiempo for h in plan.hijos)
+        return res
+
+    def show(self):
+        """
+        Muestra el plan evaluado, las etapas y los contadores de la ultima query.
+        """
+        print("EXPLAIN ANALYZE: %s" % self.query)
+        if not self.roots:
+            print("-> (result from the query cache)")
+        for plan in self.roots:
+            self._show_node(plan, 0, '')
+        self._show_stages(self.stages, self.counters)
+        if self.elapsed is not None:
+            print("Total: %.3fms" % (self.elapsed * 1000))
+        print()
+
+    def show_totals(self):
+        """
+        Muestra los tiempos por etapa y los contadores sumados de todas las queries medidas.
+        """
+        print("EXPLAIN ANALYZE: %d queries" % self.queries)
+        self._show_stages(self.total_stages, self.total_counters)
+        print("Total: %.3fms" % (self.total_time * 1000))
+        print()
+
+    def _show_node(self, plan, nivel, prefijo):
+        print("%s-> %s%s  (estimated rows=%d) (actual rows=%d time=%.3fms)" % (
+            '   ' * nivel, prefijo, plan.label(), plan.estimado, plan.filas, plan.tiempo * 1000))
+        # en un AND los operandos negados se restan (minus_posting) sin calcular su complemento
+        negados = {h[1] for h in plan.nodo[1] if h[0] == 'not'} if plan.nodo[0] == 'and' else ()
+        for hijo in plan.hijos:
+            self._show_node(hijo, nivel + 1, 'EXCEPT ' if hijo.nodo in negados else '')
+
+    def _show_stages(self, etapas, contadores):
+        print("%-18s %10s" % ('stage', 'time(ms)'))
+        for etapa in sorted(etapas, key=lambda e: (STAGES.index(e) if e in STAGES else len(STAGES), e)):
+            print("%-18s %10.3f" % (etapa, etapas[etapa] * 1000))
+        if contadores:
+            print("%-18s %10s" % ('counter', 'value'))
+            for nombre, valor in sorted(contadores.items()):
+                print("%-18s %10d" % (nombre, valor))
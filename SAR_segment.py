@@ -0,0 +1,401 @@
+"""
+Formato de indice en disco ("segmento") para SAR_Project.
+
+Un segmento es un unico fichero con varias secciones:
+
+    MAGIC | offset del directorio | seccion 1 | seccion 2 | ... | directorio
+
+El directorio es un diccionario (serializado con pickle) con la posicion de
+cada seccion. Hay cuatro tipos de seccion:
+
+    - blob: bytes sin estructura (p.e. la configuracion del indice).
+    - array: secuencia de valores de longitud variable accesibles por posicion,
+             se guarda el numero de valores, sus desplazamientos y los datos.
+    - table: diccionario con claves de tipo str ordenadas (por sus bytes utf-8),
+             formado por un array de claves y un array de valores; la busqueda
+             de una clave es una busqueda binaria sobre el fichero.
+    - idtable: diccionario con claves enteras (p.e. term ids) ordenadas, guardadas
+               como un array de enteros de 4 bytes, y un array de valores.
+
+El buscador abre el fichero con mmap, de forma que solo se leen de disco las
+paginas que toca cada consulta y varios procesos comparten la cache de paginas
+del sistema operativo. Los enteros se guardan con el orden de bytes de la
+maquina que crea el indice.
+"""
+
+import mmap
+import pickle
+import struct
+from array import array
+from bisect import bisect_left
+
+
+MAGIC = b'SARSEG01'
+
+# Alineamiento de las secciones, para poder ver los desplazamientos como enteros de 8 bytes
+ALIGN = 8
+
+
+class SegmentWriter:
+    """
+    Escribe un segmento seccion a seccion.
+    """
+
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.fh.write(MAGIC)
+        self.fh.write(struct.pack('<Q', 0))
+        self.directory = {}
+
+    def _start(self):
+        pos = self.fh.tell()
+        if pos % ALIGN:
+            self.fh.write(b'\0' * (ALIGN - pos % ALIGN))
+        return self.fh.tell()
+
+    def add_blob(self, name, data):
+        """
+        Añade una seccion de bytes sin estructura.
+
+        param:  "name": nombre de la seccion
+                "data": bytes a guardar
+
+        """
+        pos = self._start()
+        self.fh.write(data)
+        self.directory[name] = ('blob', pos, len(data))
+
+    def _write_array(self, values):
+        values = list(values)
+        offsets = array('Q', [0])
+        for v in values:
+            offsets.append(offsets[-1] + len(v))
+        pos = self._start()
+        self.fh.write(array('Q', [len(values)]).tobytes())
+        self.fh.write(offsets.tobytes())
+        for v in values:
+            self.fh.write(v)
+        return pos
+
+    def add_array(self, name, values):
+        """
+        Añade una seccion con una secuencia de valores.
+
+        param:  "name": nombre de la seccion
+                "values": iterable de bytes, el valor i-esimo se recupera con la posicion i
+
+        """
+        self.directory[name] = ('array', self._write_array(values))
+
+    def add_table(self, name, items):
+        """
+        Añade una seccion con un diccionario de claves str.
+
+        param:  "name": nombre de la seccion
+                "items": iterable de pares (clave str, valor bytes)
+
+        """
+        items = sorted((k.encode('utf-8'), v) for k, v in items)
+        keys = self._write_array(k for k, _ in items)
+        values = self._write_array(v for _, v in items)
+        self.directory[name] = ('table', keys, values)
+
+    def add_idtable(self, name, items):
+        """
+        Añade una seccion con un diccionario de claves enteras no negativas (menores de 2**32).
+
+        param:  "name": nombre de la seccion
+                "items": iterable de pares (clave int, valor bytes)
+
+        """
+        items = sorted(items, key=lambda kv: kv[0])
+        keys = array('I', [k for k, _ in items])
+        pos = self._start()
+        self.fh.write(array('Q', [len(keys)]).tobytes())
+        self.fh.write(keys.tobytes())
+        values = self._write_array(v for _, v in items)
+        self.directory[name] = ('idtable', pos, values)
+
+    def close(self):
+        pos = self._start()
+        self.fh.write(pickle.dumps(self.directory, pickle.HIGHEST_PROTOCOL))
+        self.fh.seek(len(MAGIC))
+        self.fh.write(struct.pack('<Q', pos))
+        self.fh.close()
+
+
+class Segment:
+    """
+    Segmento abierto para lectura con mmap.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("'%s' no es un segmento de indice" % path)
+        pos = struct.unpack('<Q', self.mm[len(MAGIC):len(MAGIC) + 8])[0]
+        self.directory = pickle.loads(self.mm[pos:])
+        self.view = memoryview(self.mm)
+
+    def __contains__(self, name):
+        return name in self.directory
+
+    def blob(self, name):
+        _, pos, length = self.directory[name]
+        return self.view[pos:pos + length]
+
+    def array(self, name, decode=bytes):
+        return SegmentArray(self.view, self.directory[name][1], decode)
+
+    def table(self, name, decode=bytes):
+        _, keys, values = self.directory[name]
+        return SegmentTable(SegmentArray(self.view, keys, _decode_key),
+                            SegmentArray(self.view, values, decode))
+
+    def idtable(self, name, decode=bytes):
+        _, keys, values = self.directory[name]
+        size = self.view[keys:keys + 8].cast('Q')[0]
+        return SegmentIdTable(self.view[keys + 8:keys + 8 + 4 * size].cast('I'),
+                              SegmentArray(self.view, values, decode))
+
+
+def _decode_key(raw):
+    return str(raw, 'utf-8')
+
+
+class SegmentArray:
+    """
+    Vista de una seccion array: se comporta como un diccionario de solo lectura
+    cuyas claves son las posiciones 0..n-1.
+    """
+
+    def __init__(self, view, pos, decode):
+        self.size = view[pos:pos + 8].cast('Q')[0]
+        self.offsets = view[pos + 8:pos + 8 * (self.size + 2)].cast('Q')
+        self.base = pos + 8 * (self.size + 2)
+        self.view = view
+        self.decode = decode
+
+    def raw(self, i):
+        return self.view[self.base + self.offsets[i]:self.base + self.offsets[i + 1]]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise KeyError(i)
+        return self.decode(self.raw(i))
+
+    def __contains__(self, i):
+        return isinstance(i, int) and 0 <= i < self.size
+
+    def keys(self):
+        return range(self.size)
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def values(self):
+        for i in range(self.size):
+            yield self.decode(self.raw(i))
+
+    def items(self):
+        for i in range(self.size):
+            yield i, self.decode(self.raw(i))
+
+
+class MemoryArray:
+    """
+    Secuencia de valores bytes guardados de forma compacta en memoria (un unico
+    bytearray y sus desplazamientos), con la misma interfaz que SegmentArray.
+    Se usa para construir en el indexador lo que despues sera una seccion array.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('Q', [0])
+
+    def append(self, value):
+        self.data += value
+        self.offsets.append(len(self.data))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise KeyError(i)
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def values(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class SortedTable:
+    """
+    Diccionario de solo lectura con las claves ordenadas, guardado como dos listas
+    paralelas. Tiene la misma interfaz que SegmentTable, incluida la busqueda de la
+    primera clave mayor o igual que una dada (para recorrer rangos de claves).
+    """
+
+    def __init__(self, items):
+        items = sorted(items)
+        self.keys_list = [k for k, _ in items]
+        self.values_list = [v for _, v in items]
+
+    def bisect_left(self, key):
+        return bisect_left(self.keys_list, key)
+
+    def key_at(self, i):
+        return self.keys_list[i]
+
+    def value_at(self, i):
+        return self.values_list[i]
+
+    def _find(self, key):
+        i = bisect_left(self.keys_list, key)
+        if i < len(self.keys_list) and self.keys_list[i] == key:
+            return i
+        return -1
+
+    def __len__(self):
+        return len(self.keys_list)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.values_list[i]
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        return self.values_list[i] if i >= 0 else default
+
+    def keys(self):
+        return iter(self.keys_list)
+
+    def __iter__(self):
+        return iter(self.keys_list)
+
+    def values(self):
+        return iter(self.values_list)
+
+    def items(self):
+        return zip(self.keys_list, self.values_list)
+
+
+class SegmentTable:
+    """
+    Vista de una seccion table: diccionario de solo lectura con claves str.
+    """
+
+    def __init__(self, keys, values):
+        self.keys_array = keys
+        self.values_array = values
+
+    def bisect_left(self, key):
+        """
+        Posicion de la primera clave mayor o igual que "key" (orden de bytes utf-8).
+        """
+        k = key.encode('utf-8')
+        lo, hi = 0, len(self.keys_array)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.keys_array.raw(mid)) < k:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def key_at(self, i):
+        return self.keys_array[i]
+
+    def value_at(self, i):
+        return self.values_array[i]
+
+    def _find(self, key):
+        i = self.bisect_left(key)
+        if i < len(self.keys_array) and self.keys_array.raw(i) == key.encode('utf-8'):
+            return i
+        return -1
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.values_array[i]
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        return self.values_array[i] if i >= 0 else default
+
+    def keys(self):
+        return self.keys_array.values()
+
+    def __iter__(self):
+        return self.keys_array.values()
+
+    def values(self):
+        return self.values_array.values()
+
+    def items(self):
+        return zip(self.keys_array.values(), self.values_array.values())
+
+
+class SegmentIdTable:
+    """
+    Vista de una seccion idtable: diccionario de solo lectura con claves enteras.
+    """
+
+    def __init__(self, keys, values):
+        self.keys_array = keys
+        self.values_array = values
+
+    def _find(self, key):
+        if not isinstance(key, int):
+            return -1
+        i = bisect_left(self.keys_array, key)
+        if i < len(self.keys_array) and self.keys_array[i] == key:
+            return i
+        return -1
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.values_array[i]
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        return self.values_array[i] if i >= 0 else default
+
+    def keys(self):
+        return iter(self.keys_array)
+
+    def __iter__(self):
+        return iter(self.keys_array)
+
+    def values(self):
+        return self.values_array.values()
+
+    def items(self):
+        return zip(self.keys_array, self.values_array.values())
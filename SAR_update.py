@@ -0,0 +1,407 @@
+"""
+Indexacion incremental de SAR_Project en varios segmentos, al estilo de los arboles LSM.
+
+Un indice incremental es un segmento base (el fichero creado con -F segment) mas los
+segmentos que se van añadiendo con cada actualizacion ("indice.1", "indice.2"...) y
+un manifiesto ("indice.manifest") con:
+
+    - 'segments': nombres de los segmentos, del mas antiguo al mas reciente
+    - 'sizes': numero de noticias de cada segmento
+    - 'files': fichero de noticias --> (firma, segmento), ver SAR_lib.file_signature;
+               el segmento es None si el fichero no tiene noticias
+    - 'deleted': segmento --> newid (locales al segmento) de las noticias borradas
+    - 'next': numero del siguiente segmento
+
+Cada actualizacion indexa solo los ficheros nuevos o modificados en un segmento nuevo,
+con su propio vocabulario, stems, permuterm, etc. Las noticias de los ficheros modificados
+o borrados se marcan como borradas en su segmento, sin reescribirlo. Las consultas se
+resuelven en cada segmento y se unen los resultados (MultiSegmentProject). Cuando hay
+demasiados segmentos se fusionan los mas recientes en uno solo, en un proceso en segundo
+plano; el manifiesto solo se modifica con el cerrojo "indice.lock".
+"""
+
+import os
+import pickle
+import subprocess
+import sys
+import time
+from bisect import bisect_right
+from heapq import merge
+from itertools import islice
+
+from SAR_lib import SAR_Project, file_signature
+
+
+# numero de segmentos a partir del cual se fusionan los mas recientes
+MERGE_FACTOR = 4
+
+# opciones de indexacion que se copian del segmento base a los nuevos segmentos
+FLAGS = ('multifield', 'positional', 'stemming', 'permuterm', 'compress', 'stem_postings', 'common_terms', 'ranking')
+
+
+class IndexLock:
+    """
+    Cerrojo sobre un indice incremental: un fichero "indice.lock" creado en exclusiva.
+    """
+
+    def __init__(self, index, timeout=600):
+        self.path = index + '.lock'
+        self.timeout = timeout
+
+    def __enter__(self):
+        limite = time.time() + self.timeout
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                if time.time() > limite:
+                    raise TimeoutError("no se puede bloquear el indice, ¿existe '%s' de un proceso muerto?" % self.path)
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        os.remove(self.path)
+
+
+def segment_path(index, nombre):
+    """
+    Ruta de un segmento del indice (los nombres del manifiesto son relativos a su directorio).
+    """
+    return os.path.join(os.path.dirname(index), nombre)
+
+
+def open_segment(path):
+    """
+    Abre un segmento como un SAR_Project de solo lectura.
+    """
+    parte = SAR_Project()
+    parte.open_segment(path)
+    return parte
+
+
+def read_manifest(index):
+    """
+    Lee el manifiesto de un indice incremental. Si todavia no existe (el indice es un unico
+    segmento creado sin --update) se construye a partir del segmento base.
+
+    param:  "index": ruta del segmento base
+
+    return: diccionario con el estado del indice (ver la documentacion del modulo)
+
+    """
+    if os.path.exists(index + '.manifest'):
+        with open(index + '.manifest', 'rb') as fh:
+            return pickle.load(fh)
+    base = open_segment(index)
+    nombre = os.path.basename(index)
+    return {'segments': [nombre], 'sizes': {nombre: len(base.news)},
+            'files': {f: (firma, nombre) for f, firma in base.manifest.items()},
+            'deleted': {}, 'next': 1}
+
+
+def write_manifest(index, estado):
+    """
+    Escribe el manifiesto de forma atomica (fichero temporal + os.replace).
+    """
+    tmp = index + '.manifest.tmp'
+    with open(tmp, 'wb') as fh:
+        pickle.dump(estado, fh, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, index + '.manifest')
+
+
+def file_news(parte, filename):
+    """
+    Devuelve los newid (locales) de las noticias de un fichero dentro de un segmento.
+    """
+    docids = {d for d in range(len(parte.docs)) if parte.docs[d] == filename}
+    return [n for n in range(len(parte.news)) if int(parte.news[n].split("_")[0]) in docids]
+
+
+def update_index(root, index, workers=1):
+    """
+    Actualiza un indice incremental con los ficheros nuevos o modificados de "root".
+
+    Un fichero ha cambiado si su fecha de modificacion o su tamaño no coinciden con los
+    del manifiesto y, ademas, su contenido (sha1) es distinto. Los ficheros nuevos y
+    modificados se indexan en un segmento nuevo; las noticias que tenian los ficheros
+    modificados o borrados se marcan como borradas.
+
+    param:  "root": directorio con las noticias
+            "index": ruta del segmento base
+            "workers": numero de procesos para indexar los ficheros
+
+    return: diccionario con los ficheros nuevos, modificados y borrados y el segmento creado
+
+    """
+    with IndexLock(index):
+        estado = read_manifest(index)
+        ficheros = SAR_Project().news_files(root)
+        nuevos, cambiados = [], []
+        for f in ficheros:
+            if f not in estado['files']:
+                nuevos.append(f)
+                continue
+            firma, segmento = estado['files'][f]
+            st = os.stat(f)
+            if (st.st_mtime_ns, st.st_size) != firma[:2]:
+                actual = file_signature(f)
+                if actual[2] != firma[2]:
+                    cambiados.append(f)
+                else:
+                    estado['files'][f] = (actual, segmento)
+        presentes = set(ficheros)
+        borrados = [f for f in estado['files'] if f not in presentes]
+
+        # las noticias antiguas de los ficheros modificados o borrados se marcan como borradas
+        porsegmento = {}
+        for f in cambiados + borrados:
+            if estado['files'][f][1] is None:
+                # fichero sin noticias, no esta en ningun segmento
+                continue
+            porsegmento.setdefault(estado['files'][f][1], []).append(f)
+        for segmento, lista in porsegmento.items():
+            parte = open_segment(segment_path(index, segmento))
+            marcadas = set(estado['deleted'].get(segmento, ()))
+            for f in lista:
+                marcadas.update(file_news(parte, f))
+            estado['deleted'][segmento] = sorted(marcadas)
+        for f in borrados:
+            del estado['files'][f]
+
+        nombre = None
+        indexar = sorted(nuevos + cambiados)
+        if indexar:
+            base = open_segment(segment_path(index, estado['segments'][0]))
+            delta = SAR_Project()
+            for flag in FLAGS:
+                setattr(delta, flag, getattr(base, flag))
+            delta.index_files(indexar, workers)
+            delta.finish_index()
+            if len(delta.news) > 0:
+                nombre = "%s.%d" % (os.path.basename(index), estado['next'])
+                estado['next'] += 1
+                delta.save_segment(segment_path(index, nombre))
+                estado['segments'].append(nombre)
+                estado['sizes'][nombre] = len(delta.news)
+            for f in indexar:
+                estado['files'][f] = (delta.manifest[f], nombre)
+
+        write_manifest(index, estado)
+
+    return {'new': nuevos, 'changed': cambiados, 'removed': borrados, 'segment': nombre,
+            'segments': len(estado['segments'])}
+
+
+def merge_plan(estado):
+    """
+    Elige los segmentos a fusionar: si hay mas de MERGE_FACTOR, los MERGE_FACTOR mas
+    recientes y, mientras el segmento anterior no sea mayor que todos ellos juntos,
+    tambien ese. Asi cada noticia se reescribe un numero logaritmico de veces.
+
+    return: lista de nombres de segmentos consecutivos (vacia si no hay que fusionar)
+
+    """
+    segmentos = estado['segments']
+    if len(segmentos) <= MERGE_FACTOR:
+        return []
+    i = len(segmentos) - MERGE_FACTOR
+    total = sum(estado['sizes'][s] for s in segmentos[i:])
+    while i > 0 and estado['sizes'][segmentos[i - 1]] <= total:
+        i -= 1
+        total += estado['sizes'][segmentos[i]]
+    return segmentos[i:]
+
+
+def merge_segments(index, todos=False):
+    """
+    Fusiona segmentos de un indice incremental en uno solo, sin las noticias borradas.
+
+    El cerrojo solo se toma para leer el manifiesto y para sustituir los segmentos por el
+    nuevo, de forma que se pueden hacer actualizaciones mientras se fusiona. Las noticias
+    que se borran durante la fusion se marcan como borradas en el segmento nuevo.
+
+    El fichero del segmento base (el que ha indicado el usuario) nunca se borra: si se
+    fusiona, el resultado se escribe en su lugar y conserva su nombre.
+
+    param:  "index": ruta del segmento base
+            "todos": fusionar todos los segmentos, en lugar de seguir merge_plan
+
+    return: lista de segmentos fusionados (vacia si no habia nada que fusionar)
+
+    """
+    with IndexLock(index):
+        estado = read_manifest(index)
+        plan = list(estado['segments']) if todos else merge_plan(estado)
+        if len(plan) < 2 and not (plan and estado['deleted'].get(plan[0])):
+            return []
+        base = os.path.basename(index)
+        if plan[0] == base:
+            nombre = base
+        else:
+            nombre = "%s.%d" % (base, estado['next'])
+            estado['next'] += 1
+            write_manifest(index, estado)
+        borrados = {s: set(estado['deleted'].get(s, ())) for s in plan}
+
+    fusion = SAR_Project()
+    renumerar = {}
+    for s in plan:
+        parte = open_segment(segment_path(index, s))
+        if not renumerar:
+            for flag in FLAGS:
+                setattr(fusion, flag, getattr(parte, flag))
+        vivas = [n for n in range(len(parte.news)) if n not in borrados[s]]
+        renumerar[s] = dict(zip(vivas, range(len(fusion.news), len(fusion.news) + len(vivas))))
+        fusion.merge_project(parte, borrados[s])
+        for f, firma in parte.manifest.items():
+            fusion.manifest[f] = firma
+    fusion.finish_index()
+    # el segmento base se escribe aparte y sustituye al original al actualizar el manifiesto
+    destino = segment_path(index, nombre) + ('.merging' if nombre == base else '')
+    fusion.save_segment(destino)
+
+    with IndexLock(index):
+        estado = read_manifest(index)
+        segmentos = estado['segments']
+        i = segmentos.index(plan[0]) if plan[0] in segmentos else -1
+        if i < 0 or segmentos[i:i + len(plan)] != plan:
+            # el indice ha cambiado por otro camino (p.e. otra fusion): se descarta esta
+            os.remove(destino)
+            return []
+        if destino != segment_path(index, nombre):
+            os.replace(destino, segment_path(index, nombre))
+        segmentos[i:i + len(plan)] = [nombre]
+        nuevos = []
+        for s in plan:
+            for n in set(estado['deleted'].pop(s, ())) - borrados[s]:
+                nuevos.append(renumerar[s][n])
+            del estado['sizes'][s]
+        if nuevos:
+            estado['deleted'][nombre] = sorted(nuevos)
+        estado['sizes'][nombre] = len(fusion.news)
+        for f, (firma, s) in estado['files'].items():
+            if s in plan:
+                estado['files'][f] = (firma, nombre)
+        write_manifest(index, estado)
+
+    for s in plan:
+        if s == nombre:
+            continue
+        try:
+            os.remove(segment_path(index, s))
+        except OSError:
+            # p.e. en Windows si un buscador lo tiene abierto
+            pass
+    return plan
+
+
+def remove_segments(index):
+    """
+    Borra el manifiesto y los segmentos añadidos de un indice incremental, p.e. antes de
+    crearlo de nuevo completo; el segmento base no se toca.
+    """
+    if not os.path.exists(index + '.manifest'):
+        return
+    with IndexLock(index):
+        estado = read_manifest(index)
+        for s in estado['segments']:
+            if s != os.path.basename(index) and os.path.exists(segment_path(index, s)):
+                os.remove(segment_path(index, s))
+        os.remove(index + '.manifest')
+
+
+def merge_in_background(index):
+    """
+    Lanza merge_segments en un proceso independiente, que sigue aunque termine el indexador.
+    """
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), index],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+class MultiSegmentProject(SAR_Project):
+    """
+    Buscador sobre un indice incremental.
+
+    Cada segmento se abre como un SAR_Project (con mmap) y cada consulta se resuelve en
+    todos ellos, quitando las noticias borradas; los newid de cada segmento se desplazan
+    con el numero de noticias de los anteriores. Al ordenar, cada segmento usa sus propias
+    estadisticas (idf, longitud media) hasta que se fusiona con los demas.
+    """
+
+    def __init__(self, index):
+        super().__init__()
+        estado = read_manifest(index)
+        self.parts = []
+        self.bases = []
+        self.deleted = []
+        total = 0
+        for s in estado['segments']:
+            parte = open_segment(segment_path(index, s))
+            parte.query_cache = None
+            self.parts.append(parte)
+            self.bases.append(total)
+            self.deleted.append(estado['deleted'].get(s, []))
+            total += len(parte.news)
+        for flag in FLAGS:
+            setattr(self, flag, getattr(self.parts[0], flag))
+        self.index_version += 1
+
+    def _sync(self, parte):
+        # las opciones del buscador se aplican a todos los segmentos
+        parte.use_stemming = self.use_stemming
+        parte.rank_model = self.rank_model
+        parte.profile = self.profile
+        return parte
+
+    def _combine(self, resultados):
+        # une los resultados de cada segmento quitando los borrados y desplazando los newid
+        res = []
+        for parte, base, borrados, r in zip(self.parts, self.bases, self.deleted, resultados):
+            if borrados:
+                r = parte.minus_posting(r, borrados)
+            res.extend(n + base for n in r)
+        return res
+
+    def eval_plan(self, arbol):
+        return self._combine([self._sync(parte).eval_query(arbol) for parte in self.parts])
+
+    def solve_batch(self, queries, workers=1):
+        resultados = [self._sync(parte).solve_batch(queries, workers) for parte in self.parts]
+        # las queries mal formadas (None) lo estan en todos los segmentos
+        return [None if r[0] is None else self._combine(r) for r in zip(*resultados)]
+
+    def get_record(self, newid):
+        i = bisect_right(self.bases, newid) - 1
+        return self._sync(self.parts[i]).get_record(newid - self.bases[i])
+
+    def query_terms(self, query):
+        palabras = set()
+        for parte in self.parts:
+            palabras.update(self._sync(parte).query_terms(query))
+        return palabras
+
+    def rank_result(self, result, query, k=None):
+        locales = [[] for _ in self.parts]
+        for n in result:
+            i = bisect_right(self.bases, n) - 1
+            locales[i].append(n - self.bases[i])
+        ordenados = []
+        for parte, base, local in zip(self.parts, self.bases, locales):
+            ranking = self._sync(parte).rank_result(local, query, k)
+            ordenados.append([(n + base, score) for n, score in ranking])
+        # merge es estable: a igual puntuacion quedan primero los segmentos mas antiguos
+        res = merge(*ordenados, key=lambda x: -x[1])
+        return list(islice(res, k) if k is not None else res)
+
+    def show_stats(self):
+        print('========================================')
+        print('Segmentos: {}'.format(len(self.parts)))
+        for parte, borrados in zip(self.parts, self.deleted):
+            print('\t{} noticias, {} borradas, {} días'.format(len(parte.news), len(borrados), len(parte.docs)))
+        print('========================================')
+
+
+if __name__ == "__main__":
+    # fusion en segundo plano, ver merge_in_background
+    merge_segments(sys.argv[1])
@@ -0,0 +1,23 @@
+"""
+Vocabulario de terminos con term ids.
+"""
+
+
+class Vocabulary(dict):
+    """
+    Diccionario termino --> term id. Los term id son consecutivos (0, 1, 2...) en el
+    orden en que aparecen los terminos, y self.terms es la lista de terminos por term id.
+
+    Al consultar un termino nuevo con [] se le asigna el siguiente term id (__missing__),
+    de forma que tokenizar y traducir a term ids es un unico map sobre los tokens; con
+    get o in no se añade nada, como en un diccionario normal.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.terms = []
+
+    def __missing__(self, term):
+        t = self[term] = len(self.terms)
+        self.terms.append(term)
+        return t
@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import SAR_lib
+from SAR_lib import SAR_Project
+
+
+def noticias(tmp_path, nficheros=4):
+    for i in range(nficheros):
+        with open(tmp_path / ('%02d.json' % i), 'w', encoding='utf-8') as fh:
+            json.dump([{'id': 2 * i + j, 'date': '2015-01-%02d' % (i + 1), 'title': 'noticia %d' % j,
+                        'keywords': 'k', 'article': 'valencia y canarias %d fichero %d' % (j, i)}
+                       for j in range(2)], fh)
+    return SAR_Project().news_files(tmp_path)
+
+
+def indexador():
+    indexer = SAR_Project()
+    indexer.positional = True
+    indexer.multifield = True
+    indexer.ranking = True
+    return indexer
+
+
+def test_pocos_datos_o_cpus_secuencial(tmp_path, monkeypatch):
+    ficheros = noticias(tmp_path)
+    monkeypatch.setattr(SAR_lib, 'available_cpus', lambda: 8)
+    assert SAR_Project().parallel_workers(ficheros, 4) == 1
+    monkeypatch.setattr(SAR_lib, 'PARALLEL_MIN', 0)
+    assert SAR_Project().parallel_workers(ficheros, 4) == 4
+    assert SAR_Project().parallel_workers(ficheros, 16) == len(ficheros)
+    monkeypatch.setattr(SAR_lib, 'available_cpus', lambda: 1)
+    assert SAR_Project().parallel_workers(ficheros, 4) == 1
+
+
+def test_paralelo_igual_que_secuencial(tmp_path):
+    ficheros = noticias(tmp_path)
+    secuencial = indexador()
+    for filename in ficheros:
+        secuencial.index_file(filename)
+    paralelo = indexador()
+    paralelo.index_parallel(ficheros, 2)
+    assert paralelo.news == secuencial.news
+    assert paralelo.index == secuencial.index
+    assert paralelo.posindex == secuencial.posindex
+    assert paralelo.weight == secuencial.weight
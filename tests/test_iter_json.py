@@ -0,0 +1,27 @@
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SAR_lib import iter_json
+
+
+VALORES = [12345, 678, -9.5e10, 0, True, None, "texto", {"id": 1234567, "tags": [10, 200]}]
+
+
+def test_numeros_cortados_por_el_bloque():
+    texto = json.dumps(VALORES)
+    for chunk in range(1, 12):
+        assert list(iter_json(io.StringIO(texto), chunk)) == VALORES
+
+
+def test_json_lines_bloques_pequenos():
+    texto = ''.join(json.dumps(v) + '\n' for v in VALORES)
+    for chunk in range(1, 12):
+        assert list(iter_json(io.StringIO(texto), chunk)) == VALORES
+
+
+def test_array_de_enteros_con_chunk_2():
+    assert list(iter_json(io.StringIO('[12345, 678]'), 2)) == [12345, 678]
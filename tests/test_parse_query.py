@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SAR_lib import SAR_Project, QuerySyntaxError
+
+
+MAL_FORMADAS = ['valencia AND', 'valencia )', 'valencia ) AND canarias', '(valencia OR canarias',
+                'valencia AND ()', 'NOT', 'valencia OR OR canarias', 'valencia NEAR/3', 'NEAR/3 valencia', '']
+
+
+@pytest.mark.parametrize('query', MAL_FORMADAS)
+def test_query_mal_formada(query):
+    with pytest.raises(QuerySyntaxError):
+        SAR_Project().parse_query(query)
+
+
+def test_query_bien_formada():
+    arbol = SAR_Project().parse_query('(valencia OR canarias) AND NOT title:isla')
+    assert arbol == ('and', (('or', (('term', 'article', 'valencia'), ('term', 'article', 'canarias'))),
+                             ('not', ('term', 'title', 'isla'))))
+
+
+def test_solve_and_count_muestra_el_error(capsys):
+    assert SAR_Project().solve_and_count('valencia AND') is None
+    assert 'Error de sintaxis' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('query', ['val* NEAR/3 canarias', 'valencia NEAR/3 can?rias',
+                                   '"gran canaria" NEAR/3 isla', 'a NEAR/2 b NEAR/2 "c d"',
+                                   'title:valencia NEAR/3 canarias'])
+def test_near_solo_palabras_del_mismo_campo(query):
+    with pytest.raises(QuerySyntaxError):
+        SAR_Project().parse_query(query)
+
+
+@pytest.mark.parametrize('query', ['"gran canaria', 'a " b', 'gran canaria"', '"a b" AND "c'])
+def test_comillas_sin_cerrar(query):
+    with pytest.raises(QuerySyntaxError):
+        SAR_Project().parse_query(query)
+
+
+def test_frase():
+    assert SAR_Project().parse_query('"gran  canaria" isla') == \
+        ('and', (('term', 'article', '"gran|canaria"'), ('term', 'article', 'isla')))
@@ -0,0 +1,27 @@
+import json
+import os
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_test_con_query_mal_formada(tmp_path):
+    noticias = tmp_path / 'news'
+    noticias.mkdir()
+    with open(noticias / 'n.json', 'w', encoding='utf-8') as fh:
+        json.dump([{'id': 1, 'date': '2015-01-02', 'title': 't', 'keywords': 'k',
+                    'article': 'valencia y canarias'}], fh)
+    indice = tmp_path / 'idx.bin'
+    subprocess.run([sys.executable, os.path.join(RAIZ, 'SAR_Indexer.py'), str(noticias), str(indice)],
+                   check=True, capture_output=True)
+    queries = tmp_path / 'test.txt'
+    queries.write_text('valencia\t1\nvalencia AND\t1\ncanarias\t1\n', encoding='utf-8')
+
+    salida = subprocess.run([sys.executable, os.path.join(RAIZ, 'SAR_Searcher.py'), '-T', str(queries), str(indice)],
+                            capture_output=True, text=True)
+    assert salida.returncode != 0
+    assert 'Traceback' not in salida.stderr
+    assert "==> ERROR: 'valencia AND'" in salida.stdout
+    assert 'Error de sintaxis' in salida.stdout
+    assert 'canarias' not in salida.stdout